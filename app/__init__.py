@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 
 import os
+import multiprocessing
 
 from flask import Flask
 from flask_pymongo import PyMongo
@@ -28,6 +29,7 @@ csrf = CSRFProtect()
 def create_app(config_class: type = Config) -> Flask:
     app = Flask(__name__)
     app.config.from_object(config_class)
+    app.config["CONFIG_CLASS"] = config_class
 
     pymongo.init_app(app)
     bootstrap.init_app(app)
@@ -51,11 +53,36 @@ def create_app(config_class: type = Config) -> Flask:
     if not os.path.isdir(nipype_crash_dir):
         os.makedirs(nipype_crash_dir, exist_ok=True)
 
-    nipype_config_dict = {'execution': {
-        'crashdump_dir': os.path.abspath(nipype_crash_dir)
-    }}
+    nipype_config_dict = {
+        'execution': {
+            'crashdump_dir': os.path.abspath(nipype_crash_dir),
+            # переиспользование этапов анализа опирается на хэш содержимого входных файлов, а не на время изменения
+            'hash_method': 'content',
+        },
+        # монитор ресурсов записывает пиковую память и загрузку CPU каждого узла
+        'monitoring': {
+            'enabled': True,
+        },
+    }
     config.update_config(nipype_config_dict)
     logging.update_logging(config)
+    # процесс анализа запускается через forkserver и применяет эти настройки сам
+    app.config["NIPYPE_CONFIG"] = nipype_config_dict
+
+    # веб-сервер многопоточный, а fork копирует блокировки, захваченные другими потоками (логгер, клиент MongoDB),
+    # и ребенок может навсегда на них зависнуть. Поэтому дочерние процессы порождает однопоточный forkserver,
+    # в который заранее импортированы тяжелые модули загрузки и анализа
+    multiprocessing.set_start_method("forkserver", force=True)
+    multiprocessing.set_forkserver_preload(["app.patients.utils"])
+
+    from app.patients.jobs import start_local_workers, worker_command
+    app.cli.add_command(worker_command)
+
+    from app.patients.series_archive import migrate_archives_command
+    app.cli.add_command(migrate_archives_command)
+
+    if app.config["ANALYSIS_LOCAL_WORKERS"] > 0:
+        app.before_first_request(lambda: start_local_workers(app))
 
     return app
 
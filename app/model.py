@@ -2,12 +2,14 @@
 
 import random
 import string
-import os
 
 from attr import attrs, attrib, fields, asdict
-from datetime import datetime
-from flask_pymongo import ObjectId
-from typing import List, Any, Dict, Tuple
+from datetime import datetime, timedelta
+from flask_pymongo import ObjectId, ASCENDING
+from pymongo import ReturnDocument, CursorType
+from pymongo.errors import BulkWriteError
+from pymongo.cursor import Cursor
+from typing import List, Any, Dict, Tuple, Iterator, Set
 from flask import abort, current_app
 from flask_login import UserMixin
 from werkzeug.security import check_password_hash, generate_password_hash
@@ -17,7 +19,9 @@ from transliterate import translit
 from app import login, pymongo
 
 __all__ = ["RegistrationData", "PrimaryData", "SecondaryBiomarkers", "SeriesData", "Series",
-           "PatientCollection", "Patient", "User", "UserCollection"]
+           "PatientCollection", "Patient", "User", "UserCollection", "AnalysisJob", "JobCollection",
+           "AnalysisCacheEntry", "AnalysisCacheCollection", "AnalysisEventCollection", "UploadSession",
+           "UploadSessionCollection", "SliceIndexCollection"]
 
 
 @attrs
@@ -98,16 +102,42 @@ class Series:
 
     dicom_path = attrib(type=str)
     nifti_dir = attrib(type=str)
-    img_dir = attrib(type=str)
+    img_dir = attrib(type=str, default=None)  # картинки срезов, сохраненные при загрузке старыми версиями
 
     # данные, полученные после проведения морфометического анализа
     whole_brain_volume = attrib(type=float, default=None)
     left_volume = attrib(type=float, default=None)
     right_volume = attrib(type=float, default=None)
-    status = attrib(type=str, default=None)  # ok, timeout, runtime error
+    structure_volumes = attrib(type=Dict[str, float], default=None)  # объемы всех структур FIRST
+    status = attrib(type=str, default=None)  # ok, timeout, cancelled, qc failed, runtime error
+
+    # результаты проверки качества снимка перед анализом
+    qc_metrics = attrib(type=Dict[str, Any], default=None)
+    qc_message = attrib(type=str, default=None)
+
+    # состояние задания на анализ в очереди
+    job_status = attrib(type=str, default=None)  # queued, running, done, failed, cancelled
+    queued_dt = attrib(type=datetime, default=None)
+    started_dt = attrib(type=datetime, default=None)
+    finished_dt = attrib(type=datetime, default=None)
+
+    # время и ресурсы по этапам анализа: queue, cache, bet, first, stats, views
+    metrics = attrib(type=Dict[str, Dict[str, Any]], default=None)
+
+    ANALYSIS_FIELDS = ("whole_brain_volume", "left_volume", "right_volume", "status")
+
+    # поля, которые теряют смысл при изменении снимка серии
+    RESULT_FIELDS = ANALYSIS_FIELDS + ("structure_volumes", "qc_metrics", "qc_message", "job_status", "queued_dt",
+                                       "started_dt", "finished_dt", "metrics")
+
+    IN_PROGRESS_STATUSES = ("queued", "running")
 
     def is_full_filled(self) -> bool:
-        return all(value is not None for value in asdict(self).values())
+        return all(getattr(self, name) is not None for name in self.ANALYSIS_FIELDS)
+
+    @property
+    def in_progress(self) -> bool:
+        return self.job_status in self.IN_PROGRESS_STATUSES
 
     @property
     def normed_left_volume(self) -> float:
@@ -119,12 +149,6 @@ class Series:
         if self.right_volume is not None and self.whole_brain_volume is not None:
             return round(self.right_volume / self.whole_brain_volume, 5)
 
-    @property
-    def image_paths(self) -> List[str]:
-        img_dir = os.path.join(current_app.static_folder, self.img_dir)
-        sorted_list_dir = sorted(os.listdir(img_dir), key=lambda x: int(x.split('.')[0]))
-        return [os.path.join(self.img_dir, basename) for basename in sorted_list_dir]
-
     def __repr__(self) -> str:
         return f"Дата и время создания: {self.dt}\n" \
                f"Объем левого гиппокампа: {self.left_volume} мм\u00b3\n" \
@@ -337,6 +361,89 @@ class PatientCollection:
             inserted = pymongo.db.patients.insert_one(data.serialize())
             return str(inserted.inserted_id)
 
+    @staticmethod
+    def update_series(patient_id: str, series_id: str, values: Dict[str, Any]) -> bool:
+        """
+        Точечно обновляем поля одной серии, не перезаписывая остальные серии пациента.
+        Если серия уже удалена, то ничего не делаем.
+        """
+        prefix = f"{SeriesData.FIELD_NAME}.series_dict.{series_id}"
+        result = pymongo.db.patients.update_one(
+            {"_id": ObjectId(patient_id), prefix: {"$exists": True}},
+            {"$set": {f"{prefix}.{key}": value for key, value in values.items()}}
+        )
+        return result.matched_count > 0
+
+    @staticmethod
+    def insert_series(patient_id: str, series_id: str, series: Series) -> None:
+        """
+        Добавляем серию в документ пациента, не перезаписывая остальные серии
+        """
+        prefix = f"{SeriesData.FIELD_NAME}.series_dict.{series_id}"
+        pymongo.db.patients.update_one(
+            {"_id": ObjectId(patient_id)},
+            {"$set": {prefix: asdict(series, filter=lambda _, value: value is not None)}}
+        )
+
+    @staticmethod
+    def reset_series(patient_id: str, series_id: str, values: Dict[str, Any], reset_fields: Tuple[str, ...]) -> bool:
+        """
+        Обновляем поля серии и удаляем поля reset_fields, только если серия сейчас не анализируется.
+        Состояние задания проверяется в самом запросе, поэтому анализ, поставленный в очередь
+        после чтения документа, не будет затерт. Если серия удалена или анализируется, то возвращаем False.
+        """
+        prefix = f"{SeriesData.FIELD_NAME}.series_dict.{series_id}"
+        result = pymongo.db.patients.update_one(
+            {"_id": ObjectId(patient_id), prefix: {"$exists": True},
+             f"{prefix}.job_status": {"$nin": list(Series.IN_PROGRESS_STATUSES)}},
+            {"$set": {f"{prefix}.{key}": value for key, value in values.items()},
+             "$unset": {f"{prefix}.{name}": "" for name in reset_fields}}
+        )
+        return result.matched_count > 0
+
+    @staticmethod
+    def series_exists(patient_id: str, series_id: str) -> bool:
+        prefix = f"{SeriesData.FIELD_NAME}.series_dict.{series_id}"
+        return pymongo.db.patients.count_documents({"_id": ObjectId(patient_id), prefix: {"$exists": True}},
+                                                   limit=1) > 0
+
+    @staticmethod
+    def remove_series(patient_id: str, series_id: str) -> None:
+        prefix = f"{SeriesData.FIELD_NAME}.series_dict.{series_id}"
+        pymongo.db.patients.update_one({"_id": ObjectId(patient_id)}, {"$unset": {prefix: ""}})
+
+    @staticmethod
+    def aggregate_series_metrics() -> List[Dict[str, Any]]:
+        """
+        Сводная статистика по этапам анализа всех серий. Переиспользованные этапы не учитываем.
+        """
+        pipeline = [
+            {"$project": {"series": {"$objectToArray": f"${SeriesData.FIELD_NAME}.series_dict"}}},
+            {"$unwind": "$series"},
+            {"$project": {"metrics": {"$objectToArray": "$series.v.metrics"}}},
+            {"$unwind": "$metrics"},
+            {"$match": {"metrics.v.reused": {"$ne": True}}},
+            {"$group": {
+                "_id": "$metrics.k",
+                "count": {"$sum": 1},
+                "wall_time_avg": {"$avg": "$metrics.v.wall_time"},
+                "wall_time_max": {"$max": "$metrics.v.wall_time"},
+                "cpu_time_avg": {"$avg": "$metrics.v.cpu_time"},
+                "cpu_time_max": {"$max": "$metrics.v.cpu_time"},
+                "peak_rss_mb_avg": {"$avg": "$metrics.v.peak_rss_mb"},
+                "peak_rss_mb_max": {"$max": "$metrics.v.peak_rss_mb"},
+                "peak_cpu_percent_max": {"$max": "$metrics.v.peak_cpu_percent"},
+            }},
+            {"$sort": {"_id": ASCENDING}},
+        ]
+
+        stages = []
+        for data in pymongo.db.patients.aggregate(pipeline):
+            data["stage"] = data.pop("_id")
+            stages.append(data)
+
+        return stages
+
     @staticmethod
     def paginate(page_num: int, cls: type = None, sort_rules: Dict[str, int] = None) -> Tuple[
         List[_PatientData], bool, bool]:
@@ -367,3 +474,356 @@ class PatientCollection:
     def __cls_check(cls: type = None) -> None:
         if cls is not None and not issubclass(cls, _PatientData):
             raise ValueError(f"Passed class must be a subclass of {_PatientData.__name__}")
+
+
+@attrs
+class AnalysisJob:
+    id = attrib(type=str)
+    patient_id = attrib(type=str)
+    series_id = attrib(type=str)
+    state = attrib(type=str)  # queued, running, done, failed, cancelled
+    created_dt = attrib(type=datetime)
+    started_dt = attrib(type=datetime, default=None)
+    finished_dt = attrib(type=datetime, default=None)
+    error = attrib(type=str, default=None)
+
+    # аренда задания воркером: пока воркер жив, он продлевает lease_expires
+    worker_id = attrib(type=str, default=None)
+    lease_expires = attrib(type=datetime, default=None)
+    heartbeat_dt = attrib(type=datetime, default=None)
+    attempts = attrib(type=int, default=0)
+    cancel_requested = attrib(type=bool, default=False)
+
+    @classmethod
+    def create_from_dict(cls, data: Dict[str, Any]) -> "AnalysisJob":
+        data["id"] = str(data["_id"])
+        del data["_id"]
+        return cls(**data)
+
+
+class JobCollection:
+
+    @staticmethod
+    def init() -> None:
+        if "state_created_dt_" not in pymongo.db.jobs.index_information():
+            pymongo.db.jobs.create_index([("state", ASCENDING), ("created_dt", ASCENDING)], name="state_created_dt_")
+
+        if "state_lease_expires_" not in pymongo.db.jobs.index_information():
+            pymongo.db.jobs.create_index([("state", ASCENDING), ("lease_expires", ASCENDING)],
+                                         name="state_lease_expires_")
+
+    @staticmethod
+    def push(patient_id: str, series_id: str) -> str:
+        inserted = pymongo.db.jobs.insert_one({"patient_id": patient_id, "series_id": series_id, "state": "queued",
+                                               "created_dt": datetime.now(), "attempts": 0})
+        return str(inserted.inserted_id)
+
+    @staticmethod
+    def claim(worker_id: str, lease_seconds: int) -> AnalysisJob:
+        """
+        Атомарно забираем самое старое задание из очереди и берем его в аренду
+        """
+        now = datetime.now()
+        data = pymongo.db.jobs.find_one_and_update(
+            {"state": "queued"},
+            {"$set": {"state": "running", "started_dt": now, "worker_id": worker_id, "heartbeat_dt": now,
+                      "lease_expires": now + timedelta(seconds=lease_seconds)},
+             "$inc": {"attempts": 1}},
+            sort=[("created_dt", ASCENDING)],
+            return_document=ReturnDocument.AFTER
+        )
+        if data is not None:
+            return AnalysisJob.create_from_dict(data)
+
+    @staticmethod
+    def heartbeat(job_id: str, worker_id: str, lease_seconds: int) -> AnalysisJob:
+        """
+        Продлеваем аренду задания. Возвращаем None, если аренду уже забрали у воркера
+        """
+        now = datetime.now()
+        data = pymongo.db.jobs.find_one_and_update(
+            {"_id": ObjectId(job_id), "state": "running", "worker_id": worker_id},
+            {"$set": {"heartbeat_dt": now, "lease_expires": now + timedelta(seconds=lease_seconds)}},
+            return_document=ReturnDocument.AFTER
+        )
+        if data is not None:
+            return AnalysisJob.create_from_dict(data)
+
+    @staticmethod
+    def request_cancel(patient_id: str, series_id: str) -> AnalysisJob:
+        """
+        Задание в очереди отменяем сразу, выполняющемуся заданию выставляем флаг отмены,
+        который воркер получит при продлении аренды. Возвращаем найденное активное задание.
+        """
+        data = pymongo.db.jobs.find_one_and_update(
+            {"patient_id": patient_id, "series_id": series_id, "state": "queued"},
+            {"$set": {"state": "cancelled", "finished_dt": datetime.now()}},
+            return_document=ReturnDocument.AFTER
+        )
+        if data is None:
+            data = pymongo.db.jobs.find_one_and_update(
+                {"patient_id": patient_id, "series_id": series_id, "state": "running"},
+                {"$set": {"cancel_requested": True}},
+                return_document=ReturnDocument.AFTER
+            )
+
+        if data is not None:
+            return AnalysisJob.create_from_dict(data)
+
+    @staticmethod
+    def requeue_expired(max_attempts: int) -> List[AnalysisJob]:
+        """
+        Возвращаем в очередь задания, аренда которых истекла (воркер упал или завис).
+        Задания, исчерпавшие количество попыток, помечаем как проваленные.
+        """
+        jobs = []
+
+        expired_filter = {"state": "running", "lease_expires": {"$lt": datetime.now()}}
+        for data in pymongo.db.jobs.find(expired_filter):
+            if data.get("cancel_requested"):
+                state = "cancelled"
+            elif data.get("attempts", 0) < max_attempts:
+                state = "queued"
+            else:
+                state = "failed"
+
+            update = {"state": state, "worker_id": None, "lease_expires": None}
+            if state != "queued":
+                update.update({"finished_dt": datetime.now(), "error": "lease expired"})
+
+            data = pymongo.db.jobs.find_one_and_update(dict(expired_filter, _id=data["_id"]), {"$set": update},
+                                                       return_document=ReturnDocument.AFTER)
+            if data is not None:
+                jobs.append(AnalysisJob.create_from_dict(data))
+
+        return jobs
+
+    @staticmethod
+    def finish(job_id: str, worker_id: str, state: str, error: str = None) -> bool:
+        result = pymongo.db.jobs.update_one(
+            {"_id": ObjectId(job_id), "worker_id": worker_id},
+            {"$set": {"state": state, "finished_dt": datetime.now(), "error": error, "lease_expires": None}}
+        )
+        return result.matched_count > 0
+
+    @staticmethod
+    def delete_for_series(patient_id: str, series_id: str) -> None:
+        pymongo.db.jobs.delete_many({"patient_id": patient_id, "series_id": series_id, "state": "queued"})
+
+
+@attrs
+class AnalysisCacheEntry:
+    key = attrib(type=str)
+    size = attrib(type=int)  # суммарный размер файлов записи в байтах
+    volumes = attrib(type=Dict[str, float])
+    created_dt = attrib(type=datetime)
+    last_used_dt = attrib(type=datetime)
+
+    @classmethod
+    def create_from_dict(cls, data: Dict[str, Any]) -> "AnalysisCacheEntry":
+        data["key"] = data["_id"]
+        del data["_id"]
+        return cls(**data)
+
+
+class AnalysisCacheCollection:
+
+    @staticmethod
+    def init() -> None:
+        if "last_used_dt_" not in pymongo.db.analysis_cache.index_information():
+            pymongo.db.analysis_cache.create_index("last_used_dt", name="last_used_dt_")
+
+    @staticmethod
+    def find_one(key: str) -> AnalysisCacheEntry:
+        data = pymongo.db.analysis_cache.find_one_and_update({"_id": key}, {"$set": {"last_used_dt": datetime.now()}},
+                                                             return_document=ReturnDocument.AFTER)
+        if data is not None:
+            return AnalysisCacheEntry.create_from_dict(data)
+
+    @staticmethod
+    def save_data(entry: AnalysisCacheEntry) -> None:
+        data_dict = asdict(entry)
+        del data_dict["key"]
+        pymongo.db.analysis_cache.update_one({"_id": entry.key}, {"$set": data_dict}, upsert=True)
+
+    @staticmethod
+    def delete_one(key: str) -> None:
+        pymongo.db.analysis_cache.delete_one({"_id": key})
+
+    @staticmethod
+    def total_size() -> int:
+        result = list(pymongo.db.analysis_cache.aggregate([{"$group": {"_id": None, "size": {"$sum": "$size"}}}]))
+        return result[0]["size"] if result else 0
+
+    @staticmethod
+    def iter_least_recently_used() -> Iterator[AnalysisCacheEntry]:
+        for data in pymongo.db.analysis_cache.find().sort("last_used_dt", ASCENDING):
+            yield AnalysisCacheEntry.create_from_dict(data)
+
+
+class AnalysisEventCollection:
+    """
+    События анализа (смена этапов) хранятся в ограниченной (capped) коллекции. Это позволяет читать их
+    tailable курсором: MongoDB сама отдает новые события, и опрашивать БД на каждое событие не нужно.
+    """
+
+    SIZE = 16 * 1024 * 1024
+
+    @staticmethod
+    def init() -> None:
+        if "analysis_events" not in pymongo.db.list_collection_names():
+            pymongo.db.create_collection("analysis_events", capped=True, size=AnalysisEventCollection.SIZE)
+
+    @staticmethod
+    def push(patient_id: str, series_id: str, stage: str, status: str) -> None:
+        pymongo.db.analysis_events.insert_one({"patient_id": patient_id, "series_id": series_id, "stage": stage,
+                                               "status": status, "dt": datetime.now()})
+
+    @staticmethod
+    def find_for_series(patient_id: str, series_id: str, since: datetime) -> List[Dict[str, Any]]:
+        return list(pymongo.db.analysis_events.find({"patient_id": patient_id, "series_id": series_id,
+                                                     "dt": {"$gte": since}}))
+
+    @staticmethod
+    def tail_all(since: datetime) -> Cursor:
+        return pymongo.db.analysis_events.find({"dt": {"$gte": since}}, cursor_type=CursorType.TAILABLE_AWAIT)
+
+
+@attrs
+class UploadSession:
+    id = attrib(type=str)
+    patient_id = attrib(type=str)
+    user_id = attrib(type=str)
+    chunk_size = attrib(type=int)
+    # файлы сессии: имя, размер и номера уже принятых кусков
+    files = attrib(type=List[Dict[str, Any]])
+    created_dt = attrib(type=datetime)
+    updated_dt = attrib(type=datetime)
+    state = attrib(type=str, default="uploading")  # uploading, finalizing
+
+    def chunk_count(self, file_index: int) -> int:
+        return max(1, -(-self.files[file_index]["size"] // self.chunk_size))
+
+    def missing_chunks(self, file_index: int) -> List[int]:
+        received = set(self.files[file_index]["chunks"])
+        return [num for num in range(self.chunk_count(file_index)) if num not in received]
+
+    @property
+    def is_complete(self) -> bool:
+        return not any(self.missing_chunks(file_index) for file_index in range(len(self.files)))
+
+    @classmethod
+    def create_from_dict(cls, data: Dict[str, Any]) -> "UploadSession":
+        data["id"] = str(data["_id"])
+        del data["_id"]
+        return cls(**data)
+
+
+class UploadSessionCollection:
+
+    @staticmethod
+    def init() -> None:
+        if "updated_dt_" not in pymongo.db.upload_sessions.index_information():
+            pymongo.db.upload_sessions.create_index("updated_dt", name="updated_dt_")
+
+    @staticmethod
+    def push(patient_id: str, user_id: str, chunk_size: int, files: List[Dict[str, Any]]) -> UploadSession:
+        now = datetime.now()
+        data = {"patient_id": patient_id, "user_id": user_id, "chunk_size": chunk_size,
+                "files": [dict(file, chunks=[]) for file in files], "created_dt": now, "updated_dt": now,
+                "state": "uploading"}
+        inserted = pymongo.db.upload_sessions.insert_one(data)
+        return UploadSession.create_from_dict(dict(data, _id=inserted.inserted_id))
+
+    @staticmethod
+    def find_one_or_404(upload_id: str, patient_id: str, user_id: str) -> UploadSession:
+        if not ObjectId.is_valid(upload_id):
+            abort(404)
+
+        data = pymongo.db.upload_sessions.find_one_or_404({"_id": ObjectId(upload_id), "patient_id": patient_id,
+                                                           "user_id": user_id})
+        return UploadSession.create_from_dict(data)
+
+    @staticmethod
+    def add_chunk(upload_id: str, file_index: int, chunk_num: int) -> None:
+        pymongo.db.upload_sessions.update_one({"_id": ObjectId(upload_id)},
+                                              {"$addToSet": {f"files.{file_index}.chunks": chunk_num},
+                                               "$set": {"updated_dt": datetime.now()}})
+
+    @staticmethod
+    def start_finalizing(upload_id: str) -> bool:
+        """
+        Атомарно переводим сессию в состояние finalizing. Возвращаем False, если ее уже завершает другой запрос
+        """
+        result = pymongo.db.upload_sessions.update_one(
+            {"_id": ObjectId(upload_id), "state": {"$ne": "finalizing"}},
+            {"$set": {"state": "finalizing", "updated_dt": datetime.now()}}
+        )
+        return result.matched_count > 0
+
+    @staticmethod
+    def reset_state(upload_id: str) -> None:
+        pymongo.db.upload_sessions.update_one({"_id": ObjectId(upload_id)},
+                                              {"$set": {"state": "uploading", "updated_dt": datetime.now()}})
+
+    @staticmethod
+    def delete_one(upload_id: str) -> bool:
+        """
+        Удаляем сессию. Возвращаем False, если ее уже удалил другой запрос
+        """
+        return pymongo.db.upload_sessions.delete_one({"_id": ObjectId(upload_id)}).deleted_count > 0
+
+    @staticmethod
+    def find_abandoned(ttl: timedelta) -> List[UploadSession]:
+        return [UploadSession.create_from_dict(data)
+                for data in pymongo.db.upload_sessions.find({"updated_dt": {"$lt": datetime.now() - ttl}})]
+
+
+class SliceIndexCollection:
+    """
+    Индекс срезов пациента: SOPInstanceUID и хэш содержимого каждого сохраненного среза.
+    Срезы еще не полной серии хранятся отдельно и отмечены флагом pending.
+    """
+
+    @staticmethod
+    def init() -> None:
+        index_information = pymongo.db.slices.index_information()
+
+        if "patient_id_sop_uid_" not in index_information:
+            pymongo.db.slices.create_index([("patient_id", ASCENDING), ("sop_uid", ASCENDING)],
+                                           name="patient_id_sop_uid_", unique=True)
+
+        if "patient_id_series_id_" not in index_information:
+            pymongo.db.slices.create_index([("patient_id", ASCENDING), ("series_id", ASCENDING)],
+                                           name="patient_id_series_id_")
+
+    @staticmethod
+    def find_known(patient_id: str) -> Tuple[Set[str], Set[str]]:
+        """
+        SOPInstanceUID и хэши содержимого всех срезов пациента
+        """
+        sop_uids, content_hashes = set(), set()
+
+        for data in pymongo.db.slices.find({"patient_id": patient_id}, {"sop_uid": 1, "content_hash": 1}):
+            sop_uids.add(data["sop_uid"])
+            content_hashes.add(data["content_hash"])
+
+        return sop_uids, content_hashes
+
+    @staticmethod
+    def replace_series(patient_id: str, series_id: str, entries: List[Dict[str, Any]]) -> None:
+        pymongo.db.slices.delete_many({"patient_id": patient_id, "series_id": series_id})
+
+        if not entries:
+            return
+
+        try:
+            pymongo.db.slices.insert_many([dict(entry, patient_id=patient_id, series_id=series_id)
+                                           for entry in entries], ordered=False)
+        except BulkWriteError:
+            # срез с тем же SOPInstanceUID уже проиндексирован в другой серии пациента
+            pass
+
+    @staticmethod
+    def delete_for_series(patient_id: str, series_id: str) -> None:
+        pymongo.db.slices.delete_many({"patient_id": patient_id, "series_id": series_id})
@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import hashlib
+import time
+
+from datetime import datetime
+from typing import Dict, Any, Tuple
+from flask import current_app
+
+from app.model import *
+from app.storage import get_storage
+
+__all__ = ["CACHED_FILES", "CACHED_FIELDS", "make_key", "restore", "store", "stage_node_name", "stages_dir",
+           "touch_stages", "prune_stages"]
+
+# результаты анализа, которые хранятся в кэше. Кладутся в хранилище в папку NIFTI серии под этими же именами
+CACHED_FILES = ("post_bet.nii.gz", "post_first.nii.gz")
+
+# поля серии с результатами анализа, которые хранятся в кэше
+CACHED_FIELDS = ("left_volume", "right_volume", "whole_brain_volume", "structure_volumes")
+
+_CHUNK_SIZE = 1024 * 1024
+
+
+def make_key(nifti_path: str) -> str:
+    """
+    Ключ кэша - хэш содержимого исходного NIFTI вместе с параметрами FSL, влияющими на результат
+    """
+    sha = hashlib.sha256()
+
+    with open(nifti_path, "rb") as f:
+        for chunk in iter(lambda: f.read(_CHUNK_SIZE), b""):
+            sha.update(chunk)
+
+    params = (current_app.config["BET_FRAC"], current_app.config["FIRST_METHOD"],
+              bool(current_app.config["FIRST_THREE_STAGE"]))
+    sha.update(repr(params).encode())
+
+    return sha.hexdigest()
+
+
+def restore(key: str, nifti_dir: str) -> Dict[str, float]:
+    """
+    Ищем результат анализа в кэше. При попадании копируем закэшированные файлы в папку NIFTI серии
+    в хранилище и возвращаем объемы, при промахе возвращаем None.
+    """
+    entry = AnalysisCacheCollection.find_one(key)
+    if entry is None:
+        return None
+
+    storage = get_storage()
+    entry_prefix = _entry_prefix(key)
+
+    # запись могут вытеснить прямо во время копирования - тогда считаем это промахом
+    try:
+        for name in CACHED_FILES:
+            storage.copy(os.path.join(entry_prefix, name), os.path.join(nifti_dir, name))
+    except FileNotFoundError:
+        # файлы могли удалить вручную - тогда запись бесполезна
+        if not all(storage.exists(os.path.join(entry_prefix, name)) for name in CACHED_FILES):
+            AnalysisCacheCollection.delete_one(key)
+        return None
+
+    return entry.volumes
+
+
+def store(key: str, paths: Dict[str, str], volumes: Dict[str, float]) -> None:
+    """
+    Кладем результаты анализа (файлы по именам из CACHED_FILES) в кэш и вытесняем давно
+    не использованные записи, если кэш переполнен. Файлы хранятся в общем хранилище,
+    поэтому запись видна воркерам на всех хостах.
+    """
+    storage = get_storage()
+    entry_prefix = _entry_prefix(key)
+
+    # запись в индекс появляется только после того, как все ее файлы записаны
+    for name in CACHED_FILES:
+        storage.put_file(os.path.join(entry_prefix, name), paths[name])
+
+    size = sum(os.path.getsize(paths[name]) for name in CACHED_FILES)
+    now = datetime.now()
+    AnalysisCacheCollection.save_data(AnalysisCacheEntry(key=key, size=size, volumes=volumes, created_dt=now,
+                                                         last_used_dt=now))
+
+    _evict(current_app.config["ANALYSIS_CACHE_MAX_SIZE"])
+
+
+def _evict(max_size: int) -> None:
+    total_size = AnalysisCacheCollection.total_size()
+    storage = get_storage()
+
+    for entry in AnalysisCacheCollection.iter_least_recently_used():
+        if total_size <= max_size:
+            break
+
+        AnalysisCacheCollection.delete_one(entry.key)
+        storage.delete_prefix(_entry_prefix(entry.key))
+        total_size -= entry.size
+
+
+def _entry_prefix(key: str) -> str:
+    return os.path.join(current_app.config["ANALYSIS_CACHE_FOLDER"], key[:2], key)
+
+
+def stage_node_name(stage: str, params: Dict[str, Any]) -> str:
+    """
+    Имя узла nipype, включающее хэш его параметров. Для каждого набора параметров у узла своя рабочая папка,
+    поэтому при смене параметров одного этапа результаты остальных этапов переиспользуются.
+    Изменение входных файлов nipype отслеживает сам по хэшу содержимого.
+    """
+    params_hash = hashlib.sha1(repr(sorted(params.items())).encode()).hexdigest()[:10]
+    return f"{stage}_{params_hash}"
+
+
+def stages_dir(patient_id: str) -> str:
+    """
+    Папка, в которой nipype хранит рабочие папки узлов для серий пациента
+    """
+    return os.path.join(current_app.config["ANALYSIS_WORK_FOLDER"], patient_id)
+
+
+def touch_stages(workflow_dir: str, node_names: Tuple[str, ...]) -> None:
+    """
+    Отмечаем рабочие папки узлов как использованные, чтобы они не попали под удаление по сроку хранения
+    """
+    for node_name in node_names:
+        node_dir = os.path.join(workflow_dir, node_name)
+        if os.path.isdir(node_dir):
+            os.utime(node_dir)
+
+
+def prune_stages() -> None:
+    """
+    Удаляем рабочие папки узлов, которые не использовались дольше ANALYSIS_WORK_RETENTION_DAYS дней
+    """
+    work_folder = current_app.config["ANALYSIS_WORK_FOLDER"]
+    if not os.path.isdir(work_folder):
+        return
+
+    expire_time = time.time() - current_app.config["ANALYSIS_WORK_RETENTION_DAYS"] * 24 * 60 * 60
+
+    for patient_id in os.listdir(work_folder):
+        patient_dir = os.path.join(work_folder, patient_id)
+
+        for workflow_name in os.listdir(patient_dir):
+            workflow_dir = os.path.join(patient_dir, workflow_name)
+
+            for node_name in os.listdir(workflow_dir):
+                node_dir = os.path.join(workflow_dir, node_name)
+                if os.path.isdir(node_dir) and os.path.getmtime(node_dir) < expire_time:
+                    shutil.rmtree(node_dir, ignore_errors=True)
+
+            if not os.listdir(workflow_dir):
+                os.rmdir(workflow_dir)
+
+        if not os.listdir(patient_dir):
+            os.rmdir(patient_dir)
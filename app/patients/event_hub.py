@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+
+import time
+import queue
+import threading
+
+from collections import defaultdict
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Set, Tuple
+from flask import Flask, current_app
+from pymongo.errors import PyMongoError
+
+from app.model import *
+
+__all__ = ["Subscription", "subscribe"]
+
+# насколько раньше момента подписки начинаем читать события. Время событий пишут воркеры на других хостах,
+# поэтому запас покрывает расхождение часов, а повторы отсекаются по _id
+_TAIL_OVERLAP = timedelta(seconds=5)
+
+# пауза перед повторным открытием курсора, если он закрылся (коллекция пуста или события вытеснены)
+_REOPEN_DELAY = 1.0
+
+_lock = threading.Lock()
+_subscriptions: Dict[Tuple[str, str], Set["Subscription"]] = defaultdict(set)
+_reader: threading.Thread = None
+
+
+class Subscription:
+    """
+    Подписка одного потока SSE на события анализа серии. События приходят в очередь из общего потока чтения.
+    """
+
+    def __init__(self, patient_id: str, series_id: str, since: datetime) -> None:
+        self.key = (patient_id, series_id)
+        self.since = since
+        self.queue = queue.Queue()
+        self.seen_ids = set()
+
+    def get(self, timeout: float) -> Dict[str, Any]:
+        """
+        Следующее еще не отданное событие серии или None, если за timeout секунд событий не было
+        """
+        deadline = time.monotonic() + timeout
+
+        while True:
+            try:
+                event = self.queue.get(timeout=max(0.0, deadline - time.monotonic()))
+            except queue.Empty:
+                return None
+
+            # события прошлых запусков анализа серии пропускаем
+            if event["_id"] not in self.seen_ids and event["dt"] >= self.since:
+                self.seen_ids.add(event["_id"])
+                return event
+
+    def history(self) -> List[Dict[str, Any]]:
+        """
+        Уже произошедшие события серии начиная с since. Вызывается после подписки, поэтому событие,
+        записанное во время чтения истории, не теряется, а его повтор потом отсекается в get
+        """
+        events = AnalysisEventCollection.find_for_series(*self.key, self.since)
+        self.seen_ids.update(event["_id"] for event in events)
+        return events
+
+    def close(self) -> None:
+        with _lock:
+            subscriptions = _subscriptions.get(self.key)
+            if subscriptions is not None:
+                subscriptions.discard(self)
+                if not subscriptions:
+                    del _subscriptions[self.key]
+
+
+def subscribe(patient_id: str, series_id: str, since: datetime, max_streams: int) -> Subscription:
+    """
+    Подписываемся на события анализа серии, произошедшие начиная с since. Все подписки процесса обслуживает
+    один поток, который читает новые события одним tailable курсором, поэтому на каждого зрителя
+    не приходится свой запрос к MongoDB.
+    Если в процессе уже max_streams подписок, то возвращаем None.
+    """
+    global _reader
+
+    subscription = Subscription(patient_id, series_id, since)
+
+    with _lock:
+        if sum(len(subscriptions) for subscriptions in _subscriptions.values()) >= max_streams:
+            return None
+
+        _subscriptions[subscription.key].add(subscription)
+
+        if _reader is None:
+            _reader = threading.Thread(target=_read_events,
+                                       args=(current_app._get_current_object(), datetime.now() - _TAIL_OVERLAP),
+                                       daemon=True)
+            _reader.start()
+
+    return subscription
+
+
+def _read_events(app: Flask, since: datetime) -> None:
+    """
+    Поток чтения событий. Завершается, когда в процессе не остается подписок
+    """
+    with app.app_context():
+        while True:
+            try:
+                cursor = AnalysisEventCollection.tail_all(since)
+
+                while cursor.alive:
+                    # курсор ждет новых событий на стороне MongoDB, поэтому цикл не опрашивает БД постоянно
+                    for event in cursor:
+                        since = max(since, event["dt"] - _TAIL_OVERLAP)
+                        _dispatch(event)
+
+                    if not _has_subscriptions():
+                        return
+            except PyMongoError:
+                # поток обслуживает всех зрителей процесса, поэтому при сбое MongoDB переоткрываем курсор
+                app.logger.exception("Reading analysis events failed")
+
+            if not _has_subscriptions():
+                return
+
+            time.sleep(_REOPEN_DELAY)
+
+
+def _dispatch(event: Dict[str, Any]) -> None:
+    with _lock:
+        subscriptions = list(_subscriptions.get((event["patient_id"], event["series_id"]), ()))
+
+    for subscription in subscriptions:
+        subscription.queue.put(event)
+
+
+def _has_subscriptions() -> bool:
+    """
+    Проверяем наличие подписок и, если их нет, освобождаем место потока чтения под замком,
+    чтобы новая подписка запустила новый поток
+    """
+    global _reader
+
+    with _lock:
+        if _subscriptions:
+            return True
+
+        _reader = None
+        return False
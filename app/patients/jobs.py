@@ -0,0 +1,277 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import json
+import time
+import click
+import atexit
+import socket
+import signal
+import threading
+import multiprocessing
+
+from datetime import datetime
+from typing import Iterator
+from flask import Flask, current_app
+from flask.cli import with_appcontext
+
+from app.model import *
+from app.patients.utils import analyze, discard_removed_series
+from app.patients.slots import try_acquire_slot
+from app.patients.event_hub import Subscription
+
+__all__ = ["enqueue", "cancel", "start_local_workers", "worker_command", "stream_progress"]
+
+# процессы локального пула, запущенные текущим веб-процессом
+_local_workers = []
+
+
+def enqueue(patient_id: str, series_id: str) -> bool:
+    """
+    Ставим серию в очередь на анализ. Если серия уже в очереди или анализируется, то ничего не делаем.
+    """
+    series_data: SeriesData = PatientCollection.find_one(patient_id, SeriesData)
+    series_data.find_or_404(series_id)
+
+    # серия захватывается одним условным обновлением, поэтому из двух одновременных запросов
+    # задание поставит только тот, чье обновление совпало с документом
+    values = {"job_status": "queued", "queued_dt": datetime.now(), "metrics": {}}
+    reset_fields = tuple(name for name in Series.RESULT_FIELDS if name not in values)
+    if not PatientCollection.reset_series(patient_id, series_id, values, reset_fields):
+        return False
+
+    JobCollection.push(patient_id, series_id)
+    AnalysisEventCollection.push(patient_id, series_id, "job", "queued")
+
+    return True
+
+
+def cancel(patient_id: str, series_id: str) -> bool:
+    """
+    Отменяем анализ серии. Задание из очереди снимается сразу, а выполняющийся анализ воркер прерывает
+    при ближайшем продлении аренды, убивая все процессы FSL этого запуска.
+    """
+    job = JobCollection.request_cancel(patient_id, series_id)
+    if job is None:
+        return False
+
+    if job.state == "cancelled":
+        PatientCollection.update_series(patient_id, series_id, {"job_status": "cancelled", "status": "cancelled",
+                                                                "finished_dt": job.finished_dt})
+        AnalysisEventCollection.push(patient_id, series_id, "job", "cancelled")
+
+    return True
+
+
+def start_local_workers(app: Flask) -> None:
+    """
+    Запускаем пул процессов, которые забирают задания из очереди и проводят анализ.
+    Процессы стартуют через spawn, чтобы не наследовать соединения с MongoDB от веб-процесса.
+    """
+    if _local_workers:
+        return
+
+    _start_workers(app.config["CONFIG_CLASS"], app.config["ANALYSIS_LOCAL_WORKERS"])
+    atexit.register(_stop_local_workers)
+
+
+@click.command("worker")
+@click.option("--processes", "-p", default=1, show_default=True, help="Количество процессов анализа")
+@with_appcontext
+def worker_command(processes: int) -> None:
+    """
+    Запускаем воркер анализа серий. Может работать на отдельном хосте с общей MongoDB.
+    """
+    if processes <= 1:
+        _exit_on_sigterm()
+        _worker_loop()
+        return
+
+    _start_workers(current_app.config["CONFIG_CLASS"], processes)
+
+    try:
+        for process in _local_workers:
+            process.join()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        _stop_local_workers()
+
+
+def _start_workers(config_class: type, count: int) -> None:
+    context = multiprocessing.get_context("spawn")
+
+    for _ in range(count):
+        # не daemon, так как nipype MultiProc сам порождает дочерние процессы
+        process = context.Process(target=_worker_main, args=(config_class, os.getpid()), daemon=False)
+        process.start()
+        _local_workers.append(process)
+
+
+def _stop_local_workers() -> None:
+    for process in _local_workers:
+        if process.is_alive():
+            process.terminate()
+
+    for process in _local_workers:
+        process.join(timeout=5)
+
+    _local_workers.clear()
+
+
+def _worker_main(config_class: type, parent_pid: int) -> None:
+    """
+    Точка входа дочернего процесса пула
+    """
+    from app import create_app
+
+    app = create_app(config_class)
+
+    _exit_on_sigterm()
+
+    with app.app_context():
+        # завершаемся вместе с родительским процессом, даже если он упал без atexit
+        _worker_loop(lambda: os.getppid() == parent_pid)
+
+
+def _exit_on_sigterm() -> None:
+    """
+    По SIGTERM завершаемся через SystemExit, чтобы текущий анализ успел убить свои процессы FSL
+    """
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+
+
+def _worker_loop(is_alive=lambda: True) -> None:
+    worker_id = f"{socket.gethostname()}:{os.getpid()}"
+
+    poll_interval = current_app.config["ANALYSIS_POLL_INTERVAL"]
+    lease_seconds = current_app.config["ANALYSIS_LEASE_SECONDS"]
+    max_attempts = current_app.config["ANALYSIS_MAX_ATTEMPTS"]
+
+    while is_alive():
+        for expired_job in JobCollection.requeue_expired(max_attempts):
+            PatientCollection.update_series(expired_job.patient_id, expired_job.series_id,
+                                            {"job_status": expired_job.state})
+            AnalysisEventCollection.push(expired_job.patient_id, expired_job.series_id, "job", expired_job.state)
+
+        # задание забираем из очереди только со свободным слотом, поэтому лишние задания ждут в очереди
+        # в порядке поступления, а не конкурируют за ядра
+        slot = try_acquire_slot()
+        if slot is None:
+            time.sleep(poll_interval)
+            continue
+
+        try:
+            job = JobCollection.claim(worker_id, lease_seconds)
+            if job is not None:
+                _run_job(job, worker_id)
+        finally:
+            slot.release()
+
+        if job is None:
+            time.sleep(poll_interval)
+
+
+def _run_job(job: AnalysisJob, worker_id: str) -> None:
+    """
+    Выполняем одно задание и записываем его итоговое состояние в задание и в серию.
+    Пока идет анализ, фоновый поток продлевает аренду задания.
+    """
+    queue_wait = (job.started_dt - job.created_dt).total_seconds()
+    PatientCollection.update_series(job.patient_id, job.series_id,
+                                    {"job_status": "running", "started_dt": job.started_dt,
+                                     "metrics.queue": {"wall_time": round(queue_wait, 3)}})
+    AnalysisEventCollection.push(job.patient_id, job.series_id, "job", "running")
+
+    stop_heartbeat, cancel_event = threading.Event(), threading.Event()
+    heartbeat = threading.Thread(target=_heartbeat_loop, args=(job.id, worker_id, stop_heartbeat, cancel_event,
+                                                               current_app.config["ANALYSIS_LEASE_SECONDS"],
+                                                               current_app.config["ANALYSIS_HEARTBEAT_INTERVAL"]),
+                                 daemon=True)
+    heartbeat.start()
+
+    # продление аренды перед записью гарантирует, что до ее истечения задание не заберет другой воркер
+    def holds_lease() -> bool:
+        return JobCollection.heartbeat(job.id, worker_id, current_app.config["ANALYSIS_LEASE_SECONDS"]) is not None
+
+    error = None
+
+    try:
+        status = analyze(job.patient_id, job.series_id, cancel_event, holds_lease)
+        state = {"ok": "done", "cancelled": "cancelled"}.get(status, "failed")
+        if state == "failed":
+            error = status
+    except Exception as e:
+        current_app.logger.exception(f"Analysis job {job.id} failed")
+        state, error = "failed", repr(e)
+    finally:
+        stop_heartbeat.set()
+        heartbeat.join()
+
+    # если аренду забрали, то состояние задания и серии уже принадлежит другому воркеру
+    if JobCollection.finish(job.id, worker_id, state, error):
+        PatientCollection.update_series(job.patient_id, job.series_id,
+                                        {"job_status": state, "finished_dt": datetime.now()})
+        AnalysisEventCollection.push(job.patient_id, job.series_id, "job", state)
+
+    # проверяем после завершения задания: удаление серии позже уже не застанет задание выполняющимся
+    # и само удалит рабочие папки
+    discard_removed_series(job.patient_id, job.series_id)
+
+
+def _heartbeat_loop(job_id: str, worker_id: str, stop: threading.Event, cancel_event: threading.Event,
+                    lease_seconds: int, interval: float) -> None:
+    while not stop.wait(interval):
+        job = JobCollection.heartbeat(job_id, worker_id, lease_seconds)
+
+        # прерываем анализ, если его отменили или аренду забрал другой воркер
+        if job is None or job.cancel_requested:
+            cancel_event.set()
+
+
+def stream_progress(series: Series, subscription: Subscription = None) -> Iterator[str]:
+    """
+    Генератор Server-Sent Events с переходами этапов текущего анализа серии.
+    Сначала отдаются уже произошедшие события анализа, затем новые по мере их появления из подписки.
+    Поток закрывается, когда задание завершилось. Для серии, которая не анализируется, подписка не нужна:
+    отдаем одно сообщение с состоянием задания.
+    """
+    if subscription is None:
+        yield _sse_message({"stage": "job", "status": series.job_status, "elapsed": None})
+        return
+
+    keepalive_interval = current_app.config["ANALYSIS_EVENTS_KEEPALIVE"]
+    deadline = time.monotonic() + current_app.config["ANALYSIS_EVENTS_STREAM_TIMEOUT"]
+    started_dt = series.started_dt
+
+    try:
+        events = subscription.history()
+
+        while time.monotonic() < deadline:
+            if not events:
+                event = subscription.get(keepalive_interval)
+                if event is None:
+                    # комментарий SSE, по которому обнаруживается отключившийся клиент
+                    yield ": keepalive\n\n"
+                    continue
+
+                events = [event]
+
+            for event in events:
+                if event["stage"] == "job" and event["status"] == "running":
+                    started_dt = event["dt"]
+
+                elapsed = (event["dt"] - started_dt).total_seconds() if started_dt is not None else None
+                yield _sse_message({"stage": event["stage"], "status": event["status"], "elapsed": elapsed})
+
+                if event["stage"] == "job" and event["status"] in ("done", "failed", "cancelled"):
+                    return
+
+            events = []
+    finally:
+        subscription.close()
+
+
+def _sse_message(data: dict) -> str:
+    return f"data: {json.dumps(data)}\n\n"
@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+
+import os
+import numpy as np
+
+from typing import Dict, Tuple, List
+
+from app.storage import Storage
+from app.patients.previews import load_canonical
+from app.patients.render import PNG_EXT, volume_window, to_uint8, volume_plane, plane_aspect, blend_labels, resize, \
+    encode_png
+
+__all__ = ["VIEW_NAMES", "render_views", "store_views", "delete_views", "view_key", "view_versions"]
+
+# метки левого и правого гиппокампа в сегментации FSL FIRST (см. FIRST_LABELS) и их цвета на картинках
+_LEFT_HIPP, _RIGHT_HIPP = 17, 53
+_COLORS = {_LEFT_HIPP: (255, 64, 64), _RIGHT_HIPP: (64, 160, 255)}
+
+# вид -> ось объема RAS и метки, через центр которых проходит срез. Сагиттальный срез через центр обоих гиппокампов
+# попал бы на середину мозга, поэтому для каждого гиппокампа он свой
+_VIEWS = {
+    "axial": (2, (_LEFT_HIPP, _RIGHT_HIPP)),
+    "coronal": (1, (_LEFT_HIPP, _RIGHT_HIPP)),
+    "sagittal_left": (0, (_LEFT_HIPP,)),
+    "sagittal_right": (0, (_RIGHT_HIPP,)),
+}
+
+VIEW_NAMES = tuple(_VIEWS)
+
+# папка с картинками видов внутри папки NIFTI серии
+_VIEWS_DIR = "views"
+
+
+def render_views(original_path: str, segmentation_path: str, size: int, clip_percent: float,
+                 alpha: float) -> Dict[str, bytes]:
+    """
+    Рисуем срезы через гиппокампы в трех плоскостях с наложенной сегментацией FIRST.
+    Оба снимка читаются один раз, все виды рисуются из памяти.
+    """
+    values, zooms = load_canonical(original_path)
+    volume = to_uint8(values, *volume_window(values, clip_percent))
+    del values
+
+    labels, _ = load_canonical(segmentation_path)
+    labels = np.rint(labels).astype(np.int16)
+
+    if labels.shape != volume.shape:
+        raise ValueError(f"Segmentation shape {labels.shape} does not match volume shape {volume.shape}")
+
+    images = {}
+    for name, (axis, view_labels) in _VIEWS.items():
+        index = _center(labels, view_labels)[axis]
+        image = blend_labels(volume_plane(volume, axis, index), volume_plane(labels, axis, index), _COLORS, alpha)
+        images[name] = encode_png(resize(image, size, aspect=plane_aspect(zooms, axis)))
+
+    return images
+
+
+def store_views(storage: Storage, nifti_dir: str, images: Dict[str, bytes]) -> None:
+    for name, image in images.items():
+        with storage.open_write(view_key(nifti_dir, name)) as f:
+            f.write(image)
+
+
+def delete_views(storage: Storage, nifti_dir: str) -> None:
+    storage.delete_prefix(os.path.join(nifti_dir, _VIEWS_DIR))
+
+
+def view_key(nifti_dir: str, name: str) -> str:
+    return os.path.join(nifti_dir, _VIEWS_DIR, name + PNG_EXT)
+
+
+def view_versions(storage: Storage, nifti_dir: str) -> List[Tuple[str, str]]:
+    """
+    Имена и версии сохраненных видов серии в порядке VIEW_NAMES
+    """
+    versions = []
+
+    for name in VIEW_NAMES:
+        try:
+            versions.append((name, storage.version(view_key(nifti_dir, name))))
+        except FileNotFoundError:
+            pass
+
+    return versions
+
+
+def _center(labels: np.ndarray, view_labels: Tuple[int, ...]) -> Tuple[int, ...]:
+    """
+    Центр масс вокселей меток. Если FIRST не нашел структуры, берем центр объема
+    """
+    coords = np.nonzero(np.isin(labels, view_labels))
+    if coords[0].size == 0:
+        return tuple(dim // 2 for dim in labels.shape)
+
+    return tuple(int(round(axis_coords.mean())) for axis_coords in coords)
@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+
+import os
+import gzip
+import time
+import hashlib
+import tempfile
+import numpy as np
+import nibabel as nib
+
+from functools import lru_cache
+from typing import Tuple, Dict, Any
+from flask import current_app
+
+from app.storage import get_storage
+from app.patients.render import volume_window, to_uint8, volume_plane, plane_aspect, resize, encode_png
+
+__all__ = ["PLANES", "volume_info", "image_etag", "slice_image", "load_canonical", "windowed_volume"]
+
+# плоскость среза -> ось объема в ориентации RAS, вдоль которой берутся срезы
+PLANES = {"sagittal": 0, "coronal": 1, "axial": 2}
+
+# сколько объемов держать в памяти процесса: пролистывание серии обращается к одному объему много раз подряд
+_VOLUME_CACHE_SIZE = 2
+
+# время последней проверки размера дискового кэша картинок в этом процессе
+_last_evict_time = 0.0
+
+
+def volume_info(nifti_key: str) -> Dict[str, Any]:
+    """
+    Версия и размеры объема по осям RAS. Версия меняется при перезаписи NIFTI (например, при добавлении срезов)
+    и входит в адреса картинок, поэтому браузер может кэшировать их без перепроверки.
+    Если NIFTI нет - FileNotFoundError
+    """
+    version = get_storage().version(nifti_key)
+    return {"version": version, "shape": _canonical_shape(nifti_key, version)}
+
+
+def windowed_volume(nifti_key: str, version: str) -> Tuple[np.ndarray, Tuple[float, ...]]:
+    """
+    8-битный объем в ориентации RAS и размеры вокселя. Объем кэшируется в памяти процесса по версии NIFTI
+    """
+    return _load_volume(nifti_key, version, current_app.config["SERIES_IMG_CLIP_PERCENT"])
+
+
+def image_etag(nifti_key: str, version: str, plane: str, index: int, size: int) -> str:
+    params = (nifti_key, version, plane, index, size, current_app.config["SERIES_IMG_CLIP_PERCENT"])
+    return hashlib.sha1(repr(params).encode()).hexdigest()
+
+
+def slice_image(nifti_key: str, version: str, plane: str, index: int, size: int) -> bytes:
+    """
+    PNG среза index в плоскости plane размером size по большей стороне. Готовые картинки берутся
+    из дискового кэша, вытеснение из которого идет по давности последнего обращения.
+    Если срез вне объема - IndexError
+    """
+    cache_path = _cache_path(image_etag(nifti_key, version, plane, index, size))
+
+    try:
+        with open(cache_path, "rb") as f:
+            image = f.read()
+        # время изменения файла служит временем последнего обращения
+        os.utime(cache_path)
+        return image
+    except FileNotFoundError:
+        pass
+
+    volume, zooms = windowed_volume(nifti_key, version)
+    image = encode_png(_plane_image(volume, zooms, plane, index, size))
+
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(cache_path), prefix=".tmp_")
+    with os.fdopen(fd, "wb") as f:
+        f.write(image)
+    os.replace(tmp_path, cache_path)
+
+    _evict_if_needed()
+
+    return image
+
+
+def load_canonical(path: str) -> Tuple[np.ndarray, Tuple[float, ...]]:
+    """
+    Данные NIFTI в ориентации RAS (для 4D - первый том) и размеры вокселя по осям
+    """
+    nifti = nib.as_closest_canonical(nib.load(path))
+    values = np.asanyarray(nifti.dataobj)
+
+    if values.ndim > 3:
+        values = values.reshape(values.shape[:3] + (-1,))[..., 0]
+
+    return values, tuple(float(zoom) for zoom in nifti.header.get_zooms()[:3])
+
+
+@lru_cache(maxsize=256)
+def _canonical_shape(nifti_key: str, version: str) -> Tuple[int, int, int]:
+    """
+    Размеры объема после приведения к ориентации RAS, как у load_canonical. Читаем только заголовок NIFTI,
+    а перестановку осей берем из его аффинной матрицы, поэтому сам объем не загружается
+    """
+    with get_storage().open_read(nifti_key) as f:
+        stream = gzip.GzipFile(fileobj=f) if nifti_key.endswith(".gz") else f
+        header = nib.Nifti1Header.from_fileobj(stream)
+
+    shape = header.get_data_shape()[:3]
+    ornt = nib.io_orientation(header.get_best_affine())
+
+    canonical_shape = [0, 0, 0]
+    for axis, (new_axis, _) in enumerate(ornt):
+        canonical_shape[int(new_axis)] = int(shape[axis])
+
+    return tuple(canonical_shape)
+
+
+@lru_cache(maxsize=_VOLUME_CACHE_SIZE)
+def _load_volume(nifti_key: str, version: str, clip_percent: float) -> Tuple[np.ndarray, Tuple[float, ...]]:
+    """
+    Загружаем объем один раз на версию NIFTI, приводим к ориентации RAS и сразу переводим в 8 бит,
+    чтобы в памяти держать по байту на воксель. version входит в ключ кэша, но внутри не используется
+    """
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = get_storage().local_copy(nifti_key, os.path.join(tmp_dir, os.path.basename(nifti_key)))
+        values, zooms = load_canonical(path)
+
+    return to_uint8(values, *volume_window(values, clip_percent)), zooms
+
+
+def _plane_image(volume: np.ndarray, zooms: Tuple[float, ...], plane: str, index: int, size: int) -> np.ndarray:
+    axis = PLANES[plane]
+    return resize(volume_plane(volume, axis, index), size, aspect=plane_aspect(zooms, axis))
+
+
+def _cache_path(etag: str) -> str:
+    return os.path.join(current_app.config["PREVIEW_CACHE_FOLDER"], etag[:2], etag + ".png")
+
+
+def _evict_if_needed() -> None:
+    """
+    Удаляем давно не запрошенные картинки, если кэш больше PREVIEW_CACHE_MAX_SIZE. Обход папки кэша дорогой,
+    поэтому процесс делает его не чаще раза в PREVIEW_CACHE_EVICT_INTERVAL секунд
+    """
+    global _last_evict_time
+
+    now = time.time()
+    if now - _last_evict_time < current_app.config["PREVIEW_CACHE_EVICT_INTERVAL"]:
+        return
+    _last_evict_time = now
+
+    entries = []
+    for dir_entry in os.scandir(current_app.config["PREVIEW_CACHE_FOLDER"]):
+        if not dir_entry.is_dir():
+            continue
+        for file_entry in os.scandir(dir_entry.path):
+            # картинку мог успеть удалить другой процесс
+            try:
+                stat = file_entry.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, file_entry.path))
+
+    total_size = sum(size for _, size, _ in entries)
+    max_size = current_app.config["PREVIEW_CACHE_MAX_SIZE"]
+
+    for _, size, path in sorted(entries):
+        if total_size <= max_size:
+            break
+
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total_size -= size
@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+
+import numpy as np
+import nibabel as nib
+
+from typing import Dict, Any, Tuple
+from flask import current_app
+
+__all__ = ["check_volume"]
+
+
+def check_volume(nifti_path: str) -> Tuple[Dict[str, Any], str]:
+    """
+    Быстрая проверка снимка перед анализом: размерность, размер вокселя, поле обзора, диапазон интенсивностей и
+    оценка SNR. Возвращаем метрики и текст ошибки, если снимок заведомо не пройдет BET + FIRST (иначе None).
+    """
+    image = nib.load(nifti_path)
+
+    shape = image.shape
+    voxel_size = np.asarray(image.header.get_zooms()[:3], dtype=np.float64)
+
+    metrics = {"shape": [int(dim) for dim in shape], "voxel_size": [round(float(size), 3) for size in voxel_size]}
+
+    # 4D снимок с одним объемом допустим, с несколькими - нет
+    if len(shape) < 3 or (len(shape) > 3 and int(np.prod(shape[3:])) > 1):
+        return metrics, "Снимок должен быть трехмерным"
+
+    data = np.asanyarray(image.dataobj).reshape(shape[:3]).astype(np.float32, copy=False)
+
+    fov = np.asarray(shape[:3]) * voxel_size
+    low, high = np.percentile(data, [1, 99])
+    snr = _estimate_snr(data, high)
+
+    metrics.update({
+        "fov_mm": [round(float(size), 1) for size in fov],
+        "intensity_min": float(data.min()),
+        "intensity_max": float(data.max()),
+        "intensity_p1": float(low),
+        "intensity_p99": float(high),
+        "snr": round(snr, 2) if np.isfinite(snr) else None,
+    })
+
+    config = current_app.config
+
+    if min(shape[:3]) < config["QC_MIN_DIM"]:
+        return metrics, f"Снимок содержит слишком мало срезов по одной из осей (меньше {config['QC_MIN_DIM']})"
+
+    if voxel_size.max() > config["QC_MAX_VOXEL_SIZE_MM"]:
+        return metrics, f"Размер вокселя больше {config['QC_MAX_VOXEL_SIZE_MM']} мм"
+
+    if fov.min() < config["QC_MIN_FOV_MM"]:
+        return metrics, f"Поле обзора меньше {config['QC_MIN_FOV_MM']} мм, снимок обрезан"
+
+    if high <= low:
+        return metrics, "Снимок не содержит изображения: интенсивности почти постоянны"
+
+    if snr < config["QC_MIN_SNR"]:
+        return metrics, f"Слишком низкое отношение сигнал/шум ({round(snr, 2)})"
+
+    return metrics, None
+
+
+def _estimate_snr(data: np.ndarray, high: float) -> float:
+    """
+    SNR как отношение средней интенсивности ткани к стандартному отклонению фона.
+    Фон - воксели ниже 5% от 99-го перцентиля, ткань - воксели выше среднего по снимку.
+    """
+    background = data[data < 0.05 * high]
+    foreground = data[data > data.mean()]
+
+    if foreground.size == 0:
+        return 0.0
+
+    noise = background.std() if background.size else 0.0
+    if noise == 0:
+        # фон, обнуленный при конвертации, не дает оценить шум - считаем снимок качественным
+        return float("inf")
+
+    return float(foreground.mean() / noise)
@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+
+import zlib
+import struct
+import numpy as np
+
+from typing import Sequence, Tuple, Dict
+
+__all__ = ["PNG_EXT", "volume_window", "to_uint8", "volume_plane", "plane_aspect", "blend_labels", "resize",
+           "encode_png"]
+
+PNG_EXT = ".png"
+
+_PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+_PNG_COMPRESS_LEVEL = 6
+
+# цветовые типы PNG: оттенки серого и RGB
+_PNG_GRAY, _PNG_RGB = 0, 2
+
+
+def volume_window(values: np.ndarray, clip_percent: float) -> Tuple[float, float]:
+    """
+    Границы окна по перцентилям значений. Для больших объемов перцентили считаем по прореженной выборке.
+    """
+    sample = values.ravel()
+    if sample.size > 1 << 20:
+        sample = sample[::sample.size >> 20]
+
+    low, high = np.percentile(sample, [clip_percent, 100 - clip_percent])
+    return float(low), float(high)
+
+
+def to_uint8(values: np.ndarray, low: float, high: float) -> np.ndarray:
+    """
+    Линейно отображаем значения из [low, high] в [0, 255], значения за границами обрезаем
+    """
+    if high <= low:
+        high = low + 1
+
+    scaled = (values.astype(np.float32) - low) * (255 / (high - low))
+    return np.clip(scaled, 0, 255, out=scaled).astype(np.uint8)
+
+
+def volume_plane(volume: np.ndarray, axis: int, index: int) -> np.ndarray:
+    """
+    Срез объема в ориентации RAS вдоль оси axis, повернутый так, чтобы сверху были передние (аксиальный срез)
+    или верхние отделы. Если срез вне объема - IndexError
+    """
+    if not 0 <= index < volume.shape[axis]:
+        raise IndexError(f"Slice {index} is out of range for axis {axis}")
+
+    # из оставшихся осей первая идет по столбцам картинки, вторая - по строкам снизу вверх
+    return np.rot90(np.take(volume, index, axis=axis))
+
+
+def plane_aspect(zooms: Sequence[float], axis: int) -> float:
+    """
+    Отношение высоты пикселя к ширине для среза из volume_plane
+    """
+    col_axis, row_axis = [i for i in range(3) if i != axis]
+    return zooms[row_axis] / zooms[col_axis]
+
+
+def blend_labels(image: np.ndarray, labels: np.ndarray, colors: Dict[int, Tuple[int, int, int]],
+                 alpha: float) -> np.ndarray:
+    """
+    Накладываем на 8-битный срез полупрозрачную цветную маску меток. Метки, которых нет в colors, не рисуются
+    """
+    rgb = np.repeat(image[..., None], 3, axis=2).astype(np.float32)
+
+    for label, color in colors.items():
+        mask = labels == label
+        rgb[mask] = (1 - alpha) * rgb[mask] + alpha * np.asarray(color, dtype=np.float32)
+
+    return rgb.astype(np.uint8)
+
+
+def resize(image: np.ndarray, size: int, aspect: float = 1.0) -> np.ndarray:
+    """
+    Масштабируем изображение так, чтобы большая сторона стала равна size, сохраняя пропорции.
+    aspect - отношение высоты пикселя к его ширине (для срезов объема с неизотропными вокселями).
+    При уменьшении сначала усредняем блоки пикселей (иначе мелкие детали дают рябь), затем добираем
+    точный размер выбором ближайших пикселей.
+    """
+    height, width = image.shape[:2]
+    longest = max(height * aspect, width)
+    out_height = max(1, int(round(height * aspect * size / longest)))
+    out_width = max(1, int(round(width * size / longest)))
+
+    row_factor, col_factor = max(1, height // out_height), max(1, width // out_width)
+    if row_factor > 1 or col_factor > 1:
+        height, width = height // row_factor, width // col_factor
+        blocks = image[:height * row_factor, :width * col_factor].reshape(height, row_factor, width, col_factor,
+                                                                            *image.shape[2:])
+        image = blocks.mean(axis=(1, 3)).astype(np.uint8)
+
+    if (out_height, out_width) == (height, width):
+        return image
+
+    rows = (np.arange(out_height) * height // out_height).astype(np.intp)
+    cols = (np.arange(out_width) * width // out_width).astype(np.intp)
+    return image[rows[:, None], cols]
+
+
+def encode_png(image: np.ndarray) -> bytes:
+    """
+    Кодируем 8-битное изображение (оттенки серого H x W или RGB H x W x 3) в PNG.
+    Строки фильтруем фильтром Sub (разность с соседним слева пикселем): на снимках соседние пиксели близки,
+    поэтому после фильтра данные сжимаются заметно лучше.
+    """
+    image = np.ascontiguousarray(image, dtype=np.uint8)
+    height, width = image.shape[:2]
+    color_type, channels = (_PNG_RGB, 3) if image.ndim == 3 else (_PNG_GRAY, 1)
+
+    raw = image.reshape(height, width * channels)
+    filtered = np.empty((height, width * channels + 1), dtype=np.uint8)
+    filtered[:, 0] = 1
+    filtered[:, 1:channels + 1] = raw[:, :channels]
+    np.subtract(raw[:, channels:], raw[:, :-channels], out=filtered[:, channels + 1:])
+
+    header = struct.pack(">IIBBBBB", width, height, 8, color_type, 0, 0, 0)
+    return b"".join([
+        _PNG_SIGNATURE,
+        _png_chunk(b"IHDR", header),
+        _png_chunk(b"IDAT", zlib.compress(filtered.tobytes(), _PNG_COMPRESS_LEVEL)),
+        _png_chunk(b"IEND", b""),
+    ])
+
+
+def _png_chunk(chunk_type: bytes, data: bytes) -> bytes:
+    return struct.pack(">I", len(data)) + chunk_type + data + struct.pack(">I", zlib.crc32(chunk_type + data))
@@ -1,17 +1,27 @@
 # -*- coding: utf-8 -*-
 
-from flask_login import login_required
-from typing import Union
+import os
+
+from flask_login import login_required, current_user
+from typing import Union, Tuple
 from werkzeug.wrappers.response import Response
-from flask import request, flash, Markup, redirect, url_for, render_template, send_file
+from flask import request, flash, Markup, redirect, url_for, render_template, send_file, jsonify, current_app, \
+    stream_with_context, abort
 from datetime import datetime
 from io import BytesIO
 
 from app.patients import bp
 from app.utils import user_required
 from app.model import *
+from app.storage import get_storage
+from app.patients.previews import PLANES, volume_info, image_etag, slice_image
+from app.patients.overlay import VIEW_NAMES, view_key, view_versions
+from app.patients.sprites import sprite_manifest, sprite_image, sprite_etag
+from app.patients.volume_stream import volume_header, level_path
 from app.patients.forms import *
 from app.patients.utils import *
+from app.patients.jobs import enqueue, cancel, stream_progress
+from app.patients import uploads, event_hub
 
 BASE_URL = "/patients"
 
@@ -114,13 +124,240 @@ def upload_series(patient_id: str) -> Response:
     return redirect(url_for("patients.route_page", patient_id=patient_id))
 
 
+@bp.route(f"{BASE_URL}/upload_series_archive/<patient_id>", methods=["POST"])
+@login_required
+@user_required
+def upload_series_archive(patient_id: str) -> Response:
+    # архив приходит телом запроса, а не формой, поэтому разбор срезов начинается до конца загрузки.
+    # Клиент отправляет запрос через fetch, поэтому вместо редиректа возвращаем адрес страницы
+    split_on_series(patient_id, save_archive_from_client(patient_id))
+    return jsonify(redirect=url_for("patients.route_page", patient_id=patient_id))
+
+
+@bp.route(f"{BASE_URL}/uploads/<patient_id>", methods=["POST"])
+@login_required
+@user_required
+def create_upload(patient_id: str) -> Tuple[Response, int]:
+    PatientCollection.find_one(patient_id, SeriesData)
+
+    try:
+        files = (request.get_json(silent=True) or {}).get("files")
+        session = uploads.create_session(patient_id, current_user.id, files)
+    except ValueError as e:
+        return jsonify(error=str(e)), 400
+
+    return jsonify(uploads.session_status(session)), 201
+
+
+@bp.route(f"{BASE_URL}/uploads/<patient_id>/<upload_id>")
+@login_required
+@user_required
+def upload_status(patient_id: str, upload_id: str) -> Response:
+    session = UploadSessionCollection.find_one_or_404(upload_id, patient_id, current_user.id)
+    return jsonify(uploads.session_status(session))
+
+
+@bp.route(f"{BASE_URL}/uploads/<patient_id>/<upload_id>/<int:file_index>/<int:chunk_num>", methods=["PUT"])
+@login_required
+@user_required
+def upload_chunk(patient_id: str, upload_id: str, file_index: int, chunk_num: int) -> Tuple[Response, int]:
+    session = UploadSessionCollection.find_one_or_404(upload_id, patient_id, current_user.id)
+
+    # кусок читаем в память целиком, поэтому не принимаем тело больше размера куска
+    if request.content_length is None or request.content_length > session.chunk_size:
+        abort(413)
+
+    try:
+        uploads.save_chunk(session, file_index, chunk_num, request.get_data(cache=False),
+                           request.headers.get("X-Chunk-Sha256"))
+    except ValueError as e:
+        return jsonify(error=str(e)), 400
+
+    return jsonify(file_index=file_index, chunk_num=chunk_num), 200
+
+
+@bp.route(f"{BASE_URL}/uploads/<patient_id>/<upload_id>/finalize", methods=["POST"])
+@login_required
+@user_required
+def finalize_upload(patient_id: str, upload_id: str) -> Tuple[Response, int]:
+    session = UploadSessionCollection.find_one_or_404(upload_id, patient_id, current_user.id)
+
+    try:
+        paths = uploads.finish_session(session)
+    except ValueError as e:
+        return jsonify(dict(uploads.session_status(session), error=str(e))), 409
+
+    if paths is None:
+        return jsonify(error="Загрузка уже завершается"), 409
+
+    try:
+        names = [file["name"] for file in session.files]
+        split_on_series(patient_id, save_uploaded_files(patient_id, list(zip(paths, names))))
+    except BaseException:
+        # файлы сессии не тронуты, поэтому клиент может повторить завершение
+        uploads.reopen_session(session)
+        raise
+
+    uploads.close_session(session)
+
+    return jsonify(redirect=url_for("patients.route_page", patient_id=patient_id)), 200
+
+
 @bp.route(f"{BASE_URL}/series_page/<patient_id>/<series_id>")
 @login_required
 @user_required
 def route_series_page(patient_id: str, series_id: str) -> str:
     series_data: SeriesData = PatientCollection.find_one(patient_id, SeriesData)
     series = series_data.find_or_404(series_id)
-    return render_template("patients/series.html", series=series, title="Серия", patient_id=patient_id)
+
+    # размеры объема нужны просмотрщику срезов. Если NIFTI нет, срезы не показываем
+    try:
+        preview = volume_info(_nifti_key(series))
+    except FileNotFoundError:
+        preview = None
+
+    # виды с наложенной сегментацией рисуются сразу после анализа
+    views = view_versions(get_storage(), series.nifti_dir) if series.status == "ok" else []
+
+    return render_template("patients/series.html", series=series, title="Серия", patient_id=patient_id,
+                           preview=preview, planes=PLANES, views=views)
+
+
+@bp.route(f"{BASE_URL}/series_slice/<patient_id>/<series_id>/<plane>/<int:index>")
+@login_required
+@user_required
+def series_slice(patient_id: str, series_id: str, plane: str, index: int) -> Response:
+    series_data: SeriesData = PatientCollection.find_one(patient_id, SeriesData)
+    series = series_data.find_or_404(series_id)
+
+    if plane not in PLANES:
+        abort(404)
+
+    size = request.args.get("size", current_app.config["SERIES_IMG_SIZE"], type=int)
+    size = min(max(size, 16), current_app.config["PREVIEW_MAX_SIZE"])
+
+    nifti_key = _nifti_key(series)
+    try:
+        version = get_storage().version(nifti_key)
+    except FileNotFoundError:
+        abort(404)
+
+    etag = image_etag(nifti_key, version, plane, index, size)
+
+    # картинка у браузера актуальна - не рисуем и не читаем ее из кэша
+    if etag in request.if_none_match:
+        response = current_app.response_class(status=304)
+    else:
+        try:
+            image = slice_image(nifti_key, version, plane, index, size)
+        except IndexError:
+            abort(404)
+        response = current_app.response_class(image, mimetype="image/png")
+
+    _set_cache_headers(response, etag, request.args.get("v") == version)
+    return response
+
+
+@bp.route(f"{BASE_URL}/series_sprite/<patient_id>/<series_id>/<plane>")
+@login_required
+@user_required
+def series_sprite(patient_id: str, series_id: str, plane: str) -> Response:
+    return _sprite_response(patient_id, series_id, plane, manifest=False)
+
+
+@bp.route(f"{BASE_URL}/series_sprite_manifest/<patient_id>/<series_id>/<plane>")
+@login_required
+@user_required
+def series_sprite_manifest(patient_id: str, series_id: str, plane: str) -> Response:
+    return _sprite_response(patient_id, series_id, plane, manifest=True)
+
+
+@bp.route(f"{BASE_URL}/series_volume/<patient_id>/<series_id>")
+@login_required
+@user_required
+def series_volume(patient_id: str, series_id: str) -> Response:
+    # описание объема для просмотрщика в браузере: тип данных, порядок осей, аффинная матрица и адреса уровней пирамиды
+    series_data: SeriesData = PatientCollection.find_one(patient_id, SeriesData)
+    series = series_data.find_or_404(series_id)
+
+    nifti_key = _nifti_key(series)
+    try:
+        version = get_storage().version(nifti_key)
+    except FileNotFoundError:
+        abort(404)
+
+    try:
+        header = volume_header(nifti_key, version)
+    except FileNotFoundError:
+        abort(404)
+
+    for level in header["levels"]:
+        level["url"] = url_for("patients.series_volume_level", patient_id=patient_id, series_id=series_id,
+                               level=level["level"], v=version)
+
+    response = jsonify(dict(header, version=version))
+    _set_cache_headers(response, version, request.args.get("v") == version)
+    return response
+
+
+@bp.route(f"{BASE_URL}/series_volume/<patient_id>/<series_id>/<int:level>")
+@login_required
+@user_required
+def series_volume_level(patient_id: str, series_id: str, level: int) -> Response:
+    series_data: SeriesData = PatientCollection.find_one(patient_id, SeriesData)
+    series = series_data.find_or_404(series_id)
+
+    nifti_key = _nifti_key(series)
+    try:
+        version = get_storage().version(nifti_key)
+    except FileNotFoundError:
+        abort(404)
+
+    etag = f"{version}-{level}"
+
+    if etag in request.if_none_match:
+        response = current_app.response_class(status=304)
+    else:
+        # файл отдается с диска без распаковки. Range запросы разбирает send_file, поэтому браузер может забирать
+        # отдельные аксиальные срезы по смещениям из описания объема. Открытый файл переживет вытеснение копии,
+        # но до открытия ее может удалить параллельный запрос
+        try:
+            path = level_path(nifti_key, version, level)
+            response = send_file(os.path.abspath(path), mimetype="application/octet-stream", add_etags=False,
+                                 conditional=True)
+        except (IndexError, FileNotFoundError):
+            abort(404)
+
+    _set_cache_headers(response, etag, request.args.get("v") == version)
+    return response
+
+
+@bp.route(f"{BASE_URL}/series_view/<patient_id>/<series_id>/<name>")
+@login_required
+@user_required
+def series_view(patient_id: str, series_id: str, name: str) -> Response:
+    series_data: SeriesData = PatientCollection.find_one(patient_id, SeriesData)
+    series = series_data.find_or_404(series_id)
+
+    if name not in VIEW_NAMES:
+        abort(404)
+
+    storage = get_storage()
+    key = view_key(series.nifti_dir, name)
+    try:
+        version = storage.version(key)
+    except FileNotFoundError:
+        abort(404)
+
+    # картинка вида неизменна, пока не перезаписана, поэтому ее версия и есть ETag
+    if version in request.if_none_match:
+        response = current_app.response_class(status=304)
+    else:
+        with storage.open_read(key) as f:
+            response = current_app.response_class(f.read(), mimetype="image/png")
+
+    _set_cache_headers(response, version, request.args.get("v") == version)
+    return response
 
 
 @bp.route(f"{BASE_URL}/delete_series/<patient_id>/<series_id>")
@@ -135,10 +372,57 @@ def delete_series(patient_id: str, series_id: str) -> Response:
 @login_required
 @user_required
 def analyze_series(patient_id: str, series_id: str) -> Response:
-    analyze(patient_id, series_id)
+    if enqueue(patient_id, series_id):
+        flash(Markup("Серия поставлена в очередь на анализ"))
+    else:
+        flash(Markup("Серия уже находится в очереди на анализ"))
+    return redirect(url_for("patients.route_series_page", patient_id=patient_id, series_id=series_id))
+
+
+@bp.route(f"{BASE_URL}/cancel_analysis/<patient_id>/<series_id>")
+@login_required
+@user_required
+def cancel_analysis(patient_id: str, series_id: str) -> Response:
+    if cancel(patient_id, series_id):
+        flash(Markup("Анализ серии отменяется"))
+    else:
+        flash(Markup("Серия не анализируется"))
     return redirect(url_for("patients.route_series_page", patient_id=patient_id, series_id=series_id))
 
 
+@bp.route(f"{BASE_URL}/analysis_progress/<patient_id>/<series_id>")
+@login_required
+@user_required
+def analysis_progress(patient_id: str, series_id: str) -> Response:
+    series_data: SeriesData = PatientCollection.find_one(patient_id, SeriesData)
+    series = series_data.find_or_404(series_id)
+
+    # поток событий занимает поток gunicorn на все время анализа, поэтому их число в процессе ограничено.
+    # Ответ 204 останавливает переподключения EventSource, страница узнает итог анализа при перезагрузке
+    subscription = None
+    if series.in_progress:
+        subscription = event_hub.subscribe(patient_id, series_id, series.queued_dt,
+                                           current_app.config["ANALYSIS_EVENTS_MAX_STREAMS"])
+        if subscription is None:
+            return Response(status=204)
+
+    response = Response(stream_with_context(stream_progress(series, subscription)), mimetype="text/event-stream",
+                        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+    # при отключении клиента генератор может так и не начаться, поэтому подписку закрываем и здесь
+    if subscription is not None:
+        response.call_on_close(subscription.close)
+
+    return response
+
+
+@bp.route(f"{BASE_URL}/analysis_metrics")
+@login_required
+@user_required
+def analysis_metrics() -> Response:
+    return jsonify(stages=PatientCollection.aggregate_series_metrics())
+
+
 @bp.route(f"{BASE_URL}/get_report/<patient_id>")
 @login_required
 @user_required
@@ -155,3 +439,51 @@ def get_report(patient_id: str) -> Union[Response]:
     document.save(f)
     f.seek(0)
     return send_file(f, as_attachment=True, attachment_filename='report.docx')
+
+
+def _nifti_key(series: Series) -> str:
+    return os.path.join(series.nifti_dir, "original" + current_app.config["NIFTI_EXT"])
+
+
+def _sprite_response(patient_id: str, series_id: str, plane: str, manifest: bool) -> Response:
+    """
+    Спрайт миниатюр срезов плоскости или его оглавление. Оба зависят только от версии NIFTI
+    """
+    series_data: SeriesData = PatientCollection.find_one(patient_id, SeriesData)
+    series = series_data.find_or_404(series_id)
+
+    if plane not in PLANES:
+        abort(404)
+
+    nifti_key = _nifti_key(series)
+    try:
+        version = get_storage().version(nifti_key)
+    except FileNotFoundError:
+        abort(404)
+
+    etag = sprite_etag(version, plane) + ("-manifest" if manifest else "")
+
+    if etag in request.if_none_match:
+        response = current_app.response_class(status=304)
+    elif manifest:
+        response = jsonify(sprite_manifest(nifti_key, version, plane))
+    else:
+        response = current_app.response_class(sprite_image(nifti_key, version, plane), mimetype="image/png")
+
+    _set_cache_headers(response, etag, request.args.get("v") == version)
+    return response
+
+
+def _set_cache_headers(response: Response, etag: str, versioned: bool) -> None:
+    """
+    Картинки зависят только от версии артефакта. Если версия есть в адресе, браузер может не перепроверять картинку
+    до истечения PREVIEW_MAX_AGE, иначе перепроверяет ее по ETag при каждом показе.
+    Данные пациентов не должны оседать в общих прокси, поэтому кэширование только private
+    """
+    response.set_etag(etag)
+    response.cache_control.private = True
+
+    if versioned:
+        response.cache_control.max_age = current_app.config["PREVIEW_MAX_AGE"]
+    else:
+        response.cache_control.no_cache = True
@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+
+import os
+import io
+import json
+import zlib
+import struct
+import tarfile
+import tempfile
+import click
+
+from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Tuple, Iterator, Callable, Iterable, BinaryIO
+from flask import current_app
+from flask.cli import with_appcontext
+
+from app.model import *
+from app.storage import Storage, get_storage
+
+__all__ = ["ARCHIVE_EXT", "SeriesArchive", "write_archive", "extract_series", "migrate_archives_command"]
+
+# формат архива серии: заголовок, затем сжатые zlib по отдельности срезы, затем сжатое оглавление (JSON со смещениями
+# срезов) и футер фиксированной длины со смещением и размером оглавления. Чтобы прочитать один срез, достаточно
+# прочитать футер, оглавление и сам срез, не распаковывая остальные
+ARCHIVE_EXT = ".dcmz"
+
+_HEADER = b"BMSA0001"
+_FOOTER = struct.Struct("<QQ8s")
+_FOOTER_MAGIC = b"BMSAIDX1"
+
+_COMPRESS_LEVEL = 6
+
+# срез в архиве: смещение и размер сжатых данных, исходный размер и CRC32 исходных данных
+_Member = namedtuple("_Member", ["offset", "compressed_size", "size", "crc32"])
+
+
+class SeriesArchive:
+    """
+    Архив серии с произвольным доступом к срезам. Читается из любого потока с поддержкой seek
+    (файл на диске, файл GridFS)
+    """
+
+    def __init__(self, fileobj: BinaryIO, name: str = "") -> None:
+        self.name = name
+        self._file = fileobj
+
+        self._file.seek(-_FOOTER.size, os.SEEK_END)
+        index_offset, index_size, magic = _FOOTER.unpack(self._file.read(_FOOTER.size))
+        if magic != _FOOTER_MAGIC:
+            raise ValueError(f"{name} is not a series archive")
+
+        self._file.seek(index_offset)
+        entries = json.loads(zlib.decompress(self._file.read(index_size)).decode())
+
+        self._members = {member_name: _Member(*values) for member_name, *values in entries}
+
+    def __enter__(self) -> "SeriesArchive":
+        return self
+
+    def __exit__(self, *_) -> None:
+        self.close()
+
+    def close(self) -> None:
+        self._file.close()
+
+    def names(self) -> List[str]:
+        return list(self._members)
+
+    def read(self, name: str) -> bytes:
+        member = self._members[name]
+
+        self._file.seek(member.offset)
+        data = zlib.decompress(self._file.read(member.compressed_size))
+
+        if len(data) != member.size or zlib.crc32(data) != member.crc32:
+            raise ValueError(f"Member {name} of {self.name} is corrupted")
+
+        return data
+
+    def open(self, name: str) -> io.BytesIO:
+        return io.BytesIO(self.read(name))
+
+    def extract_all(self, out_dir: str) -> None:
+        os.makedirs(out_dir, exist_ok=True)
+
+        for name in self._members:
+            with open(os.path.join(out_dir, name), "wb") as f:
+                f.write(self.read(name))
+
+
+def write_archive(src_dir: str, out: BinaryIO, threads: int = 1) -> None:
+    """
+    Упаковываем файлы папки в архив серии, записывая его в поток out. Срезы сжимаются в пуле потоков
+    (zlib отпускает GIL), а пишутся по порядку. Одновременно в памяти держим не больше 2 * threads сжатых срезов.
+    """
+    names = sorted(os.listdir(src_dir))
+    entries = []
+
+    # смещения считаем сами: поток записи GridFS не умеет tell
+    offset = len(_HEADER)
+    out.write(_HEADER)
+
+    with ThreadPoolExecutor(max_workers=max(1, threads)) as executor:
+        paths = (os.path.join(src_dir, name) for name in names)
+        for name, (data, size, crc32) in zip(names, _bounded_map(executor, _compress_file, paths, 2 * threads)):
+            entries.append([name, offset, len(data), size, crc32])
+            out.write(data)
+            offset += len(data)
+
+    index = zlib.compress(json.dumps(entries).encode())
+    out.write(index)
+    out.write(_FOOTER.pack(offset, len(index), _FOOTER_MAGIC))
+
+
+def extract_series(storage: Storage, archive_key: str, series_dir: str) -> None:
+    """
+    Распаковываем архив серии из хранилища в папку series_dir. Поддерживаются и старые архивы .tgz
+    """
+    with storage.open_read(archive_key) as f:
+        if archive_key.endswith(ARCHIVE_EXT):
+            SeriesArchive(f, archive_key).extract_all(series_dir)
+            return
+
+        # .tgz содержит папку с именем серии
+        with tarfile.open(fileobj=f, mode="r:gz") as _tar:
+            _tar.extractall(os.path.dirname(series_dir))
+
+
+def _compress_file(path: str) -> Tuple[bytes, int, int]:
+    with open(path, "rb") as f:
+        data = f.read()
+
+    return zlib.compress(data, _COMPRESS_LEVEL), len(data), zlib.crc32(data)
+
+
+def _bounded_map(executor: ThreadPoolExecutor, fn: Callable, items: Iterable, window: int) -> Iterator:
+    """
+    Аналог executor.map, который не отправляет в пул все задания сразу, а держит не больше window заданий
+    """
+    futures = deque()
+
+    for item in items:
+        futures.append(executor.submit(fn, item))
+        if len(futures) >= window:
+            yield futures.popleft().result()
+
+    while futures:
+        yield futures.popleft().result()
+
+
+@click.command("migrate-archives")
+@with_appcontext
+def migrate_archives_command() -> None:
+    """
+    Переупаковываем архивы серий .tgz в индексированный формат
+    """
+    threads = current_app.config["ARCHIVE_THREADS"]
+    storage = get_storage()
+
+    for series_data in PatientCollection.find_all(SeriesData):
+        patient_id = str(series_data.id)
+
+        for series in series_data.find_all():
+            if series.dicom_path.endswith(ARCHIVE_EXT):
+                continue
+
+            series_name = os.path.basename(series.dicom_path)[:-len(".tgz")]
+            archive_key = f"{os.path.dirname(series.dicom_path)}/{series_name}{ARCHIVE_EXT}"
+
+            with tempfile.TemporaryDirectory() as tmp_dir:
+                series_dir = os.path.join(tmp_dir, series_name)
+                extract_series(storage, series.dicom_path, series_dir)
+
+                with storage.open_write(archive_key) as out:
+                    write_archive(series_dir, out, threads)
+
+            if PatientCollection.update_series(patient_id, series.id, {"dicom_path": archive_key}):
+                storage.delete(series.dicom_path)
+                click.echo(f"{series.dicom_path} -> {archive_key}")
+            else:
+                # серию удалили, пока мы ее переупаковывали
+                storage.delete(archive_key)
@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import hashlib
+import pydicom
+import numpy as np
+
+from pydicom.dataset import FileDataset
+
+__all__ = ["ParsedSlice"]
+
+_CHUNK_SIZE = 1024 * 1024
+
+
+class ParsedSlice:
+    """
+    Срез DICOM, заголовок которого читается с диска один раз за загрузку. Пиксели (самая тяжелая часть файла)
+    не читаются при разборе заголовка и загружаются лениво, только если к ним обратились.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.header: FileDataset = pydicom.dcmread(path, stop_before_pixels=True)
+        self._pixel_array = None
+        self._content_hash = None
+
+    @property
+    def name(self) -> str:
+        return os.path.basename(self.path)
+
+    @property
+    def sop_uid(self) -> str:
+        return str(self.header.SOPInstanceUID)
+
+    @property
+    def content_hash(self) -> str:
+        """
+        SHA-256 содержимого файла. Считается один раз, обычно в процессе пула, разбирающем заголовок
+        """
+        if self._content_hash is None:
+            sha = hashlib.sha256()
+            with open(self.path, "rb") as f:
+                for chunk in iter(lambda: f.read(_CHUNK_SIZE), b""):
+                    sha.update(chunk)
+            self._content_hash = sha.hexdigest()
+        return self._content_hash
+
+    @property
+    def pixel_array(self) -> np.ndarray:
+        if self._pixel_array is None:
+            self._pixel_array = pydicom.dcmread(self.path).pixel_array
+        return self._pixel_array
+
+    def release_pixels(self) -> None:
+        self._pixel_array = None
+
+    def move(self, new_path: str) -> None:
+        shutil.move(self.path, new_path)
+        self.path = new_path
@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+
+import os
+
+from filelock import FileLock, Timeout
+from flask import current_app
+
+__all__ = ["slot_count", "try_acquire_slot"]
+
+
+def slot_count() -> int:
+    """
+    Сколько анализов может одновременно выполняться на хосте.
+    Ограничиваем заданным числом слотов, количеством ядер и бюджетом памяти.
+    """
+    cores_per_job = current_app.config["ANALYSIS_CORES_PER_JOB"]
+    memory_per_job = current_app.config["ANALYSIS_MEMORY_PER_JOB_GB"]
+
+    limits = [(os.cpu_count() or 1) // cores_per_job,
+              int(current_app.config["ANALYSIS_MEMORY_BUDGET_GB"] // memory_per_job)]
+
+    if current_app.config["ANALYSIS_SLOTS"] > 0:
+        limits.append(current_app.config["ANALYSIS_SLOTS"])
+
+    return max(1, min(limits))
+
+
+def try_acquire_slot() -> FileLock:
+    """
+    Пытаемся занять свободный слот без ожидания. Слот - это файловая блокировка, поэтому он общий
+    для всех процессов хоста (локальный пул каждого gunicorn воркера и flask worker) и освобождается
+    операционной системой, если процесс упал.
+    """
+    lock_dir = current_app.config["ANALYSIS_LOCK_DIR"]
+    os.makedirs(lock_dir, exist_ok=True)
+
+    for slot_num in range(slot_count()):
+        lock = FileLock(os.path.join(lock_dir, f"slot_{slot_num}.lock"))
+        try:
+            lock.acquire(timeout=0)
+            return lock
+        except Timeout:
+            continue
+
+    return None
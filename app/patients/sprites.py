@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+
+import os
+import io
+import json
+import math
+import hashlib
+import tempfile
+import numpy as np
+
+from typing import Dict, Any, List
+from flask import current_app
+
+from app.storage import get_storage
+from app.patients.previews import PLANES, load_canonical
+from app.patients.render import PNG_EXT, volume_window, to_uint8, volume_plane, plane_aspect, resize, encode_png
+
+__all__ = ["sprite_manifest", "sprite_image", "sprite_etag"]
+
+# папка со спрайтами внутри папки NIFTI серии
+_SPRITES_DIR = "sprites"
+
+
+def sprite_manifest(nifti_key: str, version: str, plane: str) -> Dict[str, Any]:
+    """
+    Оглавление спрайта плоскости plane: размер миниатюры, количество столбцов и для каждой миниатюры
+    номер среза и смещение в картинке спрайта. Если спрайт устарел или его нет, он строится заново.
+    """
+    manifest = _load_manifest(nifti_key, plane)
+
+    if manifest is None or manifest["version"] != version:
+        manifest = _build(nifti_key, version, plane, manifest)
+
+    return manifest
+
+
+def sprite_image(nifti_key: str, version: str, plane: str) -> bytes:
+    sprite_manifest(nifti_key, version, plane)
+
+    with get_storage().open_read(_sprite_key(nifti_key, plane, PNG_EXT)) as f:
+        return f.read()
+
+
+def sprite_etag(version: str, plane: str) -> str:
+    params = (version, plane, current_app.config["SPRITE_TILE_SIZE"], current_app.config["SPRITE_MAX_TILES"])
+    return hashlib.sha1(repr(params).encode()).hexdigest()
+
+
+def _build(nifti_key: str, version: str, plane: str, old_manifest: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Строим спрайт из отобранных на равном расстоянии срезов. Миниатюры прошлого спрайта, срезы которых
+    не изменились (совпал хэш исходных значений среза), переиспользуем без повторного масштабирования.
+    """
+    storage = get_storage()
+    axis = PLANES[plane]
+    tile_size = current_app.config["SPRITE_TILE_SIZE"]
+    clip_percent = current_app.config["SERIES_IMG_CLIP_PERCENT"]
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = storage.local_copy(nifti_key, os.path.join(tmp_dir, os.path.basename(nifti_key)))
+        values, zooms = load_canonical(path)
+
+    # окно яркости берем из прошлого спрайта: перцентили всего объема меняются при добавлении срезов,
+    # и с новым окном изменились бы все миниатюры, а не только миниатюры изменившихся срезов
+    reusable = _is_reusable(old_manifest, tile_size, clip_percent)
+    window = tuple(old_manifest["window"]) if reusable else volume_window(values, clip_percent)
+    old_tiles = _load_tiles(nifti_key, plane, old_manifest) if reusable else {}
+
+    count = values.shape[axis]
+    indices = sorted(set(np.linspace(0, count - 1, num=min(count, current_app.config["SPRITE_MAX_TILES"]),
+                                     dtype=np.intp).tolist()))
+
+    aspect = plane_aspect(zooms, axis)
+
+    tiles, hashes = [], []
+    for index in indices:
+        image = volume_plane(values, axis, index)
+
+        # миниатюра зависит от значений среза, окна яркости и пропорций вокселя
+        sha = hashlib.sha1(np.ascontiguousarray(image).tobytes())
+        sha.update(repr((image.dtype.str, image.shape, window, aspect)).encode())
+        tile_hash = sha.hexdigest()
+
+        tile = old_tiles.get(tile_hash)
+        if tile is None:
+            tile = resize(to_uint8(image, *window), tile_size, aspect=aspect)
+
+        tiles.append(tile)
+        hashes.append(tile_hash)
+
+    # у всех срезов одной плоскости одинаковый размер, поэтому и миниатюры одинаковые
+    tile_height, tile_width = tiles[0].shape
+    columns = math.ceil(math.sqrt(len(tiles)))
+    rows = math.ceil(len(tiles) / columns)
+
+    sheet = np.zeros((rows * tile_height, columns * tile_width), dtype=np.uint8)
+    for num, tile in enumerate(tiles):
+        y, x = num // columns * tile_height, num % columns * tile_width
+        sheet[y:y + tile_height, x:x + tile_width] = tile
+
+    manifest = {
+        "version": version,
+        "plane": plane,
+        "tile_size": tile_size,
+        "clip_percent": clip_percent,
+        "window": list(window),
+        "tile_width": tile_width,
+        "tile_height": tile_height,
+        "columns": columns,
+        "tiles": [{"index": index, "x": num % columns * tile_width, "y": num // columns * tile_height,
+                   "hash": tile_hash} for num, (index, tile_hash) in enumerate(zip(indices, hashes))],
+    }
+
+    # оглавление пишем последним: по его версии читатели решают, готов ли спрайт
+    with storage.open_write(_sprite_key(nifti_key, plane, PNG_EXT)) as f:
+        f.write(encode_png(sheet))
+
+    with storage.open_write(_sprite_key(nifti_key, plane, ".npy")) as f:
+        np.save(f, np.stack(tiles))
+
+    with storage.open_write(_sprite_key(nifti_key, plane, ".json")) as f:
+        f.write(json.dumps(manifest).encode())
+
+    return manifest
+
+
+def _is_reusable(old_manifest: Dict[str, Any], tile_size: int, clip_percent: float) -> bool:
+    """
+    Миниатюры и окно прошлого спрайта переиспользуем, только если он построен с теми же настройками
+    """
+    return old_manifest is not None and "window" in old_manifest and old_manifest["tile_size"] == tile_size \
+        and old_manifest.get("clip_percent") == clip_percent
+
+
+def _load_tiles(nifti_key: str, plane: str, old_manifest: Dict[str, Any]) -> Dict[str, np.ndarray]:
+    """
+    Миниатюры прошлого спрайта по хэшам их срезов. Пиксели миниатюр хранятся рядом со спрайтом без сжатия PNG
+    """
+    try:
+        with get_storage().open_read(_sprite_key(nifti_key, plane, ".npy")) as f:
+            tiles: List[np.ndarray] = list(np.load(io.BytesIO(f.read())))
+    except FileNotFoundError:
+        return {}
+
+    if len(tiles) != len(old_manifest["tiles"]):
+        return {}
+
+    return {tile_info["hash"]: tile for tile_info, tile in zip(old_manifest["tiles"], tiles)}
+
+
+def _load_manifest(nifti_key: str, plane: str) -> Dict[str, Any]:
+    try:
+        with get_storage().open_read(_sprite_key(nifti_key, plane, ".json")) as f:
+            return json.loads(f.read().decode())
+    except FileNotFoundError:
+        return None
+
+
+def _sprite_key(nifti_key: str, plane: str, ext: str) -> str:
+    return os.path.join(os.path.dirname(nifti_key), _SPRITES_DIR, plane + ext)
@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+
+import os
+import tarfile
+import zipfile
+import tempfile
+
+from typing import BinaryIO, Iterator, List
+from werkzeug.utils import secure_filename
+
+__all__ = ["ArchiveLimitError", "UnpackLimits", "extract_dicom_members", "is_dicom_file"]
+
+# файл DICOM начинается с преамбулы в 128 байт, за которой идет метка DICM
+_DICOM_MAGIC_OFFSET = 128
+_DICOM_MAGIC = b"DICM"
+
+_ZIP_MAGIC = b"PK\x03\x04"
+
+_CHUNK_SIZE = 1024 * 1024
+
+
+class ArchiveLimitError(Exception):
+    """
+    Архив при распаковке превысил допустимый размер или количество файлов
+    """
+
+
+class UnpackLimits:
+    """
+    Сколько еще байт и файлов можно распаковать. Один объект можно передать в несколько распаковок,
+    тогда ограничение действует на все архивы вместе. Сжатый архив маленького размера может распаковаться
+    в огромный объем, поэтому считаем именно распакованные байты.
+    """
+
+    def __init__(self, max_size: int, max_members: int) -> None:
+        self.max_size = max_size
+        self.max_members = max_members
+        self._size = 0
+        self._members = 0
+
+    def add_member(self) -> None:
+        self._members += 1
+        if self._members > self.max_members:
+            raise ArchiveLimitError(f"Archive has more than {self.max_members} members")
+
+    def add_bytes(self, size: int) -> None:
+        self._size += size
+        if self._size > self.max_size:
+            raise ArchiveLimitError(f"Archive is larger than {self.max_size} bytes")
+
+
+class _PrefixedStream:
+    """
+    Поток, к которому спереди вернули уже прочитанные из него байты
+    """
+
+    def __init__(self, prefix: bytes, stream: BinaryIO) -> None:
+        self._prefix = prefix
+        self._stream = stream
+
+    def read(self, size: int = -1) -> bytes:
+        if not self._prefix:
+            return self._stream.read(size)
+
+        if size is None or size < 0:
+            data, self._prefix = self._prefix + self._stream.read(), b""
+            return data
+
+        data, self._prefix = self._prefix[:size], self._prefix[size:]
+        if len(data) < size:
+            data += self._stream.read(size - len(data))
+
+        return data
+
+
+def is_dicom_file(path: str) -> bool:
+    with open(path, "rb") as f:
+        return _has_dicom_magic(f.read(_DICOM_MAGIC_OFFSET + len(_DICOM_MAGIC)))
+
+
+def _has_dicom_magic(head: bytes) -> bool:
+    return head[_DICOM_MAGIC_OFFSET:] == _DICOM_MAGIC
+
+
+def extract_dicom_members(stream: BinaryIO, out_dir: str, skipped: List[str],
+                          limits: UnpackLimits) -> Iterator[str]:
+    """
+    Распаковываем архив zip или tar (в том числе сжатый) из потока запроса в out_dir и отдаем пути файлов DICOM
+    по мере распаковки. Файлы без метки DICM на диск не пишутся, их имена добавляются в skipped.
+    Если архив превысил limits, то распаковка прерывается с ArchiveLimitError.
+
+    tar читается прямо из потока, по мере получения. У zip оглавление лежит в конце архива, поэтому
+    его сначала дописываем во временный файл на диске, а уже затем распаковываем.
+    """
+    head = stream.read(len(_ZIP_MAGIC))
+    stream = _PrefixedStream(head, stream)
+
+    if head == _ZIP_MAGIC:
+        yield from _extract_zip(stream, out_dir, skipped, limits)
+    else:
+        yield from _extract_tar(stream, out_dir, skipped, limits)
+
+
+def _extract_tar(stream: BinaryIO, out_dir: str, skipped: List[str], limits: UnpackLimits) -> Iterator[str]:
+    with tarfile.open(fileobj=stream, mode="r|*") as tar:
+        for index, member in enumerate(tar):
+            # папки и ссылки тоже считаем: архив из миллионов пустых записей разбирается так же долго
+            limits.add_member()
+            if not member.isfile():
+                continue
+
+            path = _extract_member(tar.extractfile(member), member.name, index, out_dir, skipped, limits)
+            if path is not None:
+                yield path
+
+
+def _extract_zip(stream: BinaryIO, out_dir: str, skipped: List[str], limits: UnpackLimits) -> Iterator[str]:
+    with tempfile.TemporaryFile(dir=out_dir) as spool:
+        # сжатый архив не больше распакованного, поэтому его размер ограничен тем же пределом
+        _copy_limited(stream, spool, UnpackLimits(limits.max_size, limits.max_members))
+        spool.seek(0)
+
+        with zipfile.ZipFile(spool) as archive:
+            for index, info in enumerate(archive.infolist()):
+                limits.add_member()
+                if info.is_dir():
+                    continue
+
+                with archive.open(info) as member:
+                    path = _extract_member(member, info.filename, index, out_dir, skipped, limits)
+
+                if path is not None:
+                    yield path
+
+
+def _extract_member(member: BinaryIO, name: str, index: int, out_dir: str, skipped: List[str],
+                    limits: UnpackLimits) -> str:
+    """
+    Пишем член архива на диск кусками, если это DICOM. Возвращаем путь к файлу или None, если файл пропущен.
+    """
+    basename = os.path.basename(name)
+
+    # DICOMDIR - оглавление носителя, а не срез
+    if basename.upper() == "DICOMDIR":
+        return None
+
+    head = member.read(_DICOM_MAGIC_OFFSET + len(_DICOM_MAGIC))
+    if not _has_dicom_magic(head):
+        skipped.append(name)
+        return None
+
+    # одинаковые имена в разных папках архива не должны затирать друг друга
+    path = os.path.join(out_dir, f"{index}_{secure_filename(basename)}")
+
+    try:
+        with open(path, "wb") as f:
+            limits.add_bytes(len(head))
+            f.write(head)
+            _copy_limited(member, f, limits)
+    except ArchiveLimitError:
+        os.remove(path)
+        raise
+
+    return path
+
+
+def _copy_limited(src: BinaryIO, dst: BinaryIO, limits: UnpackLimits) -> None:
+    while True:
+        chunk = src.read(_CHUNK_SIZE)
+        if not chunk:
+            break
+
+        limits.add_bytes(len(chunk))
+        dst.write(chunk)
@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import hashlib
+
+from datetime import timedelta
+from typing import List, Dict, Any
+from flask import current_app
+
+from app.model import *
+
+__all__ = ["create_session", "save_chunk", "session_status", "finish_session", "close_session", "reopen_session",
+           "discard_session_files", "collect_abandoned"]
+
+
+def create_session(patient_id: str, user_id: str, files: List[Dict[str, Any]]) -> UploadSession:
+    """
+    Открываем сессию загрузки по кускам. Под каждый файл сразу создаем файл нужного размера,
+    куски затем пишутся в него по своим смещениям в любом порядке.
+    """
+    collect_abandoned()
+
+    if not files or not isinstance(files, list):
+        raise ValueError("Не переданы файлы для загрузки")
+
+    # под каждый файл сразу создается файл на диске, поэтому количество и размер проверяем до любых записей
+    if len(files) > current_app.config["UPLOAD_MAX_MEMBERS"]:
+        raise ValueError("Количество файлов превышает допустимое")
+
+    session_files = []
+    for file in files:
+        name, size = file.get("name"), file.get("size")
+        if not isinstance(name, str) or not isinstance(size, int) or size < 0:
+            raise ValueError("Для каждого файла нужно передать имя и размер")
+        session_files.append({"name": name, "size": size})
+
+    if sum(file["size"] for file in session_files) > current_app.config["UPLOAD_MAX_SIZE"]:
+        raise ValueError("Суммарный размер файлов превышает допустимый")
+
+    session = UploadSessionCollection.push(patient_id, user_id, current_app.config["UPLOAD_CHUNK_SIZE"],
+                                           session_files)
+
+    session_dir = _session_dir(session.id)
+    os.makedirs(session_dir, exist_ok=True)
+
+    for file_index, file in enumerate(session_files):
+        with open(_part_path(session.id, file_index), "wb") as f:
+            f.truncate(file["size"])
+
+    return session
+
+
+def save_chunk(session: UploadSession, file_index: int, chunk_num: int, data: bytes, checksum: str) -> None:
+    """
+    Записываем кусок файла. Кусок принимается, только если совпали его длина и SHA-256,
+    иначе клиент должен отправить его заново. Повторная отправка уже принятого куска безопасна.
+    """
+    if session.state == "finalizing":
+        raise ValueError("Загрузка уже завершается")
+
+    if not 0 <= file_index < len(session.files) or not 0 <= chunk_num < session.chunk_count(file_index):
+        raise ValueError("Неверный номер файла или куска")
+
+    offset = chunk_num * session.chunk_size
+    expected_size = min(session.chunk_size, session.files[file_index]["size"] - offset)
+
+    if len(data) != expected_size:
+        raise ValueError(f"Неверный размер куска: {len(data)} вместо {expected_size}")
+
+    if hashlib.sha256(data).hexdigest() != (checksum or "").lower():
+        raise ValueError("Контрольная сумма куска не совпадает")
+
+    with open(_part_path(session.id, file_index), "r+b") as f:
+        f.seek(offset)
+        f.write(data)
+
+    # кусок отмечаем принятым только после записи, поэтому при обрыве он будет отправлен снова
+    UploadSessionCollection.add_chunk(session.id, file_index, chunk_num)
+
+
+def session_status(session: UploadSession) -> Dict[str, Any]:
+    """
+    Состояние сессии, по которому клиент после обрыва связи дозагружает недостающие куски
+    """
+    return {
+        "upload_id": session.id,
+        "chunk_size": session.chunk_size,
+        "files": [{"name": file["name"], "size": file["size"], "missing": session.missing_chunks(file_index)}
+                  for file_index, file in enumerate(session.files)],
+    }
+
+
+def finish_session(session: UploadSession) -> List[str]:
+    """
+    Начинаем завершение полностью загруженной сессии и возвращаем пути собранных файлов.
+    Если сессию уже завершает параллельный запрос, возвращаем None.
+    Сессия и ее файлы остаются до close_session, поэтому после ошибки сохранения завершение можно повторить.
+    """
+    if not session.is_complete:
+        raise ValueError("Загружены не все куски")
+
+    if not UploadSessionCollection.start_finalizing(session.id):
+        return None
+
+    return [_part_path(session.id, file_index) for file_index in range(len(session.files))]
+
+
+def close_session(session: UploadSession) -> None:
+    """
+    Удаляем сессию вместе с файлами после успешного сохранения серий
+    """
+    if UploadSessionCollection.delete_one(session.id):
+        discard_session_files(session.id)
+
+
+def reopen_session(session: UploadSession) -> None:
+    """
+    Возвращаем сессию в состояние загрузки после неудачного завершения
+    """
+    UploadSessionCollection.reset_state(session.id)
+
+
+def discard_session_files(upload_id: str) -> None:
+    shutil.rmtree(_session_dir(upload_id), ignore_errors=True)
+
+
+def collect_abandoned() -> None:
+    """
+    Удаляем сессии, в которые давно не приходили куски, вместе с их файлами
+    """
+    ttl = timedelta(hours=current_app.config["UPLOAD_SESSION_TTL_HOURS"])
+
+    for session in UploadSessionCollection.find_abandoned(ttl):
+        if UploadSessionCollection.delete_one(session.id):
+            discard_session_files(session.id)
+
+
+def _session_dir(upload_id: str) -> str:
+    return os.path.join(current_app.config["UPLOAD_FOLDER"], upload_id)
+
+
+def _part_path(upload_id: str, file_index: int) -> str:
+    return os.path.join(_session_dir(upload_id), f"{file_index}.part")
@@ -1,41 +1,149 @@
 # -*- coding: utf-8 -*-
 
 import os
-import pydicom
 import shutil
 import tarfile
+import zipfile
+import time
+import queue
+import signal
+import threading
+import multiprocessing
+import tempfile
 import hashlib
+import resource
 import numpy as np
-import matplotlib.pyplot as plt
+import nibabel as nib
 
-from flask import request, flash, Markup, current_app
+from flask import request, flash, Markup, escape, current_app
 from flask_login import current_user
 from werkzeug.utils import secure_filename
 from dicom2nifti.exceptions import ConversionError, ConversionValidationError
 from collections import defaultdict, namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from dicom2nifti import dicom_series_to_nifti
-from typing import List, Tuple
-from glob import glob
+from typing import List, Tuple, Dict, Any, Callable, Iterator, Iterable
 from datetime import datetime
-from wrapt_timeout_decorator import timeout
-from nipype import Node, Workflow
+from dateutil.parser import isoparse
+from nipype import Node, Workflow, config as nipype_config, logging as nipype_logging
 from nipype.interfaces import fsl
+from nipype.interfaces.base import InterfaceResult
 from pydicom.errors import InvalidDicomError
-from operator import itemgetter
+from pymongo.errors import PyMongoError
 
 from app.model import *
-
-__all__ = ["save_files_from_client", "split_on_series", "remove", "analyze"]
+from app.storage import Storage, get_storage
+from app.patients import cache
+from app.patients.volumes import label_volumes, brain_volume
+from app.patients.qc import check_volume
+from app.patients.overlay import render_views, store_views, delete_views
+from app.patients.slices import ParsedSlice
+from app.patients.unpack import ArchiveLimitError, UnpackLimits, extract_dicom_members, is_dicom_file
+from app.patients.series_archive import ARCHIVE_EXT, write_archive, extract_series
+
+__all__ = ["save_files_from_client", "save_archive_from_client", "save_uploaded_files", "split_on_series", "remove",
+           "analyze", "discard_removed_series"]
 
 # для функции _get_series_info
 __SeriesInfo = namedtuple("__SeriesInfo", ["id", "desc", "datetime"])
 __SliceInfo = namedtuple("__SliceInfo", ["number"])
 
+# задание на сохранение одной серии для пула процессов. series_dir - локальная рабочая папка, nifti_path,
+# stored_archive и pending_prefix - ключи хранилища. stored_archive - архив уже сохраненной серии (None для новой
+# серии), pending_prefix - "папка" в хранилище со срезами серии, которая еще не загружена полностью
+_SeriesTask = namedtuple("_SeriesTask", ["series_info", "slices", "series_dir", "nifti_path", "stored_archive",
+                                         "pending_prefix", "archive_threads", "storage"])
+
+# результат сохранения серии: state - stored (новая серия), merged (срезы добавлены в сохраненную серию),
+# pending (серия пока неполная), rejected (серия не сохранена). index_entries - все срезы серии для индекса
+_SeriesResult = namedtuple("_SeriesResult", ["state", "archive_path", "slice_count", "messages", "index_entries"])
+
+# пул процессов загрузки, общий для всех запросов процесса. Создается при первой загрузке
+_ingest_executor: ProcessPoolExecutor = None
+_ingest_executor_lock = threading.Lock()
+
 
 def save_files_from_client(patient_id: str) -> None:
     """
     Сохраняем все файлы, переданные клиентом, во временную папку
     """
+    tmp_dir = _make_tmp_dir(patient_id)
+
+    upload_files = request.files.getlist("series")
+
+    for file in upload_files:
+        filename = secure_filename(file.filename)
+        file.save(os.path.join(tmp_dir, filename))
+
+
+def save_archive_from_client(patient_id: str) -> Iterator[str]:
+    """
+    Распаковываем архив исследования (zip или tar), переданный клиентом телом запроса, во временную папку.
+    Пути срезов отдаем по мере распаковки, чтобы их разбор начинался, пока остальная часть архива еще передается.
+    """
+    tmp_dir = _make_tmp_dir(patient_id)
+    skipped = []
+
+    try:
+        yield from extract_dicom_members(request.stream, tmp_dir, skipped, _unpack_limits())
+    except (tarfile.TarError, zipfile.BadZipFile, EOFError):
+        flash(Markup("Архив поврежден или не является архивом zip/tar"))
+    except ArchiveLimitError:
+        _flash_archive_limit()
+
+    if skipped:
+        flash(Markup(f"Пропущено файлов не формата DICOM: <b>{len(skipped)}</b>"))
+
+
+def save_uploaded_files(patient_id: str, files: List[Tuple[str, str]]) -> Iterator[str]:
+    """
+    Копируем во временную папку файлы, собранные из кусков (пары путь - исходное имя).
+    Срезы отдаем сразу, архивы распаковываем и отдаем их срезы по мере распаковки.
+    Исходные файлы не меняются, поэтому после ошибки сохранения их можно разобрать повторно.
+    """
+    tmp_dir = _make_tmp_dir(patient_id)
+    skipped = []
+
+    # ограничение общее на все архивы загрузки
+    limits = _unpack_limits()
+
+    for num, (path, name) in enumerate(files):
+        if is_dicom_file(path):
+            new_path = os.path.join(tmp_dir, f"{num}_{secure_filename(name)}")
+            shutil.copyfile(path, new_path)
+            yield new_path
+            continue
+
+        # каждый архив распаковываем в свою папку, чтобы имена срезов разных архивов не пересекались
+        archive_dir = os.path.join(tmp_dir, str(num))
+        os.makedirs(archive_dir, exist_ok=True)
+
+        try:
+            with open(path, "rb") as f:
+                yield from extract_dicom_members(f, archive_dir, skipped, limits)
+        except (tarfile.TarError, zipfile.BadZipFile, EOFError):
+            skipped.append(name)
+        except ArchiveLimitError:
+            _flash_archive_limit()
+            break
+
+    if skipped:
+        flash(Markup(f"Пропущено файлов не формата DICOM: <b>{len(skipped)}</b>"))
+
+
+def _unpack_limits() -> UnpackLimits:
+    return UnpackLimits(current_app.config["UPLOAD_MAX_SIZE"], current_app.config["UPLOAD_MAX_MEMBERS"])
+
+
+def _flash_archive_limit() -> None:
+    max_size_mb = current_app.config["UPLOAD_MAX_SIZE"] // 1024 ** 2
+    flash(Markup(f"Архив больше <b>{max_size_mb}</b> МБ или содержит больше "
+                 f"<b>{current_app.config['UPLOAD_MAX_MEMBERS']}</b> файлов в распакованном виде, "
+                 f"распаковка прервана"))
+
+
+def _make_tmp_dir(patient_id: str) -> str:
     tmp_dir = os.path.join(current_app.config['TMP_FOLDER'], patient_id, current_user.id)
 
     if os.path.isdir(tmp_dir):
@@ -43,19 +151,19 @@ def save_files_from_client(patient_id: str) -> None:
 
     os.makedirs(tmp_dir, exist_ok=True)
 
-    upload_files = request.files.getlist("series")
-
-    for file in upload_files:
-        filename = secure_filename(file.filename)
-        file.save(os.path.join(tmp_dir, filename))
+    return tmp_dir
 
 
-def split_on_series(patient_id: str) -> None:
+def split_on_series(patient_id: str, slice_paths: Iterable[str] = None) -> None:
     """
     Распределяем загруженные срезы по сериям. Затем конвертируем в NIFTI.
+    По умолчанию берем все файлы из временной папки, иначе - переданные пути (в том числе генератор,
+    отдающий срезы по мере их получения).
 
     Проверяем каждый срез на теги.
-    Если в хотя бы одном проверка не прошла, то ни одной серии не сохраняем.
+    Срезы, которые уже есть у пациента (по SOPInstanceUID или по хэшу содержимого), отбрасываем сразу после разбора.
+    Новые срезы уже сохраненной серии добавляем в нее, пересобирая NIFTI и архив.
+    Неполную серию (с пропусками в нумерации) откладываем до загрузки недостающих срезов.
 
     Проверяем каждую серию. Если серия не прошла проверку, то игнорим только ее.
     После сохранения и конвертации серии, сообщаем клиенту об этом.
@@ -69,223 +177,885 @@ def split_on_series(patient_id: str) -> None:
     if not os.path.isdir(dicom_dir):
         os.makedirs(dicom_dir, exist_ok=True)
 
-    series_id_to_paths = defaultdict(list)
+    series_id_to_slices = defaultdict(list)
 
-    # здесь проверяем каждый срез перед тем, как замувить их в постоянную папку
-    for slice_name in os.listdir(tmp_dir):
-        slice_path = os.path.join(tmp_dir, slice_name)
+    # срезы, уже сохраненные у пациента, в том числе в еще неполных сериях
+    known_sop_uids, known_hashes = SliceIndexCollection.find_known(patient_id)
+    duplicate_count = 0
 
-        try:
-            series_info, slice_info = _get_info_from_slice(slice_path)
-        except AssertionError as e:
-            flash(Markup(str(e)))
+    # здесь проверяем каждый срез перед тем, как замувить их в постоянную папку.
+    # Заголовок каждого файла читается один раз, дальше все функции работают с разобранными срезами
+    if slice_paths is None:
+        slice_paths = [os.path.join(tmp_dir, slice_name) for slice_name in os.listdir(tmp_dir)]
+
+    for parsed_slice, series_info, slice_info, error in _parse_slices(slice_paths):
+        if error is not None:
+            flash(Markup(error))
             continue
-        except InvalidDicomError:
-            flash(Markup(f"Файл <b>{os.path.basename(slice_path)}</b> не формата DICOM"))
+
+        # хэш содержимого уже посчитан в процессе пула, поэтому обе проверки не читают файл
+        if parsed_slice.sop_uid in known_sop_uids or parsed_slice.content_hash in known_hashes:
+            duplicate_count += 1
             continue
 
-        series_id_to_paths[series_info].append((slice_info.number, slice_path))
+        known_sop_uids.add(parsed_slice.sop_uid)
+        known_hashes.add(parsed_slice.content_hash)
+
+        series_id_to_slices[series_info].append((slice_info.number, parsed_slice))
+
+    if duplicate_count:
+        flash(Markup(f"Пропущено уже загруженных срезов: <b>{duplicate_count}</b>"))
 
-    for series_info, values in series_id_to_paths.items():
+    tasks = []
 
-        slice_paths = [slice_path for _, slice_path in sorted(values, key=lambda x: x[0])]
+    for series_info, values in series_id_to_slices.items():
 
+        slices = [parsed_slice for _, parsed_slice in sorted(values, key=lambda x: x[0])]
+
+        stored_archive = None
         if series_info.id in series_data.series_dict:
-            flash(Markup(f"Серия <b>{series_info.desc}</b> уже хранится в системе"))
-            continue
+            stored_series = series_data.find_or_404(series_info.id)
 
-        try:
-            _validate_series(slice_paths)
-        except AssertionError as e:
-            flash(Markup(str(e).format(series_info.desc)))
-            continue
+            # NIFTI нельзя пересобирать, пока его анализирует воркер
+            if stored_series.in_progress:
+                flash(Markup(f"Серия <b>{stored_series.desc}</b> сейчас анализируется, новые срезы не добавлены"))
+                continue
+
+            stored_archive = stored_series.dicom_path
+            series_info = series_info._replace(desc=stored_series.desc)
 
         series_dir = os.path.join(dicom_dir, series_info.id)
 
         nifti_dir = os.path.join(current_app.config["NIFTI_FOLDER"], patient_id, series_info.id)
         nifti_path = os.path.join(nifti_dir, "original" + current_app.config["NIFTI_EXT"])
 
-        img_dir = os.path.join(current_app.config["SERIES_IMG_FOLDER"], patient_id, series_info.id)
-        _make_series_images(slice_paths, img_dir)
+        tasks.append(_SeriesTask(series_info, slices, series_dir, nifti_path, stored_archive,
+                                 _pending_prefix(patient_id, series_info.id), current_app.config["ARCHIVE_THREADS"],
+                                 get_storage()))
+
+    # сохранение серий (проверка, NIFTI, архив) выполняем параллельно. В БД пишем только поля каждой серии,
+    # так как за время сохранения документ пациента мог измениться
+    for task, result in zip(tasks, _store_all_series(tasks)):
+        for message in result.messages:
+            flash(Markup(message))
 
-        _move_series(slice_paths, series_dir)
+        series_id = task.series_info.id
 
-        _convert_series(series_dir, nifti_path, series_info.desc)
-        archive_path = _archive_series(series_dir)
+        try:
+            _save_series_record(patient_id, task, result)
+        except PyMongoError:
+            # у новой серии без записи в БД сохраненные снимки никому не нужны
+            if result.state == "stored":
+                _delete_stored_files(task, result)
+            flash(Markup(f"Серию <b>{task.series_info.desc}</b> не удалось записать в БД, загрузите ее повторно"))
+            continue
 
-        series = Series(desc=series_info.desc, dt=series_info.datetime, dicom_path=archive_path,
-                        nifti_dir=nifti_dir, img_dir=img_dir, slice_count=len(slice_paths))
-        series_data.insert(series, series_info.id)
+        # индекс пишем только после записи серии: иначе при сбое срезы числились бы загруженными
+        # и отбрасывались бы как дубли, хотя серии нет
+        if result.index_entries is None:
+            continue
 
-    # сохраняем пути в БД
-    PatientCollection.save_data(series_data, patient_id=patient_id)
+        try:
+            SliceIndexCollection.replace_series(patient_id, series_id, result.index_entries)
+        except PyMongoError:
+            if result.state == "stored":
+                PatientCollection.remove_series(patient_id, series_id)
+                _delete_stored_files(task, result)
+                SliceIndexCollection.delete_for_series(patient_id, series_id)
+                flash(Markup(f"Серию <b>{task.series_info.desc}</b> не удалось записать в БД, загрузите ее повторно"))
+            # у остальных серий неполный индекс безопасен: дубли срезов еще раз отсекаются по SOPInstanceUID
 
     # после всех операций удаляем временную папку
     shutil.rmtree(tmp_dir)
 
 
+def _save_series_record(patient_id: str, task: _SeriesTask, result: _SeriesResult) -> None:
+    """
+    Записываем в БД новую серию или изменения серии, в которую добавлены срезы
+    """
+    series_id = task.series_info.id
+
+    if result.state == "stored":
+        series = Series(desc=task.series_info.desc, dt=task.series_info.datetime, dicom_path=result.archive_path,
+                        nifti_dir=os.path.dirname(task.nifti_path), slice_count=result.slice_count)
+        PatientCollection.insert_series(patient_id, series_id, series)
+
+    elif result.state == "merged":
+        # снимок изменился, поэтому прежние результаты анализа недействительны
+        values = {"slice_count": result.slice_count, "dicom_path": result.archive_path}
+        if not PatientCollection.reset_series(patient_id, series_id, values, Series.RESULT_FIELDS):
+            # анализ поставили в очередь, пока серия пересобиралась: его состояние не трогаем
+            PatientCollection.update_series(patient_id, series_id, values)
+            flash(Markup(f"Серия <b>{task.series_info.desc}</b> поставлена на анализ во время добавления срезов, "
+                         f"после его окончания запустите анализ повторно"))
+
+
+def _delete_stored_files(task: _SeriesTask, result: _SeriesResult) -> None:
+    task.storage.delete(result.archive_path)
+    task.storage.delete_prefix(os.path.dirname(task.nifti_path))
+
+
 def remove(patient_id: str, series_id: str) -> None:
     """
     Удаляем серию: все снимки и запись в БД
     """
 
-    # сначала удаляем запись из документа пациента
+    # сначала удаляем запись серии из документа пациента, остальные серии не трогаем
     series_data: SeriesData = PatientCollection.find_one(patient_id, SeriesData)
     series = series_data.find_or_404(series_id)
     desc, dicom_path, nifti_dir, img_dir = series.desc, series.dicom_path, series.nifti_dir, series.img_dir
-    series_data.remove(series_id)
-    PatientCollection.save_data(series_data, patient_id)
-
-    # удаляем все пути
-    os.remove(dicom_path)
-    shutil.rmtree(nifti_dir)
-    shutil.rmtree(os.path.join(current_app.static_folder, img_dir))
+    PatientCollection.remove_series(patient_id, series_id)
+    JobCollection.delete_for_series(patient_id, series_id)
+    SliceIndexCollection.delete_for_series(patient_id, series_id)
+
+    # выполняющийся анализ прерываем. Его рабочие папки удалит сам воркер после остановки FSL,
+    # как и файлы, которые анализ успеет записать, иначе они пересоздадутся после удаления серии
+    running_job = JobCollection.request_cancel(patient_id, series_id)
+    analysis_running = running_job is not None and running_job.state == "running"
+
+    # удаляем все артефакты серии из хранилища и локальные рабочие папки
+    storage = get_storage()
+    storage.delete(dicom_path)
+    storage.delete_prefix(nifti_dir)
+    if img_dir is not None:
+        storage.delete_prefix(img_dir)
+    if not analysis_running:
+        shutil.rmtree(os.path.join(cache.stages_dir(patient_id), series_id), ignore_errors=True)
+    storage.delete_prefix(_pending_prefix(patient_id, series_id))
 
     flash(Markup(f"Серия <b>{desc}</b> удалена"))
 
 
-def analyze(patient_id: str, series_id: str) -> None:
+def discard_removed_series(patient_id: str, series_id: str) -> bool:
+    """
+    Если серию удалили во время анализа, то удаляем файлы, которые анализ успел записать, и рабочие папки этапов.
+    Вызывается воркером после завершения задания. Возвращаем True, если серия была удалена.
+    """
+    if PatientCollection.series_exists(patient_id, series_id):
+        return False
+
+    get_storage().delete_prefix(os.path.join(current_app.config["NIFTI_FOLDER"], patient_id, series_id))
+    shutil.rmtree(os.path.join(cache.stages_dir(patient_id), series_id), ignore_errors=True)
+    return True
+
+
+def analyze(patient_id: str, series_id: str, cancel_event: threading.Event = None,
+            holds_lease: Callable[[], bool] = None) -> str:
+    """
+    Проводим морфометрический анализ серии (FSL BET + FIRST) и сохраняем объемы в БД.
+    Возвращаем итоговый статус анализа. Анализ прерывается, если выставлен cancel_event.
+    holds_lease подтверждает перед каждой записью в серию, что задание все еще в аренде у этого воркера.
+    """
 
     timeout_value = current_app.config["TIMEOUT_VALUE"]
 
-    @timeout(timeout_value, use_signals=False)
-    def run_workflow(wf: Workflow):
-        return wf.run(plugin="MultiProc")
+    # ограничиваем ресурсы одного анализа, чтобы параллельные анализы не делили между собой все ядра
+    plugin_args = {"n_procs": current_app.config["ANALYSIS_CORES_PER_JOB"],
+                   "memory_gb": current_app.config["ANALYSIS_MEMORY_PER_JOB_GB"]}
+
+    # узлы, которые начали, но не закончили работу. Их рабочие папки при прерывании анализа удаляются
+    unfinished_nodes = set()
+
+    def on_node_event(node_name: str, node_status: str) -> None:
+        if node_status == "start":
+            unfinished_nodes.add(node_name)
+        elif node_status == "end":
+            unfinished_nodes.discard(node_name)
+
+        AnalysisEventCollection.push(patient_id, series_id, node_name.split("_")[0], node_status)
+
+    def save_result(values: Dict[str, Any]) -> None:
+        # если аренду забрал другой воркер, то серию уже анализирует он и наш результат устарел
+        if holds_lease is None or holds_lease():
+            PatientCollection.update_series(patient_id, series_id, values)
+
+    def save_views(segmentation_path: str) -> None:
+        # виды рисуем после записи объемов, поэтому ошибка отрисовки не теряет результат анализа
+        try:
+            views_metrics = _make_views(storage, nifti_dir, nifti_path, segmentation_path)
+        except Exception as e:
+            current_app.logger.exception(f"Rendering views of series {series_id} failed")
+            views_metrics = {"error": repr(e), "reused": False}
+            AnalysisEventCollection.push(patient_id, series_id, "views", "exception")
+        else:
+            AnalysisEventCollection.push(patient_id, series_id, "views", "end")
+
+        save_result({"metrics.views": views_metrics})
 
     series_data: SeriesData = PatientCollection.find_one(patient_id, SeriesData)
     series = series_data.find_or_404(series_id)
 
+    storage = get_storage()
     nifti_dir = series.nifti_dir
-    nifti_path = os.path.join(nifti_dir, "original.nii.gz")
 
-    workflow = Workflow(name=os.path.basename(nifti_dir), base_dir=os.path.dirname(nifti_dir))
+    # FSL и nibabel читают только файлы. Путь локальной копии постоянный, иначе nipype не узнает вход
+    # и не переиспользует этапы
+    nifti_path = storage.local_copy(os.path.join(nifti_dir, "original.nii.gz"),
+                                    os.path.join(cache.stages_dir(patient_id), series_id, "original.nii.gz"))
+
+    # снимки, на которых FSL заведомо не отработает, отсекаем за секунды, а не после таймаута
+    wall_started = time.perf_counter()
+    qc_metrics, qc_message = check_volume(nifti_path)
+    qc_result = {"qc_metrics": qc_metrics, "qc_message": qc_message,
+                 "metrics.qc": {"wall_time": round(time.perf_counter() - wall_started, 3), "reused": False}}
+
+    if qc_message is not None:
+        AnalysisEventCollection.push(patient_id, series_id, "qc", "exception")
+        save_result(dict(qc_result, status="qc failed"))
+        return "qc failed"
+
+    AnalysisEventCollection.push(patient_id, series_id, "qc", "end")
+    save_result(qc_result)
+
+    # одинаковый снимок с одинаковыми параметрами FSL не анализируем повторно
+    wall_started = time.perf_counter()
+    cache_key = cache.make_key(nifti_path)
+    cached_volumes = cache.restore(cache_key, nifti_dir)
+    if cached_volumes is not None:
+        # сегментация нужна видам как локальный файл. Берем ее из папки серии, а не из записи кэша,
+        # которую могут вытеснить в любой момент
+        segmentation_path = storage.local_copy(os.path.join(nifti_dir, "post_first.nii.gz"),
+                                               os.path.join(cache.stages_dir(patient_id), series_id,
+                                                            "post_first.nii.gz"))
+
+        cache_metrics = {"wall_time": round(time.perf_counter() - wall_started, 3), "reused": True}
+        AnalysisEventCollection.push(patient_id, series_id, "cache", "end")
+
+        save_result(dict(cached_volumes, status="ok", **{"metrics.cache": cache_metrics}))
+        save_views(segmentation_path)
+        return "ok"
+
+    # рабочие папки узлов не удаляем после анализа: nipype переиспользует результаты этапов,
+    # у которых не изменились ни входы, ни параметры
+    workflow = Workflow(name=series_id, base_dir=os.path.abspath(cache.stages_dir(patient_id)))
+
+    bet_params = {"frac": current_app.config["BET_FRAC"], "robust": True}
+    bet_interface = _BET(in_file=os.path.abspath(nifti_path), **bet_params)
+
+    first_params = {"method": current_app.config["FIRST_METHOD"], "brain_extracted": True,
+                    "list_of_specific_structures": ["L_Hipp", "R_Hipp"]}
+    first_interface = _FIRST(**first_params)
+    if current_app.config["FIRST_THREE_STAGE"]:
+        first_interface.inputs.args = "-3"
+        first_params["args"] = "-3"
+
+    bet_node = Node(bet_interface, name=cache.stage_node_name("bet", bet_params))
+    first_node = Node(first_interface, name=cache.stage_node_name("first", dict(first_params, bet=bet_node.name)))
 
-    frac = current_app.config["BET_FRAC"]
-    bet_interface = fsl.BET(in_file=os.path.abspath(nifti_path), frac=frac, robust=True)
+    workflow.connect(bet_node, "out_file", first_node, "in_file")
 
-    method = current_app.config["FIRST_METHOD"]
-    three_stage = current_app.config["FIRST_THREE_STAGE"]
-    first_interface = fsl.FIRST(method=method, brain_extracted=True, list_of_specific_structures=["L_Hipp", "R_Hipp"])
-    if three_stage:
-        first_interface.inputs.args = "-3"
+    result = {"left_volume": None, "right_volume": None, "whole_brain_volume": None, "structure_volumes": None}
 
-    left_stats_interface = fsl.ImageStats(op_string="-l 16.5 -u 17.5 -V")
-    right_stats_interface = fsl.ImageStats(op_string="-l 52.5 -u 53.5 -V")
-    whole_brain_interface = fsl.ImageStats(op_string="-V")
+    try:
+        run_started = datetime.now()
+        node_results = _run_workflow(workflow, plugin_args, timeout_value, on_node_event, cancel_event)
+
+        result["metrics.bet"] = _node_metrics(node_results[bet_node.name], run_started)
+        result["metrics.first"] = _node_metrics(node_results[first_node.name], run_started)
+
+        post_bet_path = node_results[bet_node.name].outputs.out_file
+        post_first_path = node_results[first_node.name].outputs.original_segmentations
+
+        # копируем, а не перемещаем, иначе nipype не найдет выходы узлов при следующем запуске
+        storage.put_file(os.path.join(nifti_dir, "post_bet.nii.gz"), post_bet_path)
+        storage.put_file(os.path.join(nifti_dir, "post_first.nii.gz"), post_first_path)
+
+        # объемы считаем в текущем процессе вместо отдельных запусков fslstats. В процессе воркера параллельно
+        # идут другие анализы, поэтому время CPU считаем по текущему потоку
+        wall_started, cpu_started = time.perf_counter(), _thread_cpu_time()
+        structure_volumes = label_volumes(post_first_path)
+        result["structure_volumes"] = structure_volumes
+        result["left_volume"] = structure_volumes.get("L_Hipp", 0.0)
+        result["right_volume"] = structure_volumes.get("R_Hipp", 0.0)
+        result["whole_brain_volume"] = brain_volume(post_bet_path)
+        result["status"] = "ok"
+        AnalysisEventCollection.push(patient_id, series_id, "stats", "end")
+        result["metrics.stats"] = {
+            "wall_time": round(time.perf_counter() - wall_started, 3),
+            "cpu_time": round(_thread_cpu_time() - cpu_started, 3),
+            # пик памяти этапа отдельно не измерить: это пик процесса воркера за все время его жизни,
+            # поэтому он хранится под своим именем и не попадает в сводку по peak_rss_mb
+            "worker_peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+            "reused": False,
+        }
+
+        cache.store(cache_key, {"post_bet.nii.gz": post_bet_path, "post_first.nii.gz": post_first_path},
+                    {key: result[key] for key in cache.CACHED_FIELDS})
+    except TimeoutError:
+        result["status"] = "timeout"
+    except _AnalysisCancelled:
+        result["status"] = "cancelled"
+    except RuntimeError:
+        result["status"] = "runtime error"
+    finally:
+        # после прерывания или любого падения в рабочих папках узлов остаются недописанные файлы FSL
+        for node_name in unfinished_nodes:
+            shutil.rmtree(os.path.join(workflow.base_dir, workflow.name, node_name), ignore_errors=True)
 
-    bet_node = Node(bet_interface, name="bet")
-    first_node = Node(first_interface, name="first")
-    left_stats_node = Node(left_stats_interface, name="left_stats")
-    right_stats_node = Node(right_stats_interface, name="right_stats")
-    whole_brain_node = Node(whole_brain_interface, name="whole_brain_stats")
+    # пишем только поля этой серии, так как за время анализа документ пациента мог измениться
+    save_result(result)
 
-    workflow.connect(bet_node, "out_file", first_node, "in_file")
-    workflow.connect(first_node, "original_segmentations", left_stats_node, "in_file")
-    workflow.connect(first_node, "original_segmentations", right_stats_node, "in_file")
-    workflow.connect(bet_node, "out_file", whole_brain_node, "in_file")
+    if result["status"] == "ok":
+        save_views(post_first_path)
 
+    # уборка рабочих папок не должна влиять на уже сохраненный результат: папки могут параллельно удалять
+    # другие воркеры, поэтому ошибки файловой системы здесь пропускаем
     try:
-        result_graph = run_workflow(workflow)
-        result_nodes = list(result_graph.nodes)
+        cache.touch_stages(os.path.join(workflow.base_dir, workflow.name), (bet_node.name, first_node.name))
+        cache.prune_stages()
+    except OSError:
+        pass
 
-        post_bet_path = result_nodes[0].result.outputs.out_file
-        post_first_path = result_nodes[1].result.outputs.original_segmentations
+    return result["status"]
 
-        new_post_bet_path = os.path.join(nifti_dir, "post_bet.nii.gz")
-        new_post_first_path = os.path.join(nifti_dir, "post_first.nii.gz")
 
-        shutil.move(post_bet_path, new_post_bet_path)
-        shutil.move(post_first_path, new_post_first_path)
+class _AnalysisCancelled(Exception):
+    pass
 
-        series.left_volume = round(result_nodes[2].result.outputs.out_stat[1], 3)
-        series.right_volume = round(result_nodes[3].result.outputs.out_stat[1], 3)
-        series.whole_brain_volume = round(result_nodes[4].result.outputs.out_stat[1], 3)
-        series.status = "ok"
-    except TimeoutError:
-        series.status = "timeout"
-    except RuntimeError:
-        series.status = "runtime error"
 
-    paths_to_delete = set(glob(os.path.join(nifti_dir, "*"))) - set(glob(os.path.join(nifti_dir, "*.nii.gz")))
-    for path in paths_to_delete:
-        if os.path.isdir(path):
-            shutil.rmtree(path)
-        else:
-            os.remove(path)
+class _ChildUsageMixin:
+    """
+    Замеряем время CPU и пик памяти команд FSL, запущенных узлом. Узел выполняется в отдельном процессе пула
+    nipype, поэтому приращение RUSAGE_CHILDREN этого процесса относится только к командам узла.
+    """
+
+    def _run_interface(self, runtime, *args, **kwargs):
+        usage_started = resource.getrusage(resource.RUSAGE_CHILDREN)
+        runtime = super()._run_interface(runtime, *args, **kwargs)
+        usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+
+        runtime.fsl_cpu_time = usage.ru_utime + usage.ru_stime - usage_started.ru_utime - usage_started.ru_stime
+
+        # ru_maxrss - максимум по всем дочерним процессам за время жизни процесса пула,
+        # поэтому пик памяти команд узла известен, только если этот максимум вырос
+        if usage.ru_maxrss > usage_started.ru_maxrss:
+            runtime.fsl_peak_rss_mb = usage.ru_maxrss / 1024
+
+        return runtime
 
-    series_data.insert(series, series_id)
-    PatientCollection.save_data(series_data, patient_id)
 
+class _BET(_ChildUsageMixin, fsl.BET):
+    pass
 
-def _convert_series(series_dir: str, nifti_path: str, series_desc: str) -> None:
+
+class _FIRST(_ChildUsageMixin, fsl.FIRST):
+    pass
+
+
+def _run_workflow(workflow: Workflow, plugin_args: Dict[str, Any], timeout_value: int,
+                  on_node_event: Callable[[str, str], None],
+                  cancel_event: threading.Event = None) -> Dict[str, InterfaceResult]:
     """
-    Конвертируем DICOM серию в формат NIFTI.
+    Запускаем workflow в дочернем процессе. Переходы узлов (start, end, exception), которые nipype сообщает
+    через status_callback, передаются в текущий процесс через очередь. Возвращаем результаты узлов по их именам.
+
+    Дочерний процесс становится лидером своей группы процессов. По таймауту, отмене или любому выходу
+    отсюда убиваем всю группу, включая процессы FSL, запущенные nipype MultiProc.
     """
-    nifti_dir = os.path.dirname(nifti_path)
+    # воркер анализа многопоточный (продление аренды), поэтому процесс запуска порождаем через forkserver, а не fork
+    context = multiprocessing.get_context("forkserver")
+    events = context.Queue()
+    process = context.Process(target=_workflow_process,
+                              args=(workflow, plugin_args, current_app.config["NIPYPE_CONFIG"], events), daemon=False)
+    process.start()
 
-    if not os.path.isdir(nifti_dir):
-        os.makedirs(nifti_dir, exist_ok=True)
+    deadline = time.monotonic() + timeout_value
 
     try:
-        dicom_series_to_nifti(series_dir, nifti_path)
-        flash(Markup(f"Серия: <b>{series_desc}</b> успешно сохранена"))
-    except (ConversionValidationError, ConversionError) as e:
-        flash(str(e))
-        shutil.rmtree(nifti_dir)
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise TimeoutError(f"Workflow {workflow.name} timed out after {timeout_value} seconds")
+
+            if cancel_event is not None and cancel_event.is_set():
+                raise _AnalysisCancelled(f"Workflow {workflow.name} cancelled")
+
+            try:
+                kind, payload = events.get(timeout=min(remaining, 1))
+            except queue.Empty:
+                if not process.is_alive():
+                    raise RuntimeError(f"Workflow process exited with code {process.exitcode}")
+                continue
+
+            if kind == "node":
+                on_node_event(*payload)
+            elif kind == "error":
+                raise RuntimeError(payload)
+            else:
+                return payload
+    finally:
+        _kill_process_group(process)
+
+
+def _workflow_process(workflow: Workflow, plugin_args: Dict[str, Any], settings: Dict[str, Any],
+                      events: multiprocessing.Queue) -> None:
+    os.setsid()
+
+    # процесс из forkserver не наследует настройки nipype из create_app. Сам он однопоточный,
+    # поэтому процессы MultiProc можно безопасно порождать через fork
+    nipype_config.update_config(settings)
+    nipype_logging.update_logging(nipype_config)
+    multiprocessing.set_start_method("fork", force=True)
+
+    def status_callback(node: Node, node_status: str) -> None:
+        events.put(("node", (node.name, node_status)))
+
+    try:
+        result_graph = workflow.run(plugin="MultiProc", plugin_args=dict(plugin_args, status_callback=status_callback))
+        events.put(("result", {node.name: node.result for node in result_graph.nodes}))
+    except Exception as e:
+        events.put(("error", repr(e)))
 
 
-def _archive_series(series_dir: str) -> str:
+def _kill_process_group(process: multiprocessing.Process, grace_period: float = 5) -> None:
     """
-    Для экономии места на диске архивируем DICOM папку-серию.
+    Завершаем группу процессов запуска: сначала SIGTERM, затем SIGKILL тем, кто не успел завершиться.
+    Группа существует, пока в ней есть хотя бы один процесс, даже если ее лидер уже завершился.
     """
-    archive_path = f"{series_dir}.tgz"
+    try:
+        os.killpg(process.pid, signal.SIGTERM)
+    except ProcessLookupError:
+        # дочерний процесс мог еще не успеть создать свою группу
+        if process.is_alive():
+            process.terminate()
+        process.join()
+        return
 
-    with tarfile.open(archive_path, "w:gz") as _tar:
-        _tar.add(series_dir, arcname=os.path.basename(series_dir))
+    process.join(grace_period)
+
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+
+    process.join()
 
-    shutil.rmtree(series_dir)
 
-    return archive_path
+def _node_metrics(node_result: InterfaceResult, run_started: datetime) -> Dict[str, Any]:
+    """
+    Собираем время и ресурсы, затраченные узлом nipype. Время CPU и пик памяти команд FSL замеряет _ChildUsageMixin,
+    пик памяти всего дерева процессов и загрузку CPU пишет монитор ресурсов nipype.
+    Узел, результат которого взят из прошлого запуска, помечаем как reused.
+    """
+    runtime = node_result.runtime
+    wall_time = getattr(runtime, "duration", None)
+    cpu_time = getattr(runtime, "fsl_cpu_time", None)
+    cpu_percent = getattr(runtime, "cpu_percent", None)
+    end_time = getattr(runtime, "endTime", None)
+
+    # монитор ресурсов учитывает сумму памяти всех процессов узла, поэтому его значение точнее
+    mem_peak_gb = getattr(runtime, "mem_peak_gb", None)
+    peak_rss_mb = mem_peak_gb * 1024 if mem_peak_gb is not None else getattr(runtime, "fsl_peak_rss_mb", None)
+
+    return {
+        "wall_time": round(wall_time, 3) if wall_time is not None else None,
+        "cpu_time": round(cpu_time, 3) if cpu_time is not None else None,
+        "peak_rss_mb": round(peak_rss_mb, 1) if peak_rss_mb is not None else None,
+        "peak_cpu_percent": round(cpu_percent, 1) if cpu_percent is not None else None,
+        "reused": end_time is not None and isoparse(end_time) < run_started,
+    }
+
+
+def _thread_cpu_time() -> float:
+    """
+    Время CPU текущего потока: в процессе воркера параллельно идут другие анализы.
+    time.thread_time есть только с Python 3.7, поэтому берем getrusage, а без RUSAGE_THREAD (не Linux) - время процесса
+    """
+    usage = resource.getrusage(getattr(resource, "RUSAGE_THREAD", resource.RUSAGE_SELF))
+    return usage.ru_utime + usage.ru_stime
 
 
-def _make_series_images(slice_paths: List[str], dir_path: str) -> None:
+def _make_views(storage: Storage, nifti_dir: str, nifti_path: str, segmentation_path: str) -> Dict[str, Any]:
     """
-    Отберем на примерно одинаковом расстоянии друг от друга срезы из переданного списка и
-    сохраним в отдельной папке их изображения.
+    Рисуем и сохраняем виды с наложенной сегментацией сразу после анализа, пока снимки лежат на локальном диске
     """
+    wall_started, cpu_started = time.perf_counter(), _thread_cpu_time()
 
-    dir_path_ = os.path.join(current_app.static_folder, dir_path)
+    config = current_app.config
+    images = render_views(nifti_path, segmentation_path, config["SERIES_IMG_SIZE"], config["SERIES_IMG_CLIP_PERCENT"],
+                          config["SEGMENTATION_OVERLAY_ALPHA"])
+    store_views(storage, nifti_dir, images)
 
-    if not os.path.isdir(dir_path_):
-        os.makedirs(dir_path_, exist_ok=True)
+    return {"wall_time": round(time.perf_counter() - wall_started, 3),
+            "cpu_time": round(_thread_cpu_time() - cpu_started, 3), "reused": False}
 
-    img_ext = current_app.config["SERIES_IMG_EXT"]
 
-    if len(slice_paths) <= 10:
-        paths_ = slice_paths
+def _parse_slices(slice_paths: Iterable[str]) -> Iterator[Tuple[ParsedSlice, __SeriesInfo, __SliceInfo, str]]:
+    """
+    Разбираем заголовки срезов в пуле процессов. Результаты (и сообщения об ошибках) отдаем
+    в том же порядке, в каком переданы файлы.
+
+    Пути могут приходить генератором: executor.map отправляет каждый путь в пул сразу, как только он получен.
+    """
+    workers = current_app.config["INGEST_WORKERS"]
+
+    if isinstance(slice_paths, list):
+        if workers <= 1 or len(slice_paths) < 2 * workers:
+            yield from map(_parse_slice, slice_paths)
+            return
+
+        chunk_size = max(1, len(slice_paths) // (workers * 4))
     else:
-        indices = list(np.linspace(0, len(slice_paths) - 1, num=10, dtype=np.int))
-        paths_ = itemgetter(*indices)(slice_paths)
+        if workers <= 1:
+            yield from map(_parse_slice, slice_paths)
+            return
+
+        # количество срезов заранее неизвестно, поэтому отправляем их в пул по одному
+        chunk_size = 1
+
+    yield from _pool_map(_parse_slice, slice_paths, chunk_size)
+
+
+def _parse_slice(slice_path: str) -> Tuple[ParsedSlice, __SeriesInfo, __SliceInfo, str]:
+    """
+    Разбираем один срез. Выполняется в процессах пула, поэтому не обращается к flask и возвращает ошибку текстом.
+    """
+    try:
+        parsed_slice = ParsedSlice(slice_path)
+        series_info, slice_info = _get_info_from_slice(parsed_slice)
+
+        # хэш нужен для проверки дублей, считаем его здесь, пока файл в кэше ОС и параллельно с другими срезами
+        parsed_slice.content_hash
+    except AssertionError as e:
+        return None, None, None, str(e)
+    except InvalidDicomError:
+        return None, None, None, f"Файл <b>{os.path.basename(slice_path)}</b> не формата DICOM"
+
+    return parsed_slice, series_info, slice_info, None
+
+
+def _store_all_series(tasks: List[_SeriesTask]) -> Iterator[_SeriesResult]:
+    """
+    Сохраняем серии в пуле процессов. Результаты отдаем в порядке заданий.
+    """
+    workers = min(current_app.config["INGEST_WORKERS"], len(tasks))
+
+    if workers <= 1:
+        yield from map(_store_series, tasks)
+        return
+
+    yield from _pool_map(_store_series, tasks)
+
+
+def _pool_map(func: Callable, items: Iterable, chunk_size: int = 1) -> Iterator:
+    """
+    Выполняем func над items в пуле процессов загрузки. Пул общий для всех загрузок процесса и создается один раз,
+    поэтому тяжелые модули не импортируются заново на каждую загрузку. Процессы пула порождает forkserver
+    (см. create_app). Если процесс пула упал, то пул больше не принимает задачи: сбрасываем его,
+    и следующая загрузка создаст новый.
+    """
+    global _ingest_executor
+
+    with _ingest_executor_lock:
+        if _ingest_executor is None:
+            _ingest_executor = ProcessPoolExecutor(max_workers=current_app.config["INGEST_WORKERS"])
+        executor = _ingest_executor
+
+    try:
+        yield from executor.map(func, items, chunksize=chunk_size)
+    except BrokenProcessPool:
+        with _ingest_executor_lock:
+            if _ingest_executor is executor:
+                _ingest_executor = None
+        raise
+
+
+def _store_series(task: _SeriesTask) -> _SeriesResult:
+    """
+    Сохраняем одну серию: DICOM архив и NIFTI. Выполняется в процессах пула, поэтому
+    не обращается к flask, а возвращает результат с сообщениями для клиента.
+
+    Любая ошибка (битый срез, сбой хранилища) отклоняет только эту серию, остальные серии загрузки сохраняются.
+    """
+    try:
+        return _store_series_slices(task)
+    except Exception as e:
+        # отложенные срезы, как и при ошибке конвертации, удаляем вместе с рабочей папкой серии:
+        # они могли уже переехать в нее или быть причиной ошибки
+        shutil.rmtree(task.series_dir, ignore_errors=True)
+
+        try:
+            task.storage.delete_prefix(task.pending_prefix)
+
+            # у новой серии нет записи в БД, поэтому ее частично записанные NIFTI и архив никому не нужны
+            if task.stored_archive is None:
+                task.storage.delete_prefix(os.path.dirname(task.nifti_path))
+                task.storage.delete(f"{task.series_dir}{ARCHIVE_EXT}")
+        except Exception:
+            pass
+
+        # индекс срезов серии очищаем: дубли срезов сохраненной серии все равно отсекаются по SOPInstanceUID
+        message = f"Серию <b>{task.series_info.desc}</b> не удалось сохранить ({escape(repr(e))}), " \
+                  f"загрузите ее срезы повторно"
+        return _SeriesResult("rejected", None, None, [message], [])
+
+
+def _store_series_slices(task: _SeriesTask) -> _SeriesResult:
+    """
+    Отложенные срезы неполной серии лежат в общем хранилище, поэтому серию можно дозагрузить через любой веб-узел.
+    Работаем с их локальными копиями во временной папке
+    """
+    work_dir = os.path.dirname(task.series_dir)
+    os.makedirs(work_dir, exist_ok=True)
+
+    pending_dir = tempfile.mkdtemp(dir=work_dir)
+    try:
+        return _merge_series_slices(task, pending_dir)
+    finally:
+        shutil.rmtree(pending_dir, ignore_errors=True)
+
+
+def _merge_series_slices(task: _SeriesTask, pending_dir: str) -> _SeriesResult:
+    """
+    Новые срезы объединяем с уже сохраненными срезами серии (из архива) и отложенными срезами неполной серии.
+    """
+    desc = task.series_info.desc
+
+    stored_slices = _load_stored_slices(task.storage, task.stored_archive, task.series_dir)
+    pending_slices = _load_pending_slices(task.storage, task.pending_prefix, pending_dir)
+    kept_entries = _index_entries(stored_slices, False) + _index_entries(pending_slices, True)
+
+    # серии, сохраненные до появления индекса срезов, в нем отсутствуют, поэтому дубли проверяем еще раз
+    sop_uids = {parsed_slice.sop_uid for parsed_slice in stored_slices + pending_slices}
+    new_slices = []
+    for parsed_slice in task.slices:
+        if parsed_slice.sop_uid not in sop_uids:
+            sop_uids.add(parsed_slice.sop_uid)
+            new_slices.append(parsed_slice)
+
+    if not new_slices:
+        _discard_extracted(task)
+        return _SeriesResult("rejected", None, None, [f"Серия <b>{desc}</b> уже хранится в системе"], kept_entries)
+
+    slices = sorted(stored_slices + pending_slices + new_slices,
+                    key=lambda parsed_slice: int(parsed_slice.header.InstanceNumber))
+
+    missing = _missing_numbers(slices)
+    if missing:
+        _discard_extracted(task)
+
+        # в индекс срезы попадают после возврата результата, то есть уже после записи в хранилище
+        for parsed_slice in new_slices:
+            task.storage.put_file(os.path.join(task.pending_prefix, f"{parsed_slice.content_hash}.dcm"),
+                                  parsed_slice.path, move=True)
+
+        message = f"Серия <b>{desc}</b> загружена не полностью, не хватает срезов под номерами " \
+                  f"<b>{_format_numbers(missing)}</b>. Серия будет сохранена после загрузки недостающих срезов"
+        return _SeriesResult("pending", None, None, [message], kept_entries + _index_entries(new_slices, True))
+
+    try:
+        _validate_series(slices)
+    except AssertionError as e:
+        _discard_extracted(task)
+        return _SeriesResult("rejected", None, None, [str(e).format(desc)], None)
+
+    _move_series(slices, task.series_dir)
+
+    # NIFTI собираем во временной папке и кладем в хранилище только после успешной конвертации,
+    # поэтому NIFTI уже сохраненной серии при ошибке не пострадает
+    tmp_dir = tempfile.mkdtemp(dir=os.path.dirname(task.series_dir))
+    try:
+        tmp_nifti_path = os.path.join(tmp_dir, os.path.basename(task.nifti_path))
+        converted, message = _convert_series(slices, task.series_dir, tmp_nifti_path, desc)
+        if converted:
+            task.storage.put_file(task.nifti_path, tmp_nifti_path, move=True)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    if not converted:
+        # отложенные срезы удаляем вместе с папкой серии, архив сохраненной серии не меняется
+        shutil.rmtree(task.series_dir, ignore_errors=True)
+        task.storage.delete_prefix(task.pending_prefix)
+        return _SeriesResult("rejected", None, None, [message], _index_entries(stored_slices, False))
+
+    if task.stored_archive is not None:
+        # результаты анализа получены по прежнему снимку
+        for name in cache.CACHED_FILES:
+            task.storage.delete(os.path.join(os.path.dirname(task.nifti_path), name))
+        delete_views(task.storage, os.path.dirname(task.nifti_path))
+
+        message = f"В серию <b>{desc}</b> добавлено срезов: <b>{len(slices) - len(stored_slices)}</b>"
+
+    archive_path = _archive_series(task.series_dir, task.storage, task.archive_threads)
+    task.storage.delete_prefix(task.pending_prefix)
+
+    # старый архив .tgz заменен архивом нового формата
+    if task.stored_archive is not None and task.stored_archive != archive_path:
+        task.storage.delete(task.stored_archive)
+
+    state = "stored" if task.stored_archive is None else "merged"
+    return _SeriesResult(state, archive_path, len(slices), [message], _index_entries(slices, False))
+
+
+def _load_stored_slices(storage: Storage, archive_key: str, series_dir: str) -> List[ParsedSlice]:
+    """
+    Распаковываем архив сохраненной серии из хранилища в ее папку и разбираем срезы
+    """
+    if archive_key is None:
+        return []
+
+    extract_series(storage, archive_key, series_dir)
+
+    return _load_slices(series_dir)
+
+
+def _load_pending_slices(storage: Storage, prefix: str, dir_path: str) -> List[ParsedSlice]:
+    """
+    Разбираем локальные копии отложенных срезов серии из хранилища
+    """
+    return [ParsedSlice(storage.local_copy(key, os.path.join(dir_path, os.path.basename(key))))
+            for key in storage.list(prefix)]
+
+
+def _load_slices(dir_path: str) -> List[ParsedSlice]:
+    if not os.path.isdir(dir_path):
+        return []
+
+    return [ParsedSlice(os.path.join(dir_path, name)) for name in os.listdir(dir_path)]
 
-    for path in paths_:
-        header = pydicom.read_file(path)
-        img_path = os.path.join(dir_path_, str(header.InstanceNumber)) + img_ext
-        figure = plt.figure(figsize=(10, 10))
-        plt.imshow(header.pixel_array, 'gray')
-        plt.xticks([])
-        plt.yticks([])
-        plt.gca().set_axis_off()
-        plt.savefig(img_path, bbox_inches='tight', pad_inches=0)
-        plt.close(figure)
 
+def _discard_extracted(task: _SeriesTask) -> None:
+    """
+    Удаляем распакованную копию сохраненной серии: сам архив при этом не меняется
+    """
+    if task.stored_archive is not None:
+        shutil.rmtree(task.series_dir, ignore_errors=True)
+
+
+def _missing_numbers(slices: List[ParsedSlice]) -> List[int]:
+    numbers = {int(parsed_slice.header.InstanceNumber) for parsed_slice in slices}
+    return sorted(set(range(1, max(numbers) + 1)) - numbers)
+
+
+def _format_numbers(numbers: List[int], limit: int = 10) -> str:
+    text = ", ".join(str(number) for number in numbers[:limit])
+    return text if len(numbers) <= limit else f"{text} и еще {len(numbers) - limit}"
+
+
+def _index_entries(slices: List[ParsedSlice], pending: bool) -> List[Dict[str, Any]]:
+    return [{"sop_uid": parsed_slice.sop_uid, "content_hash": parsed_slice.content_hash,
+             "instance_number": int(parsed_slice.header.InstanceNumber), "pending": pending}
+            for parsed_slice in slices]
+
+
+def _pending_prefix(patient_id: str, series_id: str) -> str:
+    return os.path.join(current_app.config['DICOM_FOLDER'], patient_id, "pending", series_id)
+
+
+def _convert_series(slices: List[ParsedSlice], series_dir: str, nifti_path: str, series_desc: str) -> Tuple[bool, str]:
+    """
+    Конвертируем DICOM серию в формат NIFTI. Возвращаем признак успеха и сообщение для клиента.
+
+    Обычную серию (однокадровые срезы одного размера) собираем сами из уже разобранных и отсортированных срезов.
+    Остальные случаи (мультикадровые, мозаики Siemens и т.д.) отдаем dicom2nifti, который перечитывает папку.
+    """
+    try:
+        if _is_simple_series(slices):
+            _assemble_nifti(slices, nifti_path)
+        else:
+            dicom_series_to_nifti(series_dir, nifti_path)
+        return True, f"Серия: <b>{series_desc}</b> успешно сохранена"
+    except (ConversionValidationError, ConversionError) as e:
+        if os.path.isfile(nifti_path):
+            os.remove(nifti_path)
+        return False, str(escape(str(e)))
+
+
+def _is_simple_series(slices: List[ParsedSlice]) -> bool:
+    """
+    Проверяем, что серию можно собрать напрямую: геометрия уже проверена в _validate_series,
+    остается убедиться, что все срезы - однокадровые полутоновые изображения одного размера.
+    """
+    first_header = slices[0].header
+
+    # шаг между срезами по одному срезу не определить
+    if len(slices) < 2 or "PixelSpacing" not in first_header:
+        return False
+
+    for parsed_slice in slices:
+        header = parsed_slice.header
 
-def _get_info_from_slice(slice_path: str) -> Tuple[__SeriesInfo, __SliceInfo]:
+        if int(header.get("NumberOfFrames", 1) or 1) != 1 or int(header.get("SamplesPerPixel", 1)) != 1:
+            return False
+
+        if "MOSAIC" in header.get("ImageType", []):
+            return False
+
+        if (header.Rows, header.Columns) != (first_header.Rows, first_header.Columns):
+            return False
+
+    return True
+
+
+def _assemble_nifti(slices: List[ParsedSlice], nifti_path: str) -> None:
+    """
+    Собираем NIFTI из срезов: пиксели складываем в заранее выделенный массив, аффинную матрицу строим по
+    ориентации и позициям срезов так же, как dicom2nifti (с переходом из LPS DICOM в RAS NIFTI),
+    и переориентируем объем в LAS, как это делает dicom2nifti.
+    https://github.com/icometrix/dicom2nifti/blob/6b8aeb0f291df57ea47aa2d945db84d6ff568903/dicom2nifti/common.py#L605
+    """
+    orientations, positions = _stack_geometry(slices)
+    first_header = slices[0].header
+
+    row_spacing, column_spacing = (float(value) for value in first_header.PixelSpacing)
+    orientation1, orientation2 = orientations[0, 0:3], orientations[0, 3:6]
+    step = (positions[-1] - positions[0]) / (len(slices) - 1)
+
+    affine = np.eye(4)
+    affine[:3, 0] = orientation1 * column_spacing
+    affine[:3, 1] = orientation2 * row_spacing
+    affine[:3, 2] = step
+    affine[:3, 3] = positions[0]
+    affine[:2, :] *= -1
+
+    first_pixels = slices[0].pixel_array
+    volume = np.empty((first_pixels.shape[1], first_pixels.shape[0], len(slices)), dtype=first_pixels.dtype)
+
+    # пиксели DICOM хранятся как (строка, столбец), а в NIFTI первая ось - столбец
+    for num, parsed_slice in enumerate(slices):
+        volume[:, :, num] = parsed_slice.pixel_array.T
+        parsed_slice.release_pixels()
+
+    slopes = np.array([float(parsed_slice.header.get("RescaleSlope", 1)) for parsed_slice in slices])
+    intercepts = np.array([float(parsed_slice.header.get("RescaleIntercept", 0)) for parsed_slice in slices])
+
+    if np.any(slopes != 1) or np.any(intercepts != 0):
+        volume = volume.astype(np.float32) * slopes.astype(np.float32) + intercepts.astype(np.float32)
+
+    transform = nib.orientations.ornt_transform(nib.orientations.io_orientation(affine),
+                                                nib.orientations.axcodes2ornt(("L", "A", "S")))
+    volume = nib.orientations.apply_orientation(volume, transform)
+    affine = affine.dot(nib.orientations.inv_ornt_aff(transform, volume.shape))
+
+    image = nib.Nifti1Image(volume, affine)
+    image.set_qform(affine, code=1)
+    image.set_sform(affine, code=1)
+    nib.save(image, nifti_path)
+
+
+def _archive_series(series_dir: str, storage: Storage, threads: int) -> str:
+    """
+    Для экономии места на диске архивируем DICOM папку-серию и кладем архив в хранилище. Срезы сжимаются
+    по отдельности, поэтому любой срез потом читается из архива без распаковки остальных.
+    """
+    archive_key = f"{series_dir}{ARCHIVE_EXT}"
+
+    with storage.open_write(archive_key) as out:
+        write_archive(series_dir, out, threads)
+
+    shutil.rmtree(series_dir)
+
+    return archive_key
+
+
+def _get_info_from_slice(parsed_slice: ParsedSlice) -> Tuple[__SeriesInfo, __SliceInfo]:
     """
     Вытаскиваем информацию из среза. Перед этим проверяем на наличие необходимых для конвертации тегов.
     """
-    slice_name = os.path.basename(slice_path)
-    header = pydicom.read_file(slice_path)
+    slice_name = parsed_slice.name
+    header = parsed_slice.header
 
+    assert "SOPInstanceUID" in header, f"В снимке <b>{slice_name}</b> должен быть тег <b>SOPInstanceUID</b>"
     assert "SeriesInstanceUID" in header, f"В снимке <b>{slice_name}</b> должен быть тег <b>SeriesInstanceUID</b>"
     assert "SeriesDescription" in header, f"В снимке <b>{slice_name}</b> должен быть тег <b>SeriesDescription</b>"
     assert "SeriesTime" in header, f"В снимке <b>{slice_name}</b> должен быть тег <b>SeriesTime</b>"
@@ -310,75 +1080,82 @@ def _get_info_from_slice(slice_path: str) -> Tuple[__SeriesInfo, __SliceInfo]:
     return series_info, slice_info
 
 
-def _move_series(slice_paths: List[str], series_dir: str) -> None:
+def _move_series(slices: List[ParsedSlice], series_dir: str) -> None:
     """
     Мувим срезы из временной папки в папку для хранения DICOM серий.
     """
     if not os.path.isdir(series_dir):
         os.makedirs(series_dir, exist_ok=True)
 
-    for slice_path in slice_paths:
-        slice_name = os.path.basename(slice_path)
-        new_slice_path = os.path.join(series_dir, slice_name)
-        shutil.move(slice_path, new_slice_path)
+    for parsed_slice in slices:
+        new_path = os.path.join(series_dir, parsed_slice.name)
+
+        if parsed_slice.path == new_path:
+            continue
+
+        # срезы разных загрузок могут называться одинаково, а SOPInstanceUID уникален
+        if os.path.exists(new_path):
+            new_path = os.path.join(series_dir, f"{secure_filename(parsed_slice.sop_uid)}.dcm")
 
+        parsed_slice.move(new_path)
 
-def _validate_series(slice_paths: List[str]) -> None:
+
+def _validate_series(slices: List[ParsedSlice]) -> None:
     """
-    Проверяем, что кол-во срезов достаточно для создания выразительной серии
+    Проверяем геометрию серии целиком на массивах (N,6) ориентаций и (N,3) позиций срезов:
+    количество срезов, пропуски в нумерации, одинаковую ориентацию, ортогональность и равномерный шаг срезов.
+    Проверки повторяют проверки dicom2nifti, чтобы серия не падала позже при конвертации
     https://github.com/icometrix/dicom2nifti/blob/6b8aeb0f291df57ea47aa2d945db84d6ff568903/dicom2nifti/common.py#L675
     """
-    assert len(slice_paths) >= 4, "Количество загружаемых срезов в серии <b>{}</b> должно быть не меньше 4"
-
-    first_image_orientation1, first_image_orientation2 = None, None
+    assert len(slices) >= 4, "Количество загружаемых срезов в серии <b>{}</b> должно быть не меньше 4"
 
-    for curr_slice_num, slice_path in enumerate(slice_paths, 1):
-        header = pydicom.read_file(slice_path)
+    numbers = np.array([int(parsed_slice.header.InstanceNumber) for parsed_slice in slices])
+    mismatched = np.flatnonzero(numbers != np.arange(1, len(slices) + 1))
+    missing_num = mismatched[0] + 1 if mismatched.size else None
+    assert missing_num is None, f"В серии <b>{{}}</b> не хватает среза под номером <b>{missing_num}</b>"
 
-        slice_num = int(header.InstanceNumber)
-        assert slice_num == curr_slice_num, f"В серии <b>{{}}</b> не хватает среза под номером <b>{curr_slice_num}</b>"
+    orientations, positions = _stack_geometry(slices)
 
-        """
-        Проверяем, что все срезы имеют одинаковую ориентацию
-        https://github.com/icometrix/dicom2nifti/blob/6b8aeb0f291df57ea47aa2d945db84d6ff568903/dicom2nifti/common.py#L688
-        """
+    """
+    Проверяем, что все срезы имеют одинаковую ориентацию
+    https://github.com/icometrix/dicom2nifti/blob/6b8aeb0f291df57ea47aa2d945db84d6ff568903/dicom2nifti/common.py#L688
+    """
+    assert np.allclose(orientations, orientations[0], rtol=0.001, atol=0.001), \
+        "В серии <b>{}</b> значения <b>ImageOrientationPatient</b> неконсистентны"
 
-        if first_image_orientation1 is None:
-            first_image_orientation1 = np.asarray(header.ImageOrientationPatient)[0:3]
-            first_image_orientation2 = np.asarray(header.ImageOrientationPatient)[3:6]
+    steps = np.diff(positions, axis=0)
+    step_lengths = np.linalg.norm(steps, axis=1)
+    assert np.all(step_lengths > 0), "В серии <b>{}</b> есть срезы с совпадающими <b>ImagePositionPatient</b>"
 
-        image_orientation1 = np.asarray(header.ImageOrientationPatient)[0:3]
-        image_orientation2 = np.asarray(header.ImageOrientationPatient)[3:6]
+    assert _is_orthogonal(orientations[0], steps, step_lengths), "Изображение серии <b>{}</b> не 3D"
 
-        is_equal1 = np.allclose(image_orientation1, first_image_orientation1, rtol=0.001, atol=0.001)
-        is_equal2 = np.allclose(image_orientation2, first_image_orientation2, rtol=0.001, atol=0.001)
+    """
+    Проверяем, что шаг между соседними срезами одинаковый
+    https://github.com/icometrix/dicom2nifti/blob/6b8aeb0f291df57ea47aa2d945db84d6ff568903/dicom2nifti/common.py#L728
+    """
+    assert np.allclose(steps, steps[0], rtol=0.01, atol=0.1), "В серии <b>{}</b> расстояние между срезами неравномерно"
 
-        assert is_equal1 and is_equal2, "В серии <b>{}</b> значения <b>ImageOrientationPatient</b> неконсистентны"
 
-    assert _is_orthogonal(slice_paths), "Изображение серии <b>{}</b> не 3D"
+def _stack_geometry(slices: List[ParsedSlice]) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Собираем ImageOrientationPatient и ImagePositionPatient всех срезов в массивы (N,6) и (N,3)
+    """
+    orientations = np.array([parsed_slice.header.ImageOrientationPatient for parsed_slice in slices], dtype=np.float64)
+    positions = np.array([parsed_slice.header.ImagePositionPatient for parsed_slice in slices], dtype=np.float64)
+    return orientations, positions
 
 
-def _is_orthogonal(slice_paths: List[str]) -> bool:
+def _is_orthogonal(orientation: np.ndarray, steps: np.ndarray, step_lengths: np.ndarray) -> bool:
     """
-    Проверяем, что серия ортонормирована
+    Проверяем, что серия ортонормирована: каждый шаг между соседними срезами направлен по нормали к срезу
     https://github.com/icometrix/dicom2nifti/blob/6b8aeb0f291df57ea47aa2d945db84d6ff568903/dicom2nifti/common.py#L550
     """
-    first_header = pydicom.read_file(slice_paths[0])
-    last_header = pydicom.read_file(slice_paths[-1])
-
-    first_image_orientation1 = np.array(first_header.ImageOrientationPatient)[0:3]
-    first_image_orientation2 = np.array(first_header.ImageOrientationPatient)[3:6]
-
-    first_image_position = np.array(first_header.ImagePositionPatient)
-    last_image_position = np.array(last_header.ImagePositionPatient)
-
-    first_image_direction = np.cross(first_image_orientation1, first_image_orientation2)
-    first_image_direction /= np.linalg.norm(first_image_direction)
+    normal = np.cross(orientation[0:3], orientation[3:6])
+    normal /= np.linalg.norm(normal)
 
-    combined_dir = last_image_position - first_image_position
-    combined_dir /= np.linalg.norm(combined_dir)
+    directions = steps / step_lengths[:, np.newaxis]
 
-    check1 = np.allclose(first_image_direction, combined_dir, rtol=0.05, atol=0.05)
-    check2 = np.allclose(first_image_direction, -combined_dir, rtol=0.05, atol=0.05)
+    check1 = np.allclose(directions, normal, rtol=0.05, atol=0.05)
+    check2 = np.allclose(directions, -normal, rtol=0.05, atol=0.05)
 
     return check1 or check2
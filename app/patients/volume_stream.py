@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import shutil
+import hashlib
+import tempfile
+import numpy as np
+import nibabel as nib
+
+from typing import Dict, Any, List
+from flask import current_app
+
+from app.storage import get_storage
+
+__all__ = ["volume_header", "level_path"]
+
+# данные уровня лежат в файле без сжатия в порядке осей (z, y, x) ориентации RAS: аксиальный срез k - это
+# непрерывный кусок файла, который браузер получает одним Range запросом
+_AXES = ["z", "y", "x"]
+
+_HEADER_NAME = "header.json"
+
+
+def volume_header(nifti_key: str, version: str) -> Dict[str, Any]:
+    """
+    Описание несжатой копии объема: тип данных, аффинная матрица и размеры каждого уровня пирамиды.
+    Уровень 0 - исходный объем, каждый следующий уменьшен вдвое по всем осям. Копия строится при первом обращении.
+    """
+    entry_dir = _entry_dir(nifti_key, version)
+
+    try:
+        return _read_header(entry_dir)
+    except FileNotFoundError:
+        # копии нет или ее вытеснил параллельный запрос
+        _build(nifti_key, entry_dir)
+
+    return _read_header(entry_dir)
+
+
+def level_path(nifti_key: str, version: str, level: int) -> str:
+    """
+    Путь к несжатому файлу уровня пирамиды. Если уровня нет - IndexError
+    """
+    header = volume_header(nifti_key, version)
+    if not 0 <= level < len(header["levels"]):
+        raise IndexError(f"Pyramid level {level} does not exist")
+
+    entry_dir = _entry_dir(nifti_key, version)
+    path = os.path.join(entry_dir, _level_name(level))
+
+    # копию могут вытеснять прямо сейчас: описание еще на месте, а файлов уровней уже нет
+    if not os.path.isfile(path):
+        _build(nifti_key, entry_dir)
+
+    return path
+
+
+def _read_header(entry_dir: str) -> Dict[str, Any]:
+    # время изменения папки служит временем последнего обращения
+    os.utime(entry_dir)
+
+    with open(os.path.join(entry_dir, _HEADER_NAME)) as f:
+        return json.load(f)
+
+
+def _is_complete(entry_dir: str) -> bool:
+    try:
+        with open(os.path.join(entry_dir, _HEADER_NAME)) as f:
+            header = json.load(f)
+    except FileNotFoundError:
+        return False
+
+    return all(os.path.isfile(os.path.join(entry_dir, _level_name(level["level"]))) for level in header["levels"])
+
+
+def _build(nifti_key: str, entry_dir: str) -> None:
+    """
+    Распаковываем NIFTI один раз и сохраняем уровни пирамиды рядом без сжатия. Копию собираем во временной папке
+    и переименовываем, чтобы параллельный запрос не увидел недописанные файлы. Недоудаленную при вытеснении
+    копию заменяем новой.
+    """
+    parent_dir = os.path.dirname(entry_dir)
+    os.makedirs(parent_dir, exist_ok=True)
+    tmp_dir = tempfile.mkdtemp(dir=parent_dir, prefix=".tmp_")
+
+    try:
+        local_path = get_storage().local_copy(nifti_key, os.path.join(tmp_dir, os.path.basename(nifti_key)))
+        nifti = nib.as_closest_canonical(nib.load(local_path))
+
+        values = np.asanyarray(nifti.dataobj)
+        if values.ndim > 3:
+            values = values.reshape(values.shape[:3] + (-1,))[..., 0]
+
+        # масштабированные nibabel данные приходят в float64, браузеру хватит float32
+        if values.dtype == np.float64:
+            values = values.astype(np.float32)
+        dtype = values.dtype.newbyteorder("<")
+
+        levels = []
+        affine = nifti.affine
+        for level, data in enumerate(_pyramid(values, current_app.config["VOLUME_PYRAMID_MIN_SIZE"])):
+            # (x, y, z) -> (z, y, x), чтобы аксиальные срезы были непрерывными
+            level_data = np.ascontiguousarray(data.transpose(2, 1, 0), dtype=dtype)
+            level_data.tofile(os.path.join(tmp_dir, _level_name(level)))
+
+            # воксель уровня - блок factor^3 вокселей исходного объема, его центр смещен на (factor - 1) / 2
+            factor = 2 ** level
+            level_affine = affine.dot(np.diag([factor, factor, factor, 1]))
+            level_affine[:3, 3] = affine[:3, :3].dot([(factor - 1) / 2] * 3) + affine[:3, 3]
+
+            levels.append({
+                "level": level,
+                "shape": [int(dim) for dim in data.shape[::-1]],
+                "slice_bytes": int(data.shape[0] * data.shape[1] * dtype.itemsize),
+                "affine": level_affine.tolist(),
+            })
+
+        # локальное хранилище отдает путь к самому NIFTI, скачанную же копию в кэше не держим
+        if os.path.dirname(local_path) == tmp_dir:
+            os.remove(local_path)
+
+        header = {"dtype": dtype.str, "axes": _AXES, "levels": levels}
+        with open(os.path.join(tmp_dir, _HEADER_NAME), "w") as f:
+            json.dump(header, f)
+
+        if _is_complete(entry_dir):
+            # копию уже собрал параллельный запрос
+            shutil.rmtree(tmp_dir)
+        else:
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            try:
+                os.rename(tmp_dir, entry_dir)
+            except OSError:
+                # копию одновременно с нами собрал и переименовал параллельный запрос
+                if not _is_complete(entry_dir):
+                    raise
+                shutil.rmtree(tmp_dir)
+    except BaseException:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+
+    _evict(current_app.config["VOLUME_CACHE_MAX_SIZE"], entry_dir)
+
+
+def _pyramid(values: np.ndarray, min_size: int) -> List[np.ndarray]:
+    """
+    Уровни пирамиды: каждый следующий - среднее по блокам 2x2x2 предыдущего. Останавливаемся,
+    когда большая сторона уровня стала не больше min_size
+    """
+    levels = [values]
+
+    while max(levels[-1].shape) > min_size and min(levels[-1].shape) >= 2:
+        data = levels[-1]
+        x, y, z = (dim // 2 for dim in data.shape)
+        blocks = data[:x * 2, :y * 2, :z * 2].reshape(x, 2, y, 2, z, 2)
+        levels.append(blocks.mean(axis=(1, 3, 5), dtype=np.float32).astype(values.dtype))
+
+    return levels
+
+
+def _evict(max_size: int, keep_dir: str) -> None:
+    """
+    Удаляем давно не запрошенные копии объемов, если кэш больше max_size. Копию keep_dir, которую только что
+    собрали для текущего запроса, не трогаем, даже если она одна больше max_size
+    """
+    cache_folder = current_app.config["VOLUME_CACHE_FOLDER"]
+
+    entries = []
+    for dir_entry in os.scandir(cache_folder):
+        if not dir_entry.is_dir() or dir_entry.name.startswith(".tmp_"):
+            continue
+
+        # копию мог параллельно удалить другой процесс
+        try:
+            size = sum(file_entry.stat().st_size for file_entry in os.scandir(dir_entry.path))
+            entries.append((dir_entry.stat().st_mtime, size, dir_entry.path))
+        except FileNotFoundError:
+            continue
+
+    total_size = sum(size for _, size, _ in entries)
+
+    for _, size, path in sorted(entries):
+        if total_size <= max_size:
+            break
+
+        if path == keep_dir:
+            continue
+
+        shutil.rmtree(path, ignore_errors=True)
+        total_size -= size
+
+
+def _entry_dir(nifti_key: str, version: str) -> str:
+    name = hashlib.sha1(repr((nifti_key, version)).encode()).hexdigest()
+    return os.path.join(current_app.config["VOLUME_CACHE_FOLDER"], name)
+
+
+def _level_name(level: int) -> str:
+    return f"level{level}.raw"
@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+
+import numpy as np
+import nibabel as nib
+
+from typing import Dict
+
+__all__ = ["FIRST_LABELS", "label_volumes", "brain_volume"]
+
+# метки структур в сегментации FSL FIRST
+# https://fsl.fmrib.ox.ac.uk/fsl/fslwiki/FIRST/UserGuide#Labels
+FIRST_LABELS = {
+    10: "L_Thal", 11: "L_Caud", 12: "L_Puta", 13: "L_Pall", 16: "BrStem", 17: "L_Hipp", 18: "L_Amyg", 26: "L_Accu",
+    49: "R_Thal", 50: "R_Caud", 51: "R_Puta", 52: "R_Pall", 53: "R_Hipp", 54: "R_Amyg", 58: "R_Accu",
+}
+
+
+def label_volumes(segmentation_path: str) -> Dict[str, float]:
+    """
+    Считаем объемы (мм³) всех структур сегментации за один проход по снимку.
+    Заменяет вызовы fslstats -l <label - 0.5> -u <label + 0.5> -V для каждой метки.
+    """
+    image = nib.load(segmentation_path)
+    labels = np.rint(np.asanyarray(image.dataobj)).astype(np.intp).ravel()
+
+    counts = np.bincount(labels[labels > 0])
+    voxel_volume = _voxel_volume(image)
+
+    return {FIRST_LABELS.get(label, str(label)): round(float(counts[label] * voxel_volume), 3)
+            for label in np.flatnonzero(counts)}
+
+
+def brain_volume(brain_path: str) -> float:
+    """
+    Считаем объем (мм³) ненулевых вокселей снимка после BET. Аналог fslstats -V.
+    """
+    image = nib.load(brain_path)
+    count = np.count_nonzero(np.asanyarray(image.dataobj))
+    return round(float(count * _voxel_volume(image)), 3)
+
+
+def _voxel_volume(image: nib.spatialimages.SpatialImage) -> float:
+    return float(abs(np.linalg.det(image.affine[:3, :3])))
@@ -0,0 +1,137 @@
+// Загрузка файлов по кускам с контрольной суммой каждого куска и дозагрузкой после обрыва связи.
+// Идентификатор сессии хранится в localStorage, поэтому загрузка продолжается и после перезагрузки страницы.
+
+var ChunkedUpload = (function () {
+  var MAX_RETRIES = 8;
+
+  function isSupported() {
+    return !!(window.fetch && window.crypto && window.crypto.subtle && window.localStorage);
+  }
+
+  function sleep(ms) {
+    return new Promise(function (resolve) { setTimeout(resolve, ms); });
+  }
+
+  function toHex(buffer) {
+    return Array.prototype.map.call(new Uint8Array(buffer), function (b) {
+      return ('0' + b.toString(16)).slice(-2);
+    }).join('');
+  }
+
+  function request(method, url, csrfToken, body, headers) {
+    var allHeaders = Object.assign({'X-CSRFToken': csrfToken}, headers || {});
+    return fetch(url, {method: method, credentials: 'same-origin', headers: allHeaders, body: body})
+      .then(function (response) {
+        return response.json().then(function (data) {
+          if (!response.ok) {
+            var error = new Error(data.error || response.statusText);
+            error.status = response.status;
+            throw error;
+          }
+          return data;
+        });
+      });
+  }
+
+  // повторяем запрос с нарастающей паузой: ошибки сети и контрольной суммы считаем временными
+  function withRetries(action) {
+    var attempt = 0;
+
+    function run() {
+      return action().catch(function (error) {
+        attempt += 1;
+        if (attempt > MAX_RETRIES || (error.status && error.status !== 400 && error.status < 500)) {
+          throw error;
+        }
+        return sleep(Math.min(30000, 500 * Math.pow(2, attempt))).then(run);
+      });
+    }
+
+    return run();
+  }
+
+  function storageKey(baseUrl, files) {
+    return 'chunked_upload:' + baseUrl + ':' + Array.prototype.map.call(files, function (file) {
+      return file.name + ':' + file.size + ':' + file.lastModified;
+    }).join('|');
+  }
+
+  function openSession(baseUrl, csrfToken, files, key) {
+    var uploadId = localStorage.getItem(key);
+
+    if (uploadId) {
+      return request('GET', baseUrl + '/' + uploadId, csrfToken).catch(function () {
+        localStorage.removeItem(key);
+        return openSession(baseUrl, csrfToken, files, key);
+      });
+    }
+
+    var description = {files: Array.prototype.map.call(files, function (file) {
+      return {name: file.name, size: file.size};
+    })};
+
+    return request('POST', baseUrl, csrfToken, JSON.stringify(description), {'Content-Type': 'application/json'})
+      .then(function (status) {
+        localStorage.setItem(key, status.upload_id);
+        return status;
+      });
+  }
+
+  function sendChunk(baseUrl, csrfToken, status, file, fileIndex, chunkNum) {
+    var start = chunkNum * status.chunk_size;
+    var blob = file.slice(start, Math.min(start + status.chunk_size, file.size));
+
+    return blob.arrayBuffer().then(function (data) {
+      return crypto.subtle.digest('SHA-256', data).then(function (digest) {
+        var url = baseUrl + '/' + status.upload_id + '/' + fileIndex + '/' + chunkNum;
+        return withRetries(function () {
+          return request('PUT', url, csrfToken, data,
+                         {'Content-Type': 'application/octet-stream', 'X-Chunk-Sha256': toHex(digest)});
+        });
+      });
+    });
+  }
+
+  // baseUrl - адрес создания сессии для пациента, onProgress получает долю загруженных кусков
+  function upload(baseUrl, csrfToken, files, onProgress) {
+    var key = storageKey(baseUrl, files);
+
+    return openSession(baseUrl, csrfToken, files, key).then(function (status) {
+      var queue = [];
+      var total = 0;
+
+      status.files.forEach(function (fileStatus, fileIndex) {
+        total += Math.max(1, Math.ceil(fileStatus.size / status.chunk_size));
+        fileStatus.missing.forEach(function (chunkNum) {
+          queue.push([fileIndex, chunkNum]);
+        });
+      });
+
+      var done = total - queue.length;
+
+      // куски отправляем по очереди: на плохом канале параллельные запросы только мешают друг другу
+      var chain = Promise.resolve();
+      queue.forEach(function (item) {
+        chain = chain.then(function () {
+          return sendChunk(baseUrl, csrfToken, status, files[item[0]], item[0], item[1]).then(function () {
+            done += 1;
+            if (onProgress) {
+              onProgress(done / total);
+            }
+          });
+        });
+      });
+
+      return chain.then(function () {
+        return withRetries(function () {
+          return request('POST', baseUrl + '/' + status.upload_id + '/finalize', csrfToken);
+        });
+      }).then(function (result) {
+        localStorage.removeItem(key);
+        return result;
+      });
+    });
+  }
+
+  return {isSupported: isSupported, upload: upload};
+})();
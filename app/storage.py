@@ -0,0 +1,264 @@
+# -*- coding: utf-8 -*-
+
+import os
+import re
+import shutil
+import tempfile
+
+from contextlib import contextmanager
+from typing import BinaryIO, Dict, Iterator, List
+from flask import current_app
+from gridfs import GridFSBucket, NoFile
+from pymongo import MongoClient
+from pymongo.collection import Collection
+
+__all__ = ["Storage", "LocalStorage", "GridFSStorage", "get_storage"]
+
+_CHUNK_SIZE = 1024 * 1024
+
+
+class Storage:
+    """
+    Хранилище артефактов серий: архивов DICOM, NIFTI и картинок срезов.
+    Ключ артефакта - относительный путь через "/", например DICOM_SERIES/<patient_id>/<series_id>.dcmz
+
+    Объект хранилища передается в процессы пула, поэтому должен сериализоваться через pickle.
+    """
+
+    def open_read(self, key: str) -> BinaryIO:
+        """
+        Поток чтения артефакта с поддержкой seek. Если артефакта нет - FileNotFoundError
+        """
+        raise NotImplementedError
+
+    def open_write(self, key: str) -> BinaryIO:
+        """
+        Контекстный менеджер потока записи. Артефакт становится виден читателям целиком и только после выхода
+        из контекста без исключения
+        """
+        raise NotImplementedError
+
+    def exists(self, key: str) -> bool:
+        raise NotImplementedError
+
+    def version(self, key: str) -> str:
+        """
+        Строка, которая меняется при каждой перезаписи артефакта. Если артефакта нет - FileNotFoundError
+        """
+        raise NotImplementedError
+
+    def list(self, prefix: str) -> List[str]:
+        """
+        Ключи артефактов, лежащих непосредственно в "папке" prefix
+        """
+        raise NotImplementedError
+
+    def delete(self, key: str) -> None:
+        raise NotImplementedError
+
+    def delete_prefix(self, prefix: str) -> None:
+        raise NotImplementedError
+
+    def put_file(self, key: str, path: str, move: bool = False) -> None:
+        with open(path, "rb") as src, self.open_write(key) as dst:
+            shutil.copyfileobj(src, dst, _CHUNK_SIZE)
+
+        if move:
+            os.remove(path)
+
+    def copy(self, src_key: str, dst_key: str) -> None:
+        """
+        Копируем артефакт под другим ключом. Если исходного артефакта нет - FileNotFoundError
+        """
+        with self.open_read(src_key) as src, self.open_write(dst_key) as dst:
+            shutil.copyfileobj(src, dst, _CHUNK_SIZE)
+
+    def local_copy(self, key: str, path: str) -> str:
+        """
+        Путь к локальному файлу с содержимым артефакта для библиотек, которые читают только файлы (nibabel, FSL).
+        По умолчанию артефакт скачивается в path
+        """
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+
+        with self.open_read(key) as src, open(path, "wb") as dst:
+            shutil.copyfileobj(src, dst, _CHUNK_SIZE)
+
+        return path
+
+
+class LocalStorage(Storage):
+    """
+    Хранилище на локальном диске. Ключ - путь относительно root, кроме ключей, начинающихся с префиксов из mounts:
+    они лежат относительно своей папки (картинки срезов лежат в static приложения)
+    """
+
+    def __init__(self, root: str = "", mounts: Dict[str, str] = None) -> None:
+        self.root = root
+        self.mounts = mounts or {}
+
+    def path(self, key: str) -> str:
+        for prefix, base_dir in self.mounts.items():
+            if key == prefix or key.startswith(prefix + "/"):
+                return os.path.join(base_dir, key)
+
+        return os.path.join(self.root, key)
+
+    def open_read(self, key: str) -> BinaryIO:
+        return open(self.path(key), "rb")
+
+    @contextmanager
+    def open_write(self, key: str) -> Iterator[BinaryIO]:
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp_")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                yield f
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+    def exists(self, key: str) -> bool:
+        return os.path.isfile(self.path(key))
+
+    def version(self, key: str) -> str:
+        stat = os.stat(self.path(key))
+        return f"{stat.st_mtime_ns:x}-{stat.st_size:x}"
+
+    def list(self, prefix: str) -> List[str]:
+        dir_path = self.path(prefix)
+        if not os.path.isdir(dir_path):
+            return []
+
+        return [f"{prefix}/{name}" for name in os.listdir(dir_path)
+                if not name.startswith(".tmp_") and os.path.isfile(os.path.join(dir_path, name))]
+
+    def delete(self, key: str) -> None:
+        if os.path.isfile(self.path(key)):
+            os.remove(self.path(key))
+
+    def delete_prefix(self, prefix: str) -> None:
+        shutil.rmtree(self.path(prefix), ignore_errors=True)
+
+    def put_file(self, key: str, path: str, move: bool = False) -> None:
+        dst_path = self.path(key)
+        if os.path.abspath(path) == os.path.abspath(dst_path):
+            return
+
+        if not move:
+            super().put_file(key, path)
+            return
+
+        os.makedirs(os.path.dirname(dst_path), exist_ok=True)
+        shutil.move(path, dst_path)
+
+    def local_copy(self, key: str, path: str) -> str:
+        # файл уже лежит на диске, копировать его не нужно
+        if not self.exists(key):
+            raise FileNotFoundError(self.path(key))
+
+        return self.path(key)
+
+
+class GridFSStorage(Storage):
+    """
+    Хранилище в MongoDB GridFS. Позволяет нескольким веб-узлам и воркерам работать с общими артефактами без NFS.
+    Ключ хранится в filename, при перезаписи старые ревизии удаляются.
+
+    Клиент MongoDB создается лениво в каждом процессе: после fork и в процессах пула нельзя
+    пользоваться клиентом родительского процесса.
+    """
+
+    def __init__(self, uri: str, bucket_name: str) -> None:
+        self.uri = uri
+        self.bucket_name = bucket_name
+        self._db = None
+        self._bucket = None
+
+    def __getstate__(self) -> Dict[str, str]:
+        return {"uri": self.uri, "bucket_name": self.bucket_name}
+
+    def __setstate__(self, state: Dict[str, str]) -> None:
+        self.__init__(**state)
+
+    def _connect(self) -> None:
+        if self._bucket is None:
+            self._db = MongoClient(self.uri).get_database()
+            self._bucket = GridFSBucket(self._db, bucket_name=self.bucket_name)
+
+    @property
+    def bucket(self) -> GridFSBucket:
+        self._connect()
+        return self._bucket
+
+    @property
+    def files(self) -> Collection:
+        self._connect()
+        return self._db[f"{self.bucket_name}.files"]
+
+    def open_read(self, key: str) -> BinaryIO:
+        try:
+            return self.bucket.open_download_stream_by_name(key)
+        except NoFile:
+            raise FileNotFoundError(key)
+
+    @contextmanager
+    def open_write(self, key: str) -> Iterator[BinaryIO]:
+        stream = self.bucket.open_upload_stream(key, chunk_size_bytes=_CHUNK_SIZE)
+        try:
+            yield stream
+        except BaseException:
+            stream.abort()
+            raise
+
+        stream.close()
+
+        # читатели берут последнюю ревизию, поэтому старые удаляем только после записи новой
+        for old_file in self.files.find({"filename": key, "_id": {"$ne": stream._id}}, {"_id": 1}):
+            self.bucket.delete(old_file["_id"])
+
+    def exists(self, key: str) -> bool:
+        return self.files.find_one({"filename": key}, {"_id": 1}) is not None
+
+    def version(self, key: str) -> str:
+        # каждая запись создает новую ревизию со своим _id
+        last_file = self.files.find_one({"filename": key}, {"_id": 1}, sort=[("uploadDate", -1)])
+        if last_file is None:
+            raise FileNotFoundError(key)
+
+        return str(last_file["_id"])
+
+    def list(self, prefix: str) -> List[str]:
+        keys = self.files.distinct("filename", {"filename": {"$regex": f"^{re.escape(prefix)}/"}})
+        return [key for key in keys if "/" not in key[len(prefix) + 1:]]
+
+    def delete(self, key: str) -> None:
+        for old_file in self.files.find({"filename": key}, {"_id": 1}):
+            self.bucket.delete(old_file["_id"])
+
+    def delete_prefix(self, prefix: str) -> None:
+        for old_file in self.files.find({"filename": {"$regex": f"^{re.escape(prefix)}/"}}, {"_id": 1}):
+            self.bucket.delete(old_file["_id"])
+
+
+def get_storage() -> Storage:
+    """
+    Хранилище артефактов текущего приложения, выбранное в STORAGE_BACKEND
+    """
+    storage = current_app.extensions.get("storage")
+
+    if storage is None:
+        backend = current_app.config["STORAGE_BACKEND"]
+
+        if backend == "local":
+            storage = LocalStorage(mounts={current_app.config["SERIES_IMG_FOLDER"]: current_app.static_folder})
+        elif backend == "gridfs":
+            storage = GridFSStorage(current_app.config["MONGO_URI"], current_app.config["STORAGE_GRIDFS_BUCKET"])
+        else:
+            raise ValueError(f"Unknown storage backend: {backend}")
+
+        current_app.extensions["storage"] = storage
+
+    return storage
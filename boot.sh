@@ -24,4 +24,6 @@ while true; do
 done
 
 source venv/bin/activate
-exec gunicorn -b $HOST:$GUNICORN_PORT --timeout=120 --access-logfile "$ACCESS_LOGFILE" --error-logfile "$ERROR_LOGFILE" brain_morph:flask_app
+# потоки нужны, чтобы потоки событий анализа (SSE) не занимали весь воркер. Каждый зритель анализа держит
+# поток до конца анализа, поэтому число потоков с запасом больше ANALYSIS_EVENTS_MAX_STREAMS (по умолчанию 8)
+exec gunicorn -b $HOST:$GUNICORN_PORT --worker-class gthread --threads 16 --timeout=120 --access-logfile "$ACCESS_LOGFILE" --error-logfile "$ERROR_LOGFILE" brain_morph:flask_app
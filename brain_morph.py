@@ -7,3 +7,8 @@ from app.model import *
 flask_app = create_app()
 
 UserCollection.init(flask_app)
+JobCollection.init()
+AnalysisCacheCollection.init()
+AnalysisEventCollection.init()
+UploadSessionCollection.init()
+SliceIndexCollection.init()
@@ -51,11 +51,49 @@ class Config:
     # расширение NIFTI
     NIFTI_EXT = os.environ.get("NIFTI_EXT", ".nii.gz")
 
-    # папка для 2D хранения изображений серий. Путь задается относительно static папки приложения.
+    # папка, в которой старые версии хранили 2D изображения серий. Путь задается относительно static папки приложения.
     SERIES_IMG_FOLDER = os.environ.get("SERIES_IMG_FOLDER", "SERIES_IMAGE")
 
-    # расширение для 2D изображений серий
-    SERIES_IMG_EXT = os.environ.get("SERIES_IMG_EXT", ".png")
+    # размер 2D изображений срезов (PNG) по умолчанию в пикселях по большей стороне
+    SERIES_IMG_SIZE = int(os.environ.get("SERIES_IMG_SIZE", 512))
+
+    # процент самых темных и самых ярких пикселей, которые обрезаются при отрисовке среза
+    # без окна WindowCenter/WindowWidth
+    SERIES_IMG_CLIP_PERCENT = float(os.environ.get("SERIES_IMG_CLIP_PERCENT", 0.5))
+
+    # максимальный размер 2D изображения среза, который можно запросить
+    PREVIEW_MAX_SIZE = int(os.environ.get("PREVIEW_MAX_SIZE", 1024))
+
+    # папка для дискового кэша отрисованных срезов. Путь задается относительно корня проекта.
+    PREVIEW_CACHE_FOLDER = os.environ.get("PREVIEW_CACHE_FOLDER", "PREVIEW_CACHE")
+
+    # максимальный размер кэша отрисованных срезов в байтах. По умолчанию 2 ГБ
+    PREVIEW_CACHE_MAX_SIZE = int(os.environ.get("PREVIEW_CACHE_MAX_SIZE", 2 * 1024 ** 3))
+
+    # не чаще какого периода в секундах процесс проверяет размер кэша отрисованных срезов
+    PREVIEW_CACHE_EVICT_INTERVAL = float(os.environ.get("PREVIEW_CACHE_EVICT_INTERVAL", 60))
+
+    # сколько секунд браузер может не перепроверять картинку среза. По умолчанию 30 дней
+    PREVIEW_MAX_AGE = int(os.environ.get("PREVIEW_MAX_AGE", 30 * 24 * 60 * 60))
+
+    # папка для несжатых копий объемов, которые отдаются просмотрщику в браузере.
+    # Путь задается относительно корня проекта.
+    VOLUME_CACHE_FOLDER = os.environ.get("VOLUME_CACHE_FOLDER", "VOLUME_CACHE")
+
+    # максимальный размер кэша несжатых копий объемов в байтах. По умолчанию 20 ГБ
+    VOLUME_CACHE_MAX_SIZE = int(os.environ.get("VOLUME_CACHE_MAX_SIZE", 20 * 1024 ** 3))
+
+    # уровни пирамиды объема уменьшаются вдвое, пока большая сторона уровня больше этого размера
+    VOLUME_PYRAMID_MIN_SIZE = int(os.environ.get("VOLUME_PYRAMID_MIN_SIZE", 32))
+
+    # размер миниатюры среза в спрайте в пикселях по большей стороне
+    SPRITE_TILE_SIZE = int(os.environ.get("SPRITE_TILE_SIZE", 96))
+
+    # максимальное количество миниатюр в спрайте одной плоскости
+    SPRITE_MAX_TILES = int(os.environ.get("SPRITE_MAX_TILES", 64))
+
+    # непрозрачность сегментации FSL FIRST, наложенной на срезы через гиппокампы (от 0 до 1)
+    SEGMENTATION_OVERLAY_ALPHA = float(os.environ.get("SEGMENTATION_OVERLAY_ALPHA", 0.45))
 
     # fractional intensity threshold для FSL BET (параметр -f)
     BET_FRAC = float(os.environ.get("BET_FRAC", 0.8))
@@ -72,3 +110,96 @@ class Config:
 
     # таймаут в секундах для анализа. По умолчанию ставим 12 минут
     TIMEOUT_VALUE = int(os.environ.get("TIMEOUT_VALUE", 720))
+
+    # количество процессов анализа, запускаемых вместе с веб-приложением. 0 - не запускать локальный пул
+    ANALYSIS_LOCAL_WORKERS = int(os.environ.get("ANALYSIS_LOCAL_WORKERS", 1))
+
+    # период опроса очереди заданий на анализ в секундах
+    ANALYSIS_POLL_INTERVAL = float(os.environ.get("ANALYSIS_POLL_INTERVAL", 2))
+
+    # время аренды задания воркером в секундах. Если воркер не продлил аренду, задание возвращается в очередь
+    ANALYSIS_LEASE_SECONDS = int(os.environ.get("ANALYSIS_LEASE_SECONDS", 60))
+
+    # период продления аренды задания в секундах. С этим же периодом воркер узнает об отмене анализа
+    ANALYSIS_HEARTBEAT_INTERVAL = float(os.environ.get("ANALYSIS_HEARTBEAT_INTERVAL", 5))
+
+    # максимальное количество попыток выполнить задание
+    ANALYSIS_MAX_ATTEMPTS = int(os.environ.get("ANALYSIS_MAX_ATTEMPTS", 3))
+
+    # префикс ключей хранилища для кэша результатов анализа. Кэш лежит в общем хранилище артефактов (STORAGE_BACKEND),
+    # поэтому его записи доступны воркерам на всех хостах. В локальном хранилище - папка относительно корня проекта.
+    ANALYSIS_CACHE_FOLDER = os.environ.get("ANALYSIS_CACHE_FOLDER", "ANALYSIS_CACHE")
+
+    # максимальный размер кэша результатов анализа в байтах. По умолчанию 10 ГБ
+    ANALYSIS_CACHE_MAX_SIZE = int(os.environ.get("ANALYSIS_CACHE_MAX_SIZE", 10 * 1024 ** 3))
+
+    # папка для рабочих папок узлов nipype, которые переиспользуются между запусками анализа.
+    # Путь задается относительно корня проекта.
+    ANALYSIS_WORK_FOLDER = os.environ.get("ANALYSIS_WORK_FOLDER", "ANALYSIS_WORK")
+
+    # сколько дней хранить неиспользуемые рабочие папки узлов nipype
+    ANALYSIS_WORK_RETENTION_DAYS = float(os.environ.get("ANALYSIS_WORK_RETENTION_DAYS", 14))
+
+    # количество ядер, которое отдается одному анализу (n_procs для nipype MultiProc)
+    ANALYSIS_CORES_PER_JOB = int(os.environ.get("ANALYSIS_CORES_PER_JOB", 2))
+
+    # память в ГБ, которая отдается одному анализу (memory_gb для nipype MultiProc)
+    ANALYSIS_MEMORY_PER_JOB_GB = float(os.environ.get("ANALYSIS_MEMORY_PER_JOB_GB", 4))
+
+    # общий бюджет памяти в ГБ на все анализы хоста
+    ANALYSIS_MEMORY_BUDGET_GB = float(os.environ.get("ANALYSIS_MEMORY_BUDGET_GB", 16))
+
+    # максимальное количество одновременных анализов на хосте. 0 - определяется по ядрам и памяти
+    ANALYSIS_SLOTS = int(os.environ.get("ANALYSIS_SLOTS", 0))
+
+    # папка с файлами блокировок слотов анализа. Должна находиться на локальном диске хоста.
+    # Путь задается относительно корня проекта.
+    ANALYSIS_LOCK_DIR = os.environ.get("ANALYSIS_LOCK_DIR", "ANALYSIS_LOCKS")
+
+    # период в секундах, с которым поток событий анализа шлет keepalive при отсутствии событий
+    ANALYSIS_EVENTS_KEEPALIVE = float(os.environ.get("ANALYSIS_EVENTS_KEEPALIVE", 15))
+
+    # максимальная длительность одного потока событий анализа в секундах. Браузер переподключится сам
+    ANALYSIS_EVENTS_STREAM_TIMEOUT = int(os.environ.get("ANALYSIS_EVENTS_STREAM_TIMEOUT", 600))
+
+    # максимальное количество одновременных потоков событий анализа в одном процессе gunicorn. Каждый поток
+    # занимает поток gunicorn (--threads в boot.sh), поэтому значение должно быть меньше числа потоков,
+    # иначе зрители анализа займут все потоки и обычные запросы встанут в очередь
+    ANALYSIS_EVENTS_MAX_STREAMS = int(os.environ.get("ANALYSIS_EVENTS_MAX_STREAMS", 8))
+
+    # пороги проверки качества снимка перед анализом: минимальное количество срезов по каждой оси,
+    # максимальный размер вокселя в мм, минимальное поле обзора в мм и минимальное отношение сигнал/шум
+    QC_MIN_DIM = int(os.environ.get("QC_MIN_DIM", 64))
+    QC_MAX_VOXEL_SIZE_MM = float(os.environ.get("QC_MAX_VOXEL_SIZE_MM", 2.0))
+    QC_MIN_FOV_MM = float(os.environ.get("QC_MIN_FOV_MM", 120))
+    QC_MIN_SNR = float(os.environ.get("QC_MIN_SNR", 5))
+
+    # количество процессов для разбора загружаемых DICOM файлов. 1 - разбирать в текущем процессе.
+    # Пул создается на каждую загрузку в каждом потоке веб-сервера, поэтому по умолчанию он небольшой
+    INGEST_WORKERS = int(os.environ.get("INGEST_WORKERS", 2))
+
+    # количество потоков, сжимающих срезы при архивации одной серии
+    ARCHIVE_THREADS = int(os.environ.get("ARCHIVE_THREADS", 4))
+
+    # хранилище артефактов серий (архивы DICOM, NIFTI, картинки): local - локальный диск, gridfs - MongoDB GridFS,
+    # общая для нескольких веб-узлов и воркеров
+    STORAGE_BACKEND = os.environ.get("STORAGE_BACKEND", "local")
+
+    # имя bucket GridFS для хранилища gridfs
+    STORAGE_GRIDFS_BUCKET = os.environ.get("STORAGE_GRIDFS_BUCKET", "artifacts")
+
+    # папка для файлов, загружаемых по кускам
+    UPLOAD_FOLDER = os.environ.get("UPLOAD_FOLDER", "UPLOADS")
+
+    # размер куска загрузки в байтах
+    UPLOAD_CHUNK_SIZE = int(os.environ.get("UPLOAD_CHUNK_SIZE", 8 * 1024 ** 2))
+
+    # максимальный суммарный размер файлов одной сессии загрузки в байтах
+    UPLOAD_MAX_SIZE = int(os.environ.get("UPLOAD_MAX_SIZE", 4 * 1024 ** 3))
+
+    # максимальное количество файлов в одной сессии загрузки и в архивах одной загрузки.
+    # Распакованный размер архивов ограничен UPLOAD_MAX_SIZE
+    UPLOAD_MAX_MEMBERS = int(os.environ.get("UPLOAD_MAX_MEMBERS", 20000))
+
+    # через сколько часов без новых кусков сессия загрузки считается брошенной и удаляется
+    UPLOAD_SESSION_TTL_HOURS = float(os.environ.get("UPLOAD_SESSION_TTL_HOURS", 24))